@@ -0,0 +1,205 @@
+"""
+bucket_store.py
+
+Compact storage for the in-memory rate limiter's token buckets.
+
+A bucket is identified by one int: the client's IP as an integer (strings
+that aren't IPs get a small id instead) shifted left, plus an id for the
+tier or route it limits. Its state lives in flat arrays indexed by a slot
+number, so a bucket costs a dict entry and a few array cells instead of a
+string key, a tuple and two floats.
+
+Buckets don't need a cleanup scan. A full bucket behaves exactly like a
+missing one, so each bucket is scheduled in a hierarchical timing wheel for
+the second it will have refilled and is dropped then, a few at a time on
+every check. When the store reaches `max_buckets`, the buckets closest to
+refilling are evicted first, which approximates LRU: they're the ones that
+have been left alone the longest relative to their limit.
+"""
+
+import math
+import socket
+from array import array
+
+# bits for the tier/route id below the client part of a bucket id
+CATEGORY_BITS = 16
+# marks client ids that aren't IP addresses, above any IPv6 address
+NAMED_CLIENT_FLAG = 1 << 129
+IPV6_FLAG = 1 << 128
+
+# 4 levels of 64 one-second slots cover about 194 days
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+WHEEL_MAX_DELAY = (1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1
+
+# wheel seconds caught up per check, bounds the work a check can do after
+# the process has been idle; an overdue bucket is still full, just not freed yet
+MAX_TICKS_PER_CHECK = 64
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel of bucket slots. Level n has 64 lists, each
+    covering 64^n seconds; lists of higher levels are redistributed to the
+    lower ones as the wheel reaches them.
+    """
+
+    def __init__(self, now_tick: int):
+        self.tick = now_tick
+        self.levels = [
+            [array("I") for _ in range(WHEEL_SIZE)] for _ in range(WHEEL_LEVELS)
+        ]
+
+    def add(self, slot: int, expire_tick: int) -> None:
+        # anything already due fires on the next tick
+        expire_tick = max(expire_tick, self.tick + 1)
+        delay = min(expire_tick - self.tick, WHEEL_MAX_DELAY)
+        expire_tick = self.tick + delay
+        level = 0
+        while delay >= 1 << (WHEEL_BITS * (level + 1)):
+            level += 1
+        index = (expire_tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+        self.levels[level][index].append(slot)
+
+    def advance(self, target_tick: int, max_ticks: int) -> list[int]:
+        """Moves the wheel towards `target_tick`, returns the slots that came due"""
+        due: list[int] = []
+        steps = 0
+        while self.tick < target_tick and steps < max_ticks:
+            self.tick += 1
+            steps += 1
+            for level in range(1, WHEEL_LEVELS):
+                if self.tick & ((1 << (WHEEL_BITS * level)) - 1):
+                    break
+                index = (self.tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+                cascading = self.levels[level][index]
+                self.levels[level][index] = array("I")
+                due.extend(cascading)
+            current = self.levels[0][self.tick & WHEEL_MASK]
+            if current:
+                due.extend(current)
+                self.levels[0][self.tick & WHEEL_MASK] = array("I")
+        return due
+
+    def pop_earliest(self) -> int | None:
+        """Removes and returns a slot from the soonest non-empty list"""
+        for level in range(WHEEL_LEVELS):
+            start = (self.tick >> (WHEEL_BITS * level)) & WHEEL_MASK
+            for offset in range(WHEEL_SIZE):
+                slots = self.levels[level][(start + offset) & WHEEL_MASK]
+                if slots:
+                    return slots.pop()
+        return None
+
+
+class BucketStore:
+    def __init__(self, max_buckets: int, now: float):
+        self.max_buckets = max_buckets
+        self._slots: dict[int, int] = {}
+        self._categories: dict[str, int] = {}
+        self._named_clients: dict[str, int] = {}
+        # per slot
+        self.tokens = array("d")
+        self.updated_at = array("d")
+        # when the bucket will be full again, and when the wheel will look at it;
+        # the wheel isn't updated on every check, it reschedules on expiry
+        self._expires = array("q")
+        self._scheduled = array("q")
+        self._owners: list[int | None] = []
+        self._free: list[int] = []
+        self._wheel = TimingWheel(int(now))
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def client_id(self, client: str) -> int:
+        # inet_pton rather than ipaddress, this runs for every request
+        try:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET, client))
+        except OSError:
+            pass
+        try:
+            return IPV6_FLAG | int.from_bytes(socket.inet_pton(socket.AF_INET6, client))
+        except OSError:
+            pass
+        named = self._named_clients.setdefault(client, len(self._named_clients))
+        return NAMED_CLIENT_FLAG | named
+
+    def bucket_ids(self, client: str, categories: list[str]) -> list[int]:
+        client_id = self.client_id(client) << CATEGORY_BITS
+        ids = self._categories
+        return [
+            client_id | ids.setdefault(category, len(ids)) for category in categories
+        ]
+
+    def find(self, bucket_ids: list[int]) -> list[int | None]:
+        slots = self._slots
+        return [slots.get(bucket_id) for bucket_id in bucket_ids]
+
+    def put(
+        self,
+        bucket_id: int,
+        slot: int | None,
+        tokens: float,
+        now: float,
+        full_at: float,
+    ) -> None:
+        """Stores a bucket's state, `slot` is None for new buckets"""
+        expire_tick = math.ceil(full_at)
+        if slot is None:
+            slot = self._allocate(bucket_id)
+            self._expires[slot] = expire_tick
+            self._scheduled[slot] = expire_tick
+            self._wheel.add(slot, expire_tick)
+        elif expire_tick > self._expires[slot]:
+            self._expires[slot] = expire_tick
+        self.tokens[slot] = tokens
+        self.updated_at[slot] = now
+
+    def make_room(self, needed: int) -> None:
+        """Evicts buckets until `needed` new ones fit under max_buckets"""
+        while self._slots and len(self._slots) + needed > self.max_buckets:
+            slot = self._wheel.pop_earliest()
+            if slot is None:
+                return
+            if self._expires[slot] > self._scheduled[slot]:
+                # used since it was scheduled, give it its real place first
+                self._reschedule(slot)
+                continue
+            self._release(slot)
+
+    def expire(self, now: float, max_ticks: int = MAX_TICKS_PER_CHECK) -> None:
+        """Drops the buckets that have refilled, up to `max_ticks` seconds' worth"""
+        if now < self._wheel.tick + 1:
+            return
+        for slot in self._wheel.advance(int(now), max_ticks):
+            if self._expires[slot] > self._wheel.tick:
+                # cascading from a higher level, or used since it was scheduled
+                self._reschedule(slot)
+            else:
+                self._release(slot)
+
+    def _reschedule(self, slot: int) -> None:
+        self._scheduled[slot] = self._expires[slot]
+        self._wheel.add(slot, self._expires[slot])
+
+    def _allocate(self, bucket_id: int) -> int:
+        if self._free:
+            slot = self._free.pop()
+            self._owners[slot] = bucket_id
+        else:
+            slot = len(self._owners)
+            self._owners.append(bucket_id)
+            self.tokens.append(0.0)
+            self.updated_at.append(0.0)
+            self._expires.append(0)
+            self._scheduled.append(0)
+        self._slots[bucket_id] = slot
+        return slot
+
+    def _release(self, slot: int) -> None:
+        del self._slots[self._owners[slot]]
+        self._owners[slot] = None
+        self._free.append(slot)
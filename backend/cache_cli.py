@@ -0,0 +1,188 @@
+"""
+cache_cli.py
+
+Inspects and clears the Redis cache by namespace (see cache_namespaces):
+
+    uv run python cache_cli.py list
+    uv run python cache_cli.py count hypixel_player --version old
+    uv run python cache_cli.py sample wynncraft_player -n 5
+    uv run python cache_cli.py invalidate hypixel_player --version old --yes
+
+Keys are found with SCAN and removed with UNLINK in batches, pausing between
+batches, so clearing a large namespace doesn't block Redis for the API.
+invalidate only prints what it would remove unless --yes is given.
+"""
+
+import argparse
+import asyncio
+import sys
+from typing import AsyncIterator
+
+from redis.asyncio import Redis
+
+import cache_codec
+from cache_namespaces import NAMESPACES, CacheNamespace, owner
+from redis_manager import get_redis
+
+PREVIEW_LENGTH = 120
+
+
+def matches_version(namespace: CacheNamespace, key: str, version: str) -> bool:
+    if version == "all" or namespace.version is None:
+        return True
+    key_version = namespace.version_of(key)
+    if version == "current":
+        return key_version == namespace.version
+    return key_version is not None and key_version < namespace.version
+
+
+async def scan_namespace(
+    redis: Redis, namespace: CacheNamespace, version: str, batch_size: int
+) -> AsyncIterator[str]:
+    # the match also covers nested namespaces and other versions, hence owner()
+    async for raw_key in redis.scan_iter(
+        match=f"{namespace.prefix}*", count=batch_size
+    ):
+        key = raw_key.decode() if isinstance(raw_key, bytes) else raw_key
+        if owner(key) is namespace and matches_version(namespace, key, version):
+            yield key
+
+
+def preview(raw: bytes | None) -> str:
+    if raw is None:
+        return "-"
+    try:
+        text = repr(cache_codec.loads(raw))
+    except (ValueError, TypeError):
+        text = f"<{len(raw)} bytes>"
+    if len(text) > PREVIEW_LENGTH:
+        text = text[:PREVIEW_LENGTH] + "..."
+    return text
+
+
+async def list_namespaces(redis: Redis, args: argparse.Namespace) -> None:
+    for namespace in NAMESPACES.values():
+        version = "-" if namespace.version is None else f"v{namespace.version}"
+        print(
+            f"{namespace.name:<28} {version:<4} {namespace.prefix:<38} "
+            f"{namespace.description}"
+        )
+
+
+async def count_keys(redis: Redis, args: argparse.Namespace) -> None:
+    count = 0
+    async for _ in scan_namespace(redis, args.namespace, args.version, args.batch_size):
+        count += 1
+    print(count)
+
+
+async def sample_keys(redis: Redis, args: argparse.Namespace) -> None:
+    shown = 0
+    async for key in scan_namespace(
+        redis, args.namespace, args.version, args.batch_size
+    ):
+        ttl = await redis.ttl(key)
+        if (await redis.type(key)) in (b"hash", "hash"):
+            raw = await redis.hget(key, "data")
+        else:
+            raw = await redis.get(key)
+        print(f"{key}  ttl={ttl}  {preview(raw)}")
+        shown += 1
+        if shown >= args.n:
+            break
+
+
+async def invalidate_keys(redis: Redis, args: argparse.Namespace) -> None:
+    removed = 0
+    batch: list[str] = []
+
+    async def flush() -> None:
+        nonlocal removed
+        if args.yes:
+            removed += await redis.unlink(*batch)
+            await asyncio.sleep(args.pause)
+        else:
+            removed += len(batch)
+        batch.clear()
+
+    async for key in scan_namespace(
+        redis, args.namespace, args.version, args.batch_size
+    ):
+        batch.append(key)
+        if len(batch) >= args.batch_size:
+            await flush()
+    if batch:
+        await flush()
+
+    if args.yes:
+        print(f"Removed {removed} keys from {args.namespace.name}")
+    else:
+        print(
+            f"Would remove {removed} keys from {args.namespace.name}, "
+            "run again with --yes to remove them"
+        )
+
+
+def cache_namespace(name: str) -> CacheNamespace:
+    try:
+        return NAMESPACES[name]
+    except KeyError:
+        raise argparse.ArgumentTypeError(
+            f"unknown namespace {name}, see the list command"
+        )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Inspect and clear the Redis cache")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="show the cache namespaces")
+    list_parser.set_defaults(handler=list_namespaces)
+
+    def add_scan_arguments(command: argparse.ArgumentParser) -> None:
+        command.add_argument("namespace", type=cache_namespace)
+        command.add_argument(
+            "--version",
+            choices=["current", "old", "all"],
+            default="all",
+            help="only keys written by the current or by older schema versions",
+        )
+        command.add_argument("--batch-size", type=int, default=500)
+
+    count_parser = commands.add_parser("count", help="count a namespace's keys")
+    add_scan_arguments(count_parser)
+    count_parser.set_defaults(handler=count_keys)
+
+    sample_parser = commands.add_parser("sample", help="show a few keys and values")
+    add_scan_arguments(sample_parser)
+    sample_parser.add_argument("-n", type=int, default=10)
+    sample_parser.set_defaults(handler=sample_keys)
+
+    invalidate_parser = commands.add_parser(
+        "invalidate", help="remove a namespace's keys"
+    )
+    add_scan_arguments(invalidate_parser)
+    invalidate_parser.add_argument(
+        "--pause", type=float, default=0.05, help="seconds between batches"
+    )
+    invalidate_parser.add_argument(
+        "--yes", action="store_true", help="remove them instead of counting"
+    )
+    invalidate_parser.set_defaults(handler=invalidate_keys)
+
+    return parser
+
+
+async def main(args: argparse.Namespace) -> None:
+    redis = await get_redis()
+    try:
+        await args.handler(redis, args)
+    finally:
+        await redis.aclose()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(build_parser().parse_args()))
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -0,0 +1,104 @@
+"""
+cache_codec.py
+
+Binary encoding for the Redis cache values. A value is
+
+    MAGIC | version | flags | body
+
+where the body is msgpack, zstd-compressed when that makes it smaller (the
+repeated field names of guild members and ability tree nodes compress very
+well). MAGIC is 0xC1, a byte msgpack never uses and no JSON document or UTF-8
+text can start with, so `loads` can tell these values apart from the JSON
+entries written before, and keeps reading those until they expire.
+
+Images are cached as raw PNG bytes instead of base64 text; modules list their
+base64 fields and convert them with `b64_to_bytes` / `bytes_to_b64`.
+
+CACHE_WRITE_FORMAT=json keeps writing JSON, for rolling out to a deployment
+whose older workers can only read JSON: deploy with it first, then without.
+"""
+
+import base64
+import os
+from typing import Any, Iterable
+
+import msgpack
+import zstandard
+
+import json_codec
+
+MAGIC = b"\xc1"
+FORMAT_VERSION = 1
+HEADER_SIZE = 3
+
+FLAG_ZSTD = 0x01
+
+# smaller bodies don't gain enough from compression to be worth the CPU
+COMPRESS_MIN_BYTES = 256
+ZSTD_LEVEL = 3
+
+WRITE_FORMAT = os.getenv("CACHE_WRITE_FORMAT", "binary")
+
+_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+_decompressor = zstandard.ZstdDecompressor()
+
+
+class CacheFormatError(ValueError):
+    """A value in a format or version this worker can't read"""
+
+
+def dumps(obj: Any) -> bytes:
+    if WRITE_FORMAT == "json":
+        return json_codec.dumps(obj)
+    return dumps_binary(obj)
+
+
+def dumps_binary(obj: Any) -> bytes:
+    """dumps regardless of CACHE_WRITE_FORMAT, for keys no older worker reads"""
+    flags = 0
+    body = msgpack.packb(obj, use_bin_type=True)
+    if len(body) >= COMPRESS_MIN_BYTES:
+        compressed = _compressor.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_ZSTD
+    return MAGIC + bytes((FORMAT_VERSION, flags)) + body
+
+
+def loads(raw: str | bytes) -> Any:
+    if isinstance(raw, str) or raw[:1] != MAGIC:
+        # written before the binary format, or with CACHE_WRITE_FORMAT=json
+        return json_codec.loads(raw)
+
+    if len(raw) < HEADER_SIZE:
+        raise CacheFormatError("truncated cache value")
+    version, flags = raw[1], raw[2]
+    if version != FORMAT_VERSION:
+        raise CacheFormatError(f"unknown cache format version {version}")
+
+    body = raw[HEADER_SIZE:]
+    try:
+        if flags & FLAG_ZSTD:
+            body = _decompressor.decompress(body)
+        return msgpack.unpackb(body, raw=False, strict_map_key=False)
+    except (zstandard.ZstdError, msgpack.UnpackException, ValueError) as e:
+        raise CacheFormatError(f"corrupt cache value: {e}") from e
+
+
+def b64_to_bytes(payload: dict, fields: Iterable[str]) -> dict:
+    """Copy of `payload` with the base64 `fields` decoded, before dumps"""
+    if WRITE_FORMAT == "json":
+        return payload
+    payload = dict(payload)
+    for field in fields:
+        if isinstance(payload.get(field), str):
+            payload[field] = base64.b64decode(payload[field])
+    return payload
+
+
+def bytes_to_b64(payload: dict, fields: Iterable[str]) -> dict:
+    """Undoes b64_to_bytes after loads, base64 from JSON entries is kept as is"""
+    for field in fields:
+        if isinstance(payload.get(field), bytes):
+            payload[field] = base64.b64encode(payload[field]).decode("ascii")
+    return payload
@@ -0,0 +1,340 @@
+"""
+cache_envelope.py
+
+Soft and hard expiry for the provider caches. Every entry is stored as
+{"timestamp": ..., "data": ...} and a CachePolicy decides what its age means:
+
+- younger than `fresh_seconds`: served as is
+- within the following `revalidate_seconds`: served straight away while a
+  background task refreshes it (stale-while-revalidate)
+- older than that, until Redis expires the key after `hard_seconds`: the
+  request refreshes it, but gets the old value if the upstream fails
+  (stale-if-error)
+
+Values are encoded with cache_codec, which still reads the older JSON entries.
+Keys come from cache_namespaces; `read_entry` / `read_entries` fall back to
+the previous schema version's entries.
+
+Whenever a stale value is served the (provider, resource) is recorded for the
+current request, and the middleware in main.py reports it in the X-Cache-Stale
+header.
+
+Lookups that end in NotFound leave a short-lived negative entry behind, so
+repeated searches for a typo or a player who never joined a server don't go
+upstream every time. They only count while there is no cached value, and are
+removed as soon as a fetch finds the resource.
+
+Datasets that rarely change are fetched conditionally. Their entries are kept
+in a Redis hash next to the upstream's validators (ETag, Last-Modified), so a
+304 only has to bump the timestamp and TTL of the entry.
+"""
+
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Generic, TypeVar
+
+import httpx
+from redis.asyncio import Redis
+from redis.exceptions import ResponseError
+
+import cache_codec
+import exceptions
+import json_codec
+import request_cost
+from cache_namespaces import NEGATIVE, CacheNamespace, get_versioned
+from single_flight import single_flight
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# upstream failures that a stale value can stand in for
+STALE_IF_ERROR_EXCEPTIONS = (
+    exceptions.UpstreamError,
+    exceptions.UpstreamTimeoutError,
+    exceptions.ServiceError,
+)
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    fresh_seconds: int
+    revalidate_seconds: int
+    # how long Redis keeps the entry, the upper bound for stale-if-error
+    hard_seconds: int
+
+
+# how long a NotFound is remembered, by provider
+NEGATIVE_TTL: dict[str, int] = {
+    # usernames get registered and changed all the time
+    "mojang": 60 * 2,
+    "hypixel": 60 * 10,
+    "wynncraft": 60 * 10,
+    "mcci": 60 * 10,
+    "donut": 60 * 5,
+}
+DEFAULT_NEGATIVE_TTL = 60 * 5
+
+
+@dataclass
+class Cached(Generic[T]):
+    value: T
+    stored_at: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.stored_at
+
+
+@dataclass(frozen=True)
+class Validators:
+    etag: str | None = None
+    last_modified: str | None = None
+
+    @classmethod
+    def from_response(cls, response: httpx.Response) -> "Validators":
+        return cls(response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+    def headers(self) -> dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class NotModified:
+    """Returned by conditional fetches when the upstream answered 304"""
+
+
+NOT_MODIFIED = NotModified()
+
+
+def wrap(data: Any) -> bytes:
+    return cache_codec.dumps({"timestamp": time.time(), "data": data})
+
+
+def unwrap(raw: str | bytes | None) -> tuple[Any, float] | None:
+    """
+    Returns (data, stored_at), or None for missing, pre-envelope or unreadable
+    entries
+    """
+    if raw is None:
+        return None
+    try:
+        envelope = cache_codec.loads(raw)
+        return envelope["data"], float(envelope["timestamp"])
+    except (ValueError, TypeError, KeyError):
+        return None
+
+
+async def read_entries(
+    redis: Redis, namespace: CacheNamespace, ids: list[str | None]
+) -> list[tuple[Any, float] | None]:
+    """unwrap for several ids of a namespace, see cache_namespaces for versions"""
+    entries: list[tuple[Any, float] | None] = []
+    for raw, previous in await get_versioned(redis, namespace, ids):
+        entry = unwrap(raw)
+        if entry is not None and previous and namespace.migrate is not None:
+            try:
+                entry = namespace.migrate(entry[0]), entry[1]
+            except Exception as e:
+                logger.warning(f"Couldn't migrate {namespace.name} entry: {e}")
+                entry = None
+        entries.append(entry)
+    return entries
+
+
+async def read_entry(
+    redis: Redis, namespace: CacheNamespace, id: str | None = None
+) -> tuple[Any, float] | None:
+    return (await read_entries(redis, namespace, [id]))[0]
+
+
+async def read_conditional(redis: Redis, key: str) -> tuple[Any, float] | None:
+    """Like unwrap, for entries written by write_conditional"""
+    try:
+        timestamp, data = await redis.hmget(key, "timestamp", "data")
+    except ResponseError:
+        # still a plain string entry from before it was fetched conditionally
+        return None
+    if timestamp is None or data is None:
+        return None
+    try:
+        return cache_codec.loads(data), float(timestamp)
+    except ValueError:
+        return None
+
+
+async def read_validators(redis: Redis, key: str) -> Validators:
+    try:
+        etag, last_modified = await redis.hmget(key, "etag", "last_modified")
+    except ResponseError:
+        return Validators()
+    return Validators(json_codec.to_str(etag), json_codec.to_str(last_modified))
+
+
+async def write_conditional(
+    redis: Redis, key: str, data: Any, ttl: int, validators: Validators
+) -> None:
+    entry = {"timestamp": time.time(), "data": cache_codec.dumps(data)}
+    if validators.etag:
+        entry["etag"] = validators.etag
+    if validators.last_modified:
+        entry["last_modified"] = validators.last_modified
+
+    pipe = redis.pipeline()
+    pipe.delete(key)
+    pipe.hset(key, mapping=entry)
+    pipe.expire(key, ttl)
+    await pipe.execute()
+
+
+async def touch_conditional(redis: Redis, key: str, ttl: int) -> float:
+    """
+    Marks an entry fresh again after a 304, leaving its payload alone.
+    Returns the new timestamp, for local_cache.touch.
+    """
+    stored_at = time.time()
+    pipe = redis.pipeline()
+    pipe.hset(key, "timestamp", stored_at)
+    pipe.expire(key, ttl)
+    await pipe.execute()
+    return stored_at
+
+
+def negative_key(key: tuple[str, str, str]) -> str:
+    return NEGATIVE.key(":".join(key))
+
+
+async def is_known_missing(redis: Redis, key: tuple[str, str, str]) -> bool:
+    try:
+        return bool(await redis.exists(negative_key(key)))
+    except Exception as e:
+        logger.warning(f"Couldn't check negative cache for {':'.join(key)}: {e}")
+        return False
+
+
+async def remember_missing(redis: Redis, key: tuple[str, str, str]) -> None:
+    ttl = NEGATIVE_TTL.get(key[0], DEFAULT_NEGATIVE_TTL)
+    try:
+        await redis.set(negative_key(key), b"1", ex=ttl)
+    except Exception as e:
+        logger.warning(f"Couldn't store negative cache for {':'.join(key)}: {e}")
+
+
+async def forget_missing(redis: Redis, *keys: tuple[str, str, str]) -> None:
+    """For when a resource turns up through another path than its own lookup"""
+    if not keys:
+        return
+    try:
+        await redis.unlink(*(negative_key(key) for key in keys))
+    except Exception as e:
+        logger.warning(f"Couldn't clear negative cache entries: {e}")
+
+
+_stale_resources: ContextVar[set[str] | None] = ContextVar(
+    "stale_resources", default=None
+)
+
+
+def track_stale_resources() -> set[str]:
+    """Called once per request, the returned set fills up as stale values are served"""
+    stale: set[str] = set()
+    _stale_resources.set(stale)
+    return stale
+
+
+def mark_stale(key: tuple[str, str, str]) -> None:
+    stale = _stale_resources.get()
+    if stale is not None:
+        stale.add(f"{key[0]}:{key[1]}")
+
+
+# strong references, the event loop only keeps weak ones to running tasks
+_refreshes: set[asyncio.Task] = set()
+
+
+def _refresh_done(key: tuple[str, str, str], task: asyncio.Task) -> None:
+    _refreshes.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(
+            f"Background refresh of {':'.join(key)} failed: {task.exception()}"
+        )
+
+
+def refresh_in_background(
+    redis: Redis, key: tuple[str, str, str], fetch: Callable[[], Awaitable[Any]]
+) -> None:
+    # the request that triggered it is served without waiting, so it isn't
+    # charged for the refresh either
+    task = asyncio.create_task(
+        single_flight(redis, key, fetch), context=request_cost.untracked_context()
+    )
+    _refreshes.add(task)
+    task.add_done_callback(lambda task: _refresh_done(key, task))
+
+
+async def serve_cached(
+    redis: Redis,
+    key: tuple[str, str, str],
+    policy: CachePolicy,
+    read_cache: Callable[[], Awaitable[Cached[T] | None]],
+    fetch: Callable[[], Awaitable[T | NotModified]],
+    as_stale: Callable[[T], T] | None = None,
+) -> T:
+    """
+    Serves `key` according to `policy`, coalescing upstream fetches.
+    `fetch` is responsible for writing the cache, or for refreshing it and
+    returning NOT_MODIFIED when the upstream says it hasn't changed. A
+    NotFound from `fetch` is remembered for NEGATIVE_TTL.
+    `as_stale` lets callers flag a stale value in the value itself (e.g.
+    setting source="stale_cache").
+    """
+    cached = await read_cache()
+    if cached is not None and cached.age < policy.fresh_seconds:
+        return cached.value
+
+    async def load() -> T:
+        # another request or worker may have refreshed it while we waited
+        latest = await read_cache()
+        if latest is not None and latest.age < policy.fresh_seconds:
+            return latest.value
+        try:
+            result = await fetch()
+        except exceptions.NotFound:
+            await remember_missing(redis, key)
+            raise
+        if not isinstance(result, NotModified):
+            return result
+        if latest is None:
+            # the entry expired between reading it and the 304
+            latest = await read_cache()
+            if latest is None:
+                raise exceptions.UpstreamError()
+        return latest.value
+
+    def serve_stale(stale: Cached[T]) -> T:
+        mark_stale(key)
+        return as_stale(stale.value) if as_stale is not None else stale.value
+
+    if cached is None:
+        if await is_known_missing(redis, key):
+            raise exceptions.NotFound()
+        request_cost.add_cache_miss()
+        return await single_flight(redis, key, load)
+
+    if cached.age < policy.fresh_seconds + policy.revalidate_seconds:
+        refresh_in_background(redis, key, load)
+        return serve_stale(cached)
+
+    request_cost.add_cache_miss()
+    try:
+        return await single_flight(redis, key, load)
+    except STALE_IF_ERROR_EXCEPTIONS as e:
+        logger.warning(f"Serving stale {':'.join(key)} after upstream error: {e}")
+        return serve_stale(cached)
@@ -0,0 +1,232 @@
+"""
+cache_namespaces.py
+
+Every kind of key the API keeps in Redis, in one place. A CacheNamespace is a
+key prefix and, for cached payloads, a schema version that is part of the key:
+
+    aspexis:hypixel:player:v1:<uuid>
+
+Bump a namespace's version when the shape of its payload changes. Entries are
+then written under the new version, while a read that misses the new key
+falls back to the previous version's entry, passed through `migrate` when the
+namespace has one. The old entry is served until it ages out under its
+normal CachePolicy, so the refetches are spread over the entries' lifetimes
+instead of every entry turning into a miss at deploy time. A `migrate` that
+raises, or a payload that no longer validates, is a miss for that entry only.
+Old versions' keys expire on their own, or can be removed with cache_cli.py.
+
+Version 1 falls back to the unversioned keys from before namespaces existed.
+Namespaces without a version (locks, counters, id mappings) have no fallback.
+The hashes written by cache_envelope.write_conditional don't fall back either,
+there are only a handful of them and they're fetched conditionally anyway.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from redis.asyncio import Redis
+
+
+@dataclass(frozen=True)
+class CacheNamespace:
+    name: str
+    prefix: str
+    version: int | None = None
+    # upgrades a previous version's payload to the current shape
+    migrate: Callable[[Any], Any] | None = None
+    description: str = ""
+
+    @property
+    def base(self) -> str:
+        if self.version is None:
+            return self.prefix
+        return f"{self.prefix}:v{self.version}"
+
+    @property
+    def previous_base(self) -> str | None:
+        if self.version is None:
+            return None
+        if self.version == 1:
+            return self.prefix
+        return f"{self.prefix}:v{self.version - 1}"
+
+    def key(self, id: str | None = None) -> str:
+        return self.base if id is None else f"{self.base}:{id}"
+
+    def previous_key(self, id: str | None = None) -> str | None:
+        base = self.previous_base
+        if base is None:
+            return None
+        return base if id is None else f"{base}:{id}"
+
+    def version_of(self, key: str) -> int | None:
+        """Version a key of this namespace was written by, 0 before versions"""
+        if self.version is None:
+            return None
+        rest = key[len(self.prefix) :]
+        if rest.startswith(":v"):
+            number = rest[2:].split(":", 1)[0]
+            if number.isdigit():
+                return int(number)
+        return 0
+
+
+NAMESPACES: dict[str, CacheNamespace] = {}
+
+
+def namespace(
+    name: str,
+    prefix: str,
+    version: int | None = None,
+    migrate: Callable[[Any], Any] | None = None,
+    description: str = "",
+) -> CacheNamespace:
+    if name in NAMESPACES:
+        raise ValueError(f"cache namespace {name} already exists")
+    cache_namespace = CacheNamespace(name, prefix, version, migrate, description)
+    NAMESPACES[name] = cache_namespace
+    return cache_namespace
+
+
+def owner(key: str) -> CacheNamespace | None:
+    """The namespace a key belongs to, prefixes can be nested"""
+    matches = [
+        ns
+        for ns in NAMESPACES.values()
+        if key == ns.prefix or key.startswith(f"{ns.prefix}:")
+    ]
+    return max(matches, key=lambda ns: len(ns.prefix), default=None)
+
+
+async def get_versioned(
+    redis: Redis, namespace: CacheNamespace, ids: list[str | None]
+) -> list[tuple[bytes | None, bool]]:
+    """
+    Raw values for `ids` in one round trip, from the previous version's keys
+    where the current ones are missing. The flag is True for those.
+    """
+    if not ids:
+        return []
+    keys = [namespace.key(id) for id in ids]
+    if namespace.version is None:
+        return [(raw, False) for raw in await redis.mget(keys)]
+
+    previous_keys = [namespace.previous_key(id) for id in ids]
+    raws = await redis.mget(keys + previous_keys)
+    current, previous = raws[: len(ids)], raws[len(ids) :]
+    return [
+        (raw, False) if raw is not None else (old, old is not None)
+        for raw, old in zip(current, previous)
+    ]
+
+
+# minecraft
+MINECRAFT_DATA = namespace(
+    "minecraft_data",
+    "aspexis:minecraft:data",
+    version=1,
+    description="Mojang profiles by uuid, textures referenced by hash",
+)
+MINECRAFT_USERNAME = namespace(
+    "minecraft_username",
+    "aspexis:minecraft:username",
+    description="lowercased username -> uuid",
+)
+TEXTURE = namespace(
+    "texture",
+    "aspexis:texture",
+    version=1,
+    description="rendered skin faces and capes by texture hash",
+)
+CAPES_GENERIC = namespace(
+    "capes_generic",
+    "aspexis:cape:generic",
+    version=1,
+    description="capes.me catalog, conditional",
+)
+CAPES_USER = namespace(
+    "capes_user", "aspexis:cape:user", version=1, description="capes per uuid"
+)
+CAPES_IMAGE = namespace(
+    "capes_image",
+    "aspexis:cape:image",
+    version=1,
+    description="cape renders by image digest",
+)
+
+# hypixel
+HYPIXEL_PLAYER = namespace(
+    "hypixel_player", "aspexis:hypixel:player", version=1, description="by uuid"
+)
+HYPIXEL_GUILD = namespace(
+    "hypixel_guild", "aspexis:hypixel:guild", version=1, description="by guild id"
+)
+HYPIXEL_PLAYER_GUILD = namespace(
+    "hypixel_player_guild",
+    "aspexis:hypixel:player_guild",
+    description="uuid -> guild id",
+)
+HYPIXEL_QUOTA = namespace(
+    "hypixel_quota", "aspexis:hypixel:quota", description="shared API key quota"
+)
+
+# wynncraft
+WYNNCRAFT_PLAYER = namespace(
+    "wynncraft_player", "aspexis:wynncraft:player", version=1, description="by uuid"
+)
+WYNNCRAFT_STATUS = namespace(
+    "wynncraft_status",
+    "aspexis:wynncraft:status",
+    version=1,
+    description="online status by uuid",
+)
+WYNNCRAFT_TREE_STRUCTURE = namespace(
+    "wynncraft_tree_structure",
+    "aspexis:wynncraft:tree:structure",
+    version=1,
+    description="by class, conditional",
+)
+WYNNCRAFT_TREE_ABILITIES = namespace(
+    "wynncraft_tree_abilities",
+    "aspexis:wynncraft:tree:abilities",
+    version=1,
+    description="by class, conditional",
+)
+WYNNCRAFT_PLAYER_STRUCTURE = namespace(
+    "wynncraft_player_structure",
+    "aspexis:wynncraft:player:structure",
+    version=1,
+    description="unlocked abilities by uuid:character",
+)
+WYNNCRAFT_MAX_CONTENT = namespace(
+    "wynncraft_max_content",
+    "aspexis:wynncraft:max_stats",
+    version=1,
+    description="conditional",
+)
+
+# other servers
+DONUT_STATS = namespace(
+    "donut_stats",
+    "aspexis:donut:stats",
+    version=1,
+    description="by lowercased username",
+)
+MCCI = namespace(
+    "mcci", "aspexis:mcci", version=1, description="player sections, section:uuid"
+)
+
+# bookkeeping
+NEGATIVE = namespace(
+    "negative",
+    "aspexis:notfound",
+    description="remembered NotFounds, provider:resource:id",
+)
+POPULARITY = namespace(
+    "popularity", "aspexis:popularity", description="decayed view counts by kind"
+)
+RATE_LIMIT = namespace(
+    "rate_limit", "aspexis:ratelimit", description="token buckets, {ip}:tier"
+)
+SINGLE_FLIGHT_LOCK = namespace("single_flight_lock", "aspexis:lock:single_flight")
+REFRESH_AHEAD_LOCK = namespace("refresh_ahead_lock", "aspexis:lock:refresh_ahead")
@@ -2,7 +2,7 @@ from redis.asyncio import Redis
 from dotenv import load_dotenv
 import httpx
 import os
-import json
+import cache_codec
 from pydantic import BaseModel
 import exceptions
 import logging
@@ -12,6 +12,24 @@ from utils import pillow_to_b64
 import asyncio
 from redis_manager import get_redis
 import hashlib
+from upstream_clients import UpstreamClients
+from cache_envelope import (
+    NOT_MODIFIED,
+    CachePolicy,
+    Cached,
+    NotModified,
+    read_conditional,
+    read_validators,
+    serve_cached,
+    touch_conditional,
+    read_entry,
+    Validators,
+    wrap,
+    write_conditional,
+)
+from cache_namespaces import CAPES_GENERIC, CAPES_IMAGE, CAPES_USER, get_versioned
+from local_cache import invalidate, local_cache, touch
+from request_cost import measure_cpu
 
 load_dotenv()
 logger = logging.getLogger(__name__)
@@ -24,9 +42,25 @@ BROWSER_HEADERS = {
     "Accept": "application/json",
 }
 
-GENERIC_CAPES_KEY = "aspexis:cape:generic"
-USER_CAPES_KEY = "aspexis:cape:user:"
-IMAGE_CAPES_KEY = "aspexis:cape:image:"
+GENERIC_CAPES_KEY = CAPES_GENERIC.key()
+
+GENERIC_CAPES_POLICY = CachePolicy(
+    fresh_seconds=60 * 60,
+    revalidate_seconds=60 * 60 * 24,
+    hard_seconds=60 * 60 * 24 * 7,
+)
+USER_CAPES_POLICY = CachePolicy(
+    fresh_seconds=60 * 15,
+    revalidate_seconds=60 * 60,
+    hard_seconds=60 * 60 * 24,
+)
+
+# cached as raw PNG bytes
+IMAGE_FIELDS = ("front_b64", "back_b64")
+
+GENERIC_CAPES_LOCAL_CACHE = local_cache(
+    "capes_catalog", ttl_seconds=60 * 5, max_entries=1
+)
 
 
 class GenericCapeData(BaseModel):
@@ -48,14 +82,12 @@ class UserCapeData(BaseModel):
     removed: bool
 
 
-def get_image_key(url: str) -> str:
-    digest = hashlib.sha256(url.encode()).hexdigest()
-    return f"{IMAGE_CAPES_KEY}{digest}"
+def get_image_id(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
 
 
-def process_generic_capes(cape_data) -> list[GenericCapeData]:
+def process_generic_capes(cape_data: list[dict]) -> list[GenericCapeData]:
     capes: list[GenericCapeData] = []
-    cape_data = json.loads(cape_data)
     for cape in cape_data:
         capes.append(
             GenericCapeData(
@@ -75,19 +107,42 @@ def get_cape_dictionary(cape_list: list[GenericCapeData]) -> dict[str, GenericCa
     return cape_dict
 
 
+async def get_generic_cape_cache(redis: Redis) -> Cached[list[GenericCapeData]] | None:
+    async def load() -> Cached[list[GenericCapeData]] | None:
+        cached = await read_conditional(redis, GENERIC_CAPES_KEY)
+        if cached is not None:
+            cape_data, stored_at = cached
+            return Cached(process_generic_capes(cape_data), stored_at)
+        return None
+
+    return await GENERIC_CAPES_LOCAL_CACHE.get_or_load(GENERIC_CAPES_KEY, load)
+
+
 async def get_generic_cape_data(
-    client: httpx.AsyncClient, redis: Redis
+    client: UpstreamClients, redis: Redis
 ) -> list[GenericCapeData]:
-    """Fetches data from capes.me about all known capes and caches it in Redis."""
-    cape_data_raw = await redis.get(GENERIC_CAPES_KEY)
-    if cape_data_raw:
-        return process_generic_capes(cape_data_raw)
+    """Gets data from capes.me about all known capes"""
+    return await serve_cached(
+        redis,
+        ("capes", "catalog", "all"),
+        GENERIC_CAPES_POLICY,
+        lambda: get_generic_cape_cache(redis),
+        lambda: fetch_generic_cape_data(client, redis),
+    )
+
 
+async def fetch_generic_cape_data(
+    client: UpstreamClients, redis: Redis
+) -> list[GenericCapeData] | NotModified:
+    """Fetches data from capes.me about all known capes and caches it in Redis."""
+    validators = await read_validators(redis, GENERIC_CAPES_KEY)
     try:
-        response = await client.get(
-            "https://capes.me/api/capes", timeout=10, headers=BROWSER_HEADERS
+        response = await client.provider("capes").get(
+            "https://capes.me/api/capes",
+            headers={**BROWSER_HEADERS, **validators.headers()},
         )
-        response.raise_for_status()
+        if response.status_code != 304:
+            response.raise_for_status()
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP error occurred: {e}")
         raise exceptions.UpstreamError()
@@ -97,32 +152,66 @@ async def get_generic_cape_data(
     except httpx.RequestError as e:
         logger.error(f"Request exception occurred: {e}")
         raise exceptions.UpstreamError()
+    except exceptions.UpstreamError:
+        # circuit breaker is open
+        raise
     except Exception as e:
         logger.warning(f"something went wrong while getting capes from capes.me: {e}")
         raise exceptions.ServiceError()
 
+    if response.status_code == 304:
+        stored_at = await touch_conditional(
+            redis, GENERIC_CAPES_KEY, GENERIC_CAPES_POLICY.hard_seconds
+        )
+        await touch(redis, GENERIC_CAPES_LOCAL_CACHE, GENERIC_CAPES_KEY, stored_at)
+        return NOT_MODIFIED
+
     response_data = response.json()
 
-    await redis.set(
-        GENERIC_CAPES_KEY, json.dumps(response_data), ex=3600
-    )  # cache for 1 hour
+    await write_conditional(
+        redis,
+        GENERIC_CAPES_KEY,
+        response_data,
+        GENERIC_CAPES_POLICY.hard_seconds,
+        Validators.from_response(response),
+    )
+    await invalidate(redis, GENERIC_CAPES_LOCAL_CACHE, GENERIC_CAPES_KEY)
+
+    return process_generic_capes(response_data)
 
-    return process_generic_capes(json.dumps(response_data))
 
+async def get_user_capes_cache(
+    uuid: str, redis: Redis
+) -> Cached[list[UserCapeData]] | None:
+    cached = await read_entry(redis, CAPES_USER, uuid)
+    if cached is not None:
+        cape_data, stored_at = cached
+        capes = []
+        for cape in cape_data:
+            images = cache_codec.bytes_to_b64(cape["images"], IMAGE_FIELDS)
+            capes.append(UserCapeData(**{**cape, "images": images}))
+        return Cached(capes, stored_at)
+    return None
 
-async def get_capes_for_user(uuid: str, client: httpx.AsyncClient, redis: Redis):
+
+async def get_capes_for_user(uuid: str, client: UpstreamClients, redis: Redis):
     """Fetches capes for a specific user by UUID."""
+    return await serve_cached(
+        redis,
+        ("capes", "user", uuid),
+        USER_CAPES_POLICY,
+        lambda: get_user_capes_cache(uuid, redis),
+        lambda: fetch_capes_for_user(uuid, client, redis),
+    )
 
-    user_cape_data_raw = await redis.get(f"{USER_CAPES_KEY}{uuid}")
-    if user_cape_data_raw:
-        capes = []
-        for cape in json.loads(user_cape_data_raw):
-            capes.append(UserCapeData(**cape))
-        return capes
 
+async def fetch_capes_for_user(
+    uuid: str, client: UpstreamClients, redis: Redis
+) -> list[UserCapeData]:
+    """Fetches capes for a user from capes.me and caches them"""
     try:
-        response = await client.get(
-            f"https://capes.me/api/user/{uuid}", timeout=10, headers=BROWSER_HEADERS
+        response = await client.provider("capes").get(
+            f"https://capes.me/api/user/{uuid}", headers=BROWSER_HEADERS
         )
         response.raise_for_status()
     except httpx.HTTPStatusError as e:
@@ -136,6 +225,9 @@ async def get_capes_for_user(uuid: str, client: httpx.AsyncClient, redis: Redis)
     except httpx.RequestError as e:
         logger.error(f"Request exception occurred: {e}")
         raise exceptions.UpstreamError()
+    except exceptions.UpstreamError:
+        # circuit breaker is open
+        raise
     except Exception as e:
         logger.warning(f"something went wrong while getting capes from capes.me: {e}")
         raise exceptions.ServiceError()
@@ -168,24 +260,38 @@ async def get_capes_for_user(uuid: str, client: httpx.AsyncClient, redis: Redis)
         user_capes = await asyncio.gather(*tasks)
 
     await redis.set(
-        f"{USER_CAPES_KEY}{uuid}",
-        json.dumps([cape.model_dump() for cape in user_capes]),
-        ex=900,
+        CAPES_USER.key(uuid),
+        wrap(
+            [
+                {
+                    **cape.model_dump(),
+                    "images": cache_codec.b64_to_bytes(
+                        cape.images.model_dump(), IMAGE_FIELDS
+                    ),
+                }
+                for cape in user_capes
+            ]
+        ),
+        ex=USER_CAPES_POLICY.hard_seconds,
     )
 
     return user_capes
 
 
 async def get_cape_images(
-    cape_url: str, client: httpx.AsyncClient, redis: Redis
+    cape_url: str, client: UpstreamClients, redis: Redis
 ) -> CapeImageData:
-    cape_data = await redis.get(get_image_key(cape_url))
+    [(cape_data, _)] = await get_versioned(redis, CAPES_IMAGE, [get_image_id(cape_url)])
     if cape_data:
-        cape_data_json = json.loads(cape_data)
-        return CapeImageData(**cape_data_json)
+        try:
+            payload = cache_codec.loads(cape_data)
+            return CapeImageData(**cache_codec.bytes_to_b64(payload, IMAGE_FIELDS))
+        except ValueError:
+            # unreadable, fetch it again
+            pass
 
     try:
-        response = await client.get(cape_url, timeout=10)
+        response = await client.provider("capes").get(cape_url)
         response.raise_for_status()
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP error occurred: {e}")
@@ -196,23 +302,27 @@ async def get_cape_images(
     except httpx.RequestError as e:
         logger.error(f"Request exception occurred: {e}")
         raise exceptions.UpstreamError()
+    except exceptions.UpstreamError:
+        # circuit breaker is open
+        raise
     except Exception as e:
         logger.warning(
             f"something went wrong while getting cape image from mojang: {e}"
         )
         raise exceptions.ServiceError()
 
-    cape_bytes = io.BytesIO(response.content)
-    full_cape_image = Image.open(cape_bytes)
+    with measure_cpu():
+        cape_bytes = io.BytesIO(response.content)
+        full_cape_image = Image.open(cape_bytes)
 
-    crop_area = (1, 1, 11, 17)
-    cape_showcase = full_cape_image.crop(crop_area)
+        crop_area = (1, 1, 11, 17)
+        cape_showcase = full_cape_image.crop(crop_area)
 
-    crop_area = (12, 1, 22, 17)
-    cape_back = full_cape_image.crop(crop_area)
+        crop_area = (12, 1, 22, 17)
+        cape_back = full_cape_image.crop(crop_area)
 
-    cape_front_b64 = pillow_to_b64(cape_showcase)
-    cape_back_b64 = pillow_to_b64(cape_back)
+        cape_front_b64 = pillow_to_b64(cape_showcase)
+        cape_back_b64 = pillow_to_b64(cape_back)
 
     full_cape_data = CapeImageData(
         front_b64=cape_front_b64,
@@ -220,7 +330,11 @@ async def get_cape_images(
     )
 
     await redis.set(
-        get_image_key(cape_url), full_cape_data.model_dump_json(), ex=86400
+        CAPES_IMAGE.key(get_image_id(cape_url)),
+        cache_codec.dumps(
+            cache_codec.b64_to_bytes(full_cape_data.model_dump(), IMAGE_FIELDS)
+        ),
+        ex=86400,
     )  # cache for 24 hours
 
     return full_cape_data
@@ -230,11 +344,10 @@ if __name__ == "__main__":
 
     async def main():
         redis = await get_redis()
-        async with httpx.AsyncClient() as client:
-            print(
-                await get_capes_for_user(
-                    "3ff2e63ad63045e0b96f57cd0eae708d", client, redis
-                )
-            )
+        client = UpstreamClients()
+        print(
+            await get_capes_for_user("3ff2e63ad63045e0b96f57cd0eae708d", client, redis)
+        )
+        await client.aclose()
 
     asyncio.run(main())
@@ -0,0 +1,167 @@
+"""
+circuit_breaker.py
+
+Per-provider circuit breaker. Tracks the outcome and latency of recent upstream
+requests; once too many of them fail the breaker opens and requests fail fast
+with UpstreamError instead of each waiting for a timeout. After a cooldown a
+single probe request is let through to test whether the provider recovered.
+
+It also derives the provider's read timeout from its recent p99 latency, so a
+provider that normally answers in 200ms doesn't get to hold a connection for
+the full 10 seconds.
+"""
+
+import logging
+import math
+import time
+from collections import deque
+from typing import Literal
+
+from pydantic import BaseModel
+
+import exceptions
+
+logger = logging.getLogger(__name__)
+
+BreakerState = Literal["closed", "open", "half_open"]
+
+# outcomes older than this don't count towards the error rate
+WINDOW_SECONDS = 60
+WINDOW_SIZE = 200
+# error rate only matters once we have enough requests to judge from
+MIN_REQUESTS = 20
+FAILURE_THRESHOLD = 0.5
+OPEN_SECONDS = 30
+
+# adaptive timeouts need enough successful samples before p99 means anything
+MIN_LATENCY_SAMPLES = 50
+TIMEOUT_P99_MULTIPLIER = 3.0
+MIN_TIMEOUT_SECONDS = 2.0
+
+
+class CircuitBreakerStats(BaseModel):
+    state: BreakerState
+    requests_in_window: int
+    error_rate: float
+    p50_ms: float | None
+    p95_ms: float | None
+    p99_ms: float | None
+    timeout_seconds: float
+    times_opened: int
+    rejected: int
+
+
+class CircuitBreaker:
+    def __init__(self, provider: str, max_timeout: float):
+        self.provider = provider
+        self.max_timeout = max_timeout
+        self.state: BreakerState = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+        # (finished_at, ok)
+        self.outcomes: deque[tuple[float, bool]] = deque(maxlen=WINDOW_SIZE)
+        # latency in seconds of successful requests
+        self.latencies: deque[float] = deque(maxlen=WINDOW_SIZE)
+
+    def before_request(self) -> bool:
+        """
+        Raises UpstreamError while the breaker is open.
+        Returns True if this request is the half-open probe.
+        """
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < OPEN_SECONDS:
+                self.rejected += 1
+                raise exceptions.UpstreamError()
+            self.state = "half_open"
+
+        if self.state == "half_open":
+            if self.probe_in_flight:
+                self.rejected += 1
+                raise exceptions.UpstreamError()
+            self.probe_in_flight = True
+            return True
+
+        return False
+
+    def record(self, ok: bool, latency: float | None = None, probe: bool = False):
+        now = time.monotonic()
+        if probe:
+            self.probe_in_flight = False
+
+        if ok and latency is not None:
+            self.latencies.append(latency)
+
+        if self.state == "half_open" and probe:
+            if ok:
+                logger.info(f"{self.provider} circuit breaker closed")
+                self.state = "closed"
+                self.outcomes.clear()
+            else:
+                self._open(now)
+            return
+
+        self.outcomes.append((now, ok))
+        if self.state == "closed" and not ok:
+            requests, error_rate = self._window(now)
+            if requests >= MIN_REQUESTS and error_rate >= FAILURE_THRESHOLD:
+                self._open(now)
+
+    def record_latency(self, latency: float) -> None:
+        """A latency sample without an outcome, for requests that were cancelled"""
+        self.latencies.append(latency)
+
+    def release_probe(self) -> None:
+        """Called when the probe was cancelled before it had an outcome"""
+        self.probe_in_flight = False
+
+    def _open(self, now: float) -> None:
+        logger.warning(f"{self.provider} circuit breaker opened")
+        self.state = "open"
+        self.opened_at = now
+        self.times_opened += 1
+
+    def _window(self, now: float) -> tuple[int, float]:
+        recent = [
+            ok
+            for finished_at, ok in self.outcomes
+            if now - finished_at <= WINDOW_SECONDS
+        ]
+        if not recent:
+            return 0, 0.0
+        return len(recent), recent.count(False) / len(recent)
+
+    def percentile(self, p: float) -> float | None:
+        """Latency percentile in seconds, p is between 0 and 1"""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, math.ceil(p * len(ordered)) - 1)
+        return ordered[max(index, 0)]
+
+    def timeout(self) -> float:
+        if len(self.latencies) < MIN_LATENCY_SAMPLES:
+            return self.max_timeout
+        p99 = self.percentile(0.99) or self.max_timeout
+        return min(
+            self.max_timeout, max(MIN_TIMEOUT_SECONDS, p99 * TIMEOUT_P99_MULTIPLIER)
+        )
+
+    def stats(self) -> CircuitBreakerStats:
+        requests, error_rate = self._window(time.monotonic())
+
+        def to_ms(value: float | None) -> float | None:
+            return round(value * 1000, 1) if value is not None else None
+
+        return CircuitBreakerStats(
+            state=self.state,
+            requests_in_window=requests,
+            error_rate=round(error_rate, 3),
+            p50_ms=to_ms(self.percentile(0.5)),
+            p95_ms=to_ms(self.percentile(0.95)),
+            p99_ms=to_ms(self.percentile(0.99)),
+            timeout_seconds=round(self.timeout(), 2),
+            times_opened=self.times_opened,
+            rejected=self.rejected,
+        )
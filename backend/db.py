@@ -16,13 +16,16 @@ db_url = db_url.split("?")[0]
 db_url = re.sub(r"^postgresql\+psycopg2:", "postgresql+asyncpg:", db_url)
 db_url = re.sub(r"^postgresql:", "postgresql+asyncpg:", db_url)
 
+DB_POOL_SIZE = 15  # persistent connections
+DB_MAX_OVERFLOW = 15  # temporary burst connections
+
 engine = create_async_engine(
     db_url,
     connect_args={"ssl": "require"},
     echo=False,
     pool_pre_ping=True,
-    pool_size=15,  # persistent connections
-    max_overflow=15,  # temporary burst connections
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
     pool_timeout=30,  # seconds to wait before error
 )
 
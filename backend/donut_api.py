@@ -1,14 +1,12 @@
-import httpx
 import asyncio
+import httpx
 from dotenv import load_dotenv
 import os
 from pydantic import BaseModel
-from fastapi import HTTPException
 from metrics_manager import add_value
 from db import engine
-from minecraft_manager import get_minecraft_data
 import exceptions
-from redis.asyncio import Redis
+from upstream_clients import UpstreamClients
 
 load_dotenv()
 
@@ -34,23 +32,47 @@ class DonutPlayerStats(BaseModel):
 
 async def get_donut_stats(
     username: str,
-    http_client: httpx.AsyncClient,
+    http_client: UpstreamClients,
 ) -> DonutPlayerStats:
     """Returns a DonutPlayerStats object on success, raises NotFound on fail"""
+    # the two endpoints don't depend on each other
+    donut_response, online_status = await asyncio.gather(
+        fetch_donut_stats(username, http_client),
+        get_donut_status(username, http_client),
+    )
+    return process_donut_stats(donut_response, online_status)
+
+
+async def fetch_donut_stats(username: str, http_client: UpstreamClients) -> dict:
     assert donut_api_key is not None, "Donut API key not found"
     try:
-        donut_response_raw = await http_client.get(
+        donut_response_raw = await http_client.provider("donut").get(
             f"https://api.donutsmp.net/v1/stats/{username}",
             headers={"Authorization": donut_api_key},
         )
         donut_response_raw.raise_for_status()
-        donut_response = donut_response_raw.json()
-
-        online_status = await get_donut_status(username, http_client)
+        return donut_response_raw.json()
+
+    except httpx.HTTPStatusError as e:
+        # only a real 404 is remembered as missing, anything else is Donut's
+        # problem and shouldn't hide the player for NEGATIVE_TTL
+        if e.response.status_code == 404:
+            raise exceptions.NotFound()
+        print(f"Donut stats request failed with {e.response.status_code}")
+        raise exceptions.UpstreamError()
+    except httpx.TimeoutException as e:
+        print(f"Donut stats request timed out: {e}")
+        raise exceptions.UpstreamTimeoutError()
+    except exceptions.UpstreamError:
+        # circuit breaker is open
+        raise
+    except Exception as e:
+        # connection errors and unparseable responses
+        print(f"Donut stats request failed: {e}")
+        raise exceptions.UpstreamError()
 
-    except Exception:
-        raise exceptions.NotFound()
 
+def process_donut_stats(donut_response: dict, online_status: bool) -> DonutPlayerStats:
     stats_to_convert = {
         "money": "money",
         "shards": "shards",
@@ -101,12 +123,12 @@ async def get_donut_stats(
     return player_stats
 
 
-async def get_donut_status(username: str, http_client: httpx.AsyncClient) -> bool:
+async def get_donut_status(username: str, http_client: UpstreamClients) -> bool:
     """Returns true if the player is online, false if offline"""
     # so the donutapi is really dumb it only shows rank if the player is online like who designed this 💀
     assert donut_api_key is not None, "Donut API key not found"
     try:
-        donut_status_response = await http_client.get(
+        donut_status_response = await http_client.provider("donut").get(
             f"https://api.donutsmp.net/v1/lookup/{username}",
             headers={"Authorization": donut_api_key},
         )
@@ -126,13 +148,8 @@ async def get_donut_status(username: str, http_client: httpx.AsyncClient) -> boo
     return False
 
 
-async def add_donut_stats_to_db(
-    data: DonutPlayerStats,
-    username,
-    session,
-    http_client: httpx.AsyncClient,
-    redis: Redis,
-) -> None:
+async def add_donut_stats_to_db(data: DonutPlayerStats, uuid: str | None) -> None:
+    """`uuid` is resolved by the request, None if that failed"""
     if not isinstance(data, DonutPlayerStats):
         print("Couldn't add donut data to db because it's not DonutPlayerStats")
         return
@@ -149,19 +166,8 @@ async def add_donut_stats_to_db(
         20: data.placed_blocks,
     }
 
-    try:
-        mojang_data = await get_minecraft_data(username, http_client, redis)
-        uuid = mojang_data.uuid
-    except HTTPException:
-        print(
-            f"Donut Stats: an HTTP Exception happened while fetching uuid for {username}; not adding to db"
-        )
-        return
-
     if uuid is None:
-        print(
-            f"Donut Stats: could not get uuid for player {username}; not adding to db"
-        )
+        print("Donut Stats: no uuid for this player; not adding to db")
         return
 
     async with engine.begin() as conn:
@@ -171,5 +177,5 @@ async def add_donut_stats_to_db(
 
 
 if __name__ == "__main__":
-    data = asyncio.run(get_donut_stats("2b3t", httpx.AsyncClient()))
+    data = asyncio.run(get_donut_stats("2b3t", UpstreamClients()))
     print(data)
@@ -0,0 +1,77 @@
+import asyncio
+
+from redis.asyncio import Redis
+
+from cache_envelope import CachePolicy, Cached, read_entry, serve_cached, wrap
+from cache_namespaces import DONUT_STATS
+from donut_api import DonutPlayerStats, get_donut_stats
+from minecraft_manager import get_minecraft_data
+from upstream_clients import UpstreamClients
+
+DONUT_POLICY = CachePolicy(
+    fresh_seconds=60 * 3,
+    revalidate_seconds=60 * 10,
+    hard_seconds=60 * 60,
+)
+
+
+async def get_donut_cache(
+    username: str, redis: Redis
+) -> Cached[DonutPlayerStats] | None:
+    cached = await read_entry(redis, DONUT_STATS, username)
+    if cached is not None:
+        payload, stored_at = cached
+        try:
+            return Cached(DonutPlayerStats(**payload), stored_at)
+        except Exception as e:
+            print(f"Couldn't validate DonutPlayerStats from cache: {e}")
+            return None
+    return None
+
+
+async def fetch_donut_data(
+    username: str, http_client: UpstreamClients, redis: Redis
+) -> DonutPlayerStats:
+    data = await get_donut_stats(username, http_client)
+    await redis.set(
+        DONUT_STATS.key(username),
+        wrap(data.model_dump()),
+        ex=DONUT_POLICY.hard_seconds,
+    )
+    return data
+
+
+async def resolve_donut_uuid(
+    username: str, http_client: UpstreamClients, redis: Redis
+) -> str | None:
+    """
+    The player's uuid, from the Mojang cache whenever it has the username.
+    None if it can't be resolved, which only costs the stats their DB write.
+    """
+    try:
+        mojang_data = await get_minecraft_data(
+            username, http_client, redis, allow_stale=True
+        )
+    except Exception as e:
+        # not only HTTPExceptions, the stats are served either way
+        print(f"Donut Stats: couldn't resolve uuid for {username}: {e}")
+        return None
+    return mojang_data.uuid
+
+
+async def get_donut_data(
+    username: str, http_client: UpstreamClients, redis: Redis
+) -> tuple[DonutPlayerStats, str | None]:
+    """The player's stats and uuid, looked up concurrently"""
+    # the Donut API doesn't care about case
+    username = username.lower()
+    return await asyncio.gather(
+        serve_cached(
+            redis,
+            ("donut", "stats", username),
+            DONUT_POLICY,
+            lambda: get_donut_cache(username, redis),
+            lambda: fetch_donut_data(username, http_client, redis),
+        ),
+        resolve_donut_uuid(username, http_client, redis),
+    )
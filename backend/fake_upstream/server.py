@@ -0,0 +1,459 @@
+"""
+fake_upstream/server.py
+
+Local stand-in for every upstream provider the backend calls (Mojang,
+sessionserver, textures, Hypixel, Wynncraft, capes.me, MCC Island, DonutSMP).
+It replays the JSON fixtures in fake_upstream/fixtures, with latency, errors
+and 429s injected according to a profile from profiles.json.
+
+Requests are expected as /<original host>/<original path>, which is what the
+backend sends when UPSTREAM_OVERRIDE_URL is set:
+
+    uv run python fake_upstream/server.py --profile degraded --port 8099
+    UPSTREAM_OVERRIDE_URL=http://127.0.0.1:8099 uv run fastapi dev main.py
+
+With --record, requests are forwarded to the real upstream instead and the
+responses saved under fixtures/recorded; later runs replay those before
+falling back to the generic fixtures.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import httpx
+import uvicorn
+from PIL import Image
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+FAKE_UPSTREAM_DIR = Path(__file__).parent
+FIXTURES_DIR = FAKE_UPSTREAM_DIR / "fixtures"
+RECORDED_DIR = FIXTURES_DIR / "recorded"
+PROFILES_FILE = FAKE_UPSTREAM_DIR / "profiles.json"
+
+TEXTURE = "texture"
+UUID = r"(?P<uuid>[0-9a-fA-F]{32})"
+DASHED_UUID = r"(?P<dashed_uuid>[0-9a-fA-F-]{36})"
+
+# (host, path pattern, fixture name), the first match wins
+ROUTES: list[tuple[str, str, str]] = [
+    (
+        "api.minecraftservices.com",
+        r"/minecraft/profile/lookup/name/(?P<username>[A-Za-z0-9_]{1,16})",
+        "mojang_lookup",
+    ),
+    (
+        "sessionserver.mojang.com",
+        rf"/session/minecraft/profile/{UUID}",
+        "sessionserver_profile",
+    ),
+    ("textures.minecraft.net", r"/texture/[0-9a-f]+", TEXTURE),
+    ("api.hypixel.net", r"/v2/player", "hypixel_player"),
+    ("api.hypixel.net", r"/v2/guild", "hypixel_guild"),
+    ("api.hypixel.net", r"/v2/status", "hypixel_status"),
+    (
+        "api.wynncraft.com",
+        rf"/v3/player/{DASHED_UUID}/characters/[^/]+/abilities",
+        "wynncraft_player_abilities",
+    ),
+    (
+        "api.wynncraft.com",
+        rf"/v3/player/{DASHED_UUID}/characters/[^/]+",
+        "wynncraft_character",
+    ),
+    ("api.wynncraft.com", rf"/v3/player/{DASHED_UUID}", "wynncraft_player"),
+    (
+        "api.wynncraft.com",
+        r"/v3/guild/prefix/(?P<prefix>[^/]+)",
+        "wynncraft_guild",
+    ),
+    ("api.wynncraft.com", r"/v3/ability/map/[a-z]+", "wynncraft_ability_map"),
+    ("api.wynncraft.com", r"/v3/ability/tree/[a-z]+", "wynncraft_ability_tree"),
+    (
+        "api.wynncraft.com",
+        r"/v3/leaderboards/playerContent",
+        "wynncraft_content_leaderboard",
+    ),
+    ("capes.me", r"/api/capes", "capes_catalog"),
+    ("capes.me", rf"/api/user/{UUID}", "capes_user"),
+    ("api.mccisland.net", r"/graphql", "mcci_player"),
+    ("api.donutsmp.net", r"/v1/stats/(?P<username>[^/]+)", "donut_stats"),
+    ("api.donutsmp.net", r"/v1/lookup/(?P<username>[^/]+)", "donut_lookup"),
+]
+
+# upstreams only reachable over plain http
+HTTP_ONLY_HOSTS = {"textures.minecraft.net"}
+
+# headers that shouldn't be copied between the backend, us and the real upstream
+HOP_BY_HOP_HEADERS = {
+    "host",
+    "content-length",
+    "content-encoding",
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+}
+
+
+@dataclass
+class LatencyDistribution:
+    distribution: str = "fixed"
+    value: float = 0.0
+    min: float = 0.0
+    max: float = 0.0
+    median: float = 0.0
+    p99: float = 0.0
+
+    def sample_seconds(self, rng: random.Random) -> float:
+        if self.distribution == "uniform":
+            ms = rng.uniform(self.min, self.max)
+        elif self.distribution == "lognormal":
+            # sigma chosen so that the 99th percentile lands on p99
+            sigma = math.log(max(self.p99, self.median) / self.median) / 2.326
+            ms = rng.lognormvariate(math.log(self.median), sigma)
+        else:
+            ms = self.value
+        return max(ms, 0.0) / 1000
+
+
+@dataclass
+class HostProfile:
+    latency: LatencyDistribution
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    # {"limit": ..., "window_seconds": ...}, reported through RateLimit-* headers
+    quota: dict[str, int] | None = None
+
+
+class QuotaWindow:
+    def __init__(self, limit: int, window_seconds: int):
+        self.limit = limit
+        self.window_seconds = window_seconds
+        self.started_at = time.monotonic()
+        self.used = 0
+
+    def take(self) -> tuple[bool, dict[str, str]]:
+        now = time.monotonic()
+        if now - self.started_at >= self.window_seconds:
+            self.started_at = now
+            self.used = 0
+        reset = max(1, math.ceil(self.window_seconds - (now - self.started_at)))
+        allowed = self.used < self.limit
+        if allowed:
+            self.used += 1
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(max(self.limit - self.used, 0)),
+            "RateLimit-Reset": str(reset),
+        }
+        if not allowed:
+            headers["Retry-After"] = str(reset)
+        return allowed, headers
+
+
+def load_profile(name: str) -> dict[str, HostProfile]:
+    profiles = json.loads(PROFILES_FILE.read_text())
+    if name not in profiles:
+        raise SystemExit(f"Unknown profile {name}, choose from {', '.join(profiles)}")
+
+    host_profiles = {}
+    for host, settings in profiles[name].items():
+        host_profiles[host] = HostProfile(
+            latency=LatencyDistribution(**settings.get("latency_ms", {})),
+            error_rate=settings.get("error_rate", 0.0),
+            rate_limit_rate=settings.get("rate_limit_rate", 0.0),
+            quota=settings.get("quota"),
+        )
+    return host_profiles
+
+
+def load_fixtures() -> dict[str, dict]:
+    return {
+        path.stem: json.loads(path.read_text()) for path in FIXTURES_DIR.glob("*.json")
+    }
+
+
+def username_to_uuid(username: str) -> str:
+    # usernames are at most 16 ascii characters, so they fit in a uuid and the
+    # sessionserver fixture can hand the same name back for it
+    return username.lower().encode("ascii").ljust(16, b"\0").hex()
+
+
+def uuid_to_username(uuid: str) -> str:
+    try:
+        name = bytes.fromhex(uuid).rstrip(b"\0").decode("ascii")
+    except ValueError:
+        name = ""
+    if re.fullmatch(r"[A-Za-z0-9_]{1,16}", name):
+        return name
+    return f"Player_{uuid[:8]}"
+
+
+def template_variables(
+    match: re.Match, query: dict[str, str], body: bytes
+) -> dict[str, str]:
+    variables = {k: v for k, v in match.groupdict().items() if v is not None}
+    variables.update(query)
+    # hypixel's guild endpoint takes ?player=<uuid>
+    if "player" in variables:
+        variables.setdefault("uuid", variables["player"])
+
+    if body:
+        try:
+            # graphql requests carry the uuid in their variables
+            graphql_variables = json.loads(body).get("variables") or {}
+            if "uuid" in graphql_variables:
+                variables.setdefault("dashed_uuid", graphql_variables["uuid"])
+        except (ValueError, AttributeError):
+            pass
+
+    if "dashed_uuid" in variables:
+        variables.setdefault("uuid", variables["dashed_uuid"].replace("-", ""))
+    if "uuid" in variables:
+        uuid = variables["uuid"].replace("-", "").lower()
+        variables["uuid"] = uuid
+        variables.setdefault(
+            "dashed_uuid",
+            f"{uuid[:8]}-{uuid[8:12]}-{uuid[12:16]}-{uuid[16:20]}-{uuid[20:]}",
+        )
+        variables["uuid_username"] = uuid_to_username(uuid)
+    if "username" in variables:
+        variables["username_uuid"] = username_to_uuid(variables["username"])
+    return variables
+
+
+def fill_template(value: Any, variables: dict[str, str]) -> Any:
+    if isinstance(value, str):
+        for name, replacement in variables.items():
+            value = value.replace(f"{{{name}}}", replacement)
+        return value
+    if isinstance(value, list):
+        return [fill_template(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: fill_template(item, variables) for key, item in value.items()}
+    return value
+
+
+def texture_png(path: str) -> bytes:
+    """A 64x64 RGBA texture, tinted by its hash so different skins differ"""
+    digest = hashlib.sha256(path.encode()).digest()
+    image = Image.new("RGBA", (64, 64), (digest[0], digest[1], digest[2], 255))
+    # the face overlay layer is mostly transparent, like on a real skin
+    overlay = Image.new("RGBA", (8, 8), (digest[3], digest[4], digest[5], 0))
+    image.paste(overlay, (40, 8))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def recording_key(method: str, path: str, query: str, body: bytes) -> str:
+    digest = hashlib.sha256(f"{method} {path}?{query}".encode() + body)
+    return digest.hexdigest()[:20]
+
+
+def fixture_response(fixture: dict, request_headers: dict[str, str]) -> Response:
+    headers = dict(fixture.get("headers", {}))
+    if "body_b64" in fixture:
+        content = base64.b64decode(fixture["body_b64"])
+    else:
+        content = json.dumps(fixture["body"]).encode()
+        headers.setdefault("Content-Type", "application/json")
+
+    # lets the backend's conditional fetches get 304s
+    etag = f'"{hashlib.sha1(content).hexdigest()}"'
+    headers["ETag"] = etag
+    if (
+        fixture.get("status", 200) == 200
+        and request_headers.get("if-none-match") == etag
+    ):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content, status_code=fixture.get("status", 200), headers=headers)
+
+
+class FakeUpstream:
+    def __init__(self, profile: dict[str, HostProfile], seed: int, record: bool):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.record = record
+        self.fixtures = load_fixtures()
+        self.routes = [
+            (host, re.compile(pattern), fixture) for host, pattern, fixture in ROUTES
+        ]
+        self.quotas: dict[str, QuotaWindow] = {}
+        self.textures: dict[str, bytes] = {}
+        self.counts: Counter[str] = Counter()
+        self.client = httpx.AsyncClient(timeout=30, follow_redirects=True)
+
+    def host_profile(self, host: str) -> HostProfile:
+        return self.profile.get(host) or self.profile.get(
+            "default", HostProfile(LatencyDistribution())
+        )
+
+    async def handle(self, request: Request) -> Response:
+        host = request.path_params["host"]
+        path = "/" + request.path_params["path"]
+        body = await request.body()
+        response = await self.respond(request, host, path, body)
+        self.counts[f"{host} {response.status_code}"] += 1
+        return response
+
+    async def respond(
+        self, request: Request, host: str, path: str, body: bytes
+    ) -> Response:
+        key = recording_key(request.method, path, request.url.query, body)
+        recorded = RECORDED_DIR / host / f"{key}.json"
+
+        if self.record:
+            return await self.forward(request, host, path, body, recorded)
+
+        host_profile = self.host_profile(host)
+        await asyncio.sleep(host_profile.latency.sample_seconds(self.rng))
+
+        quota_headers: dict[str, str] = {}
+        if host_profile.quota is not None:
+            quota = self.quotas.setdefault(
+                host,
+                QuotaWindow(
+                    host_profile.quota["limit"], host_profile.quota["window_seconds"]
+                ),
+            )
+            allowed, quota_headers = quota.take()
+            if not allowed:
+                return JSONResponse(
+                    {"success": False, "cause": "Key throttle"},
+                    status_code=429,
+                    headers=quota_headers,
+                )
+
+        if self.rng.random() < host_profile.rate_limit_rate:
+            return JSONResponse(
+                {"success": False, "cause": "Injected rate limit"},
+                status_code=429,
+                headers={**quota_headers, "Retry-After": "1"},
+            )
+        if self.rng.random() < host_profile.error_rate:
+            return JSONResponse(
+                {"success": False, "cause": "Injected upstream error"},
+                status_code=503,
+            )
+
+        if recorded.exists():
+            response = fixture_response(
+                json.loads(recorded.read_text()), dict(request.headers)
+            )
+            response.headers.update(quota_headers)
+            return response
+
+        for route_host, pattern, fixture_name in self.routes:
+            if route_host != host:
+                continue
+            match = pattern.fullmatch(path)
+            if match is None:
+                continue
+
+            if fixture_name == TEXTURE:
+                if path not in self.textures:
+                    self.textures[path] = texture_png(path)
+                return Response(self.textures[path], media_type="image/png")
+
+            fixture = self.fixtures[fixture_name]
+            variables = template_variables(match, dict(request.query_params), body)
+            fixture = {**fixture, "body": fill_template(fixture["body"], variables)}
+            response = fixture_response(fixture, dict(request.headers))
+            response.headers.update(quota_headers)
+            return response
+
+        return JSONResponse(
+            {"detail": f"fake_upstream has no fixture for {host}{path}"},
+            status_code=404,
+        )
+
+    async def forward(
+        self, request: Request, host: str, path: str, body: bytes, recorded: Path
+    ) -> Response:
+        scheme = "http" if host in HTTP_ONLY_HOSTS else "https"
+        headers = {
+            k: v for k, v in request.headers.items() if k not in HOP_BY_HOP_HEADERS
+        }
+        upstream = await self.client.request(
+            request.method,
+            f"{scheme}://{host}{path}",
+            params=request.query_params,
+            content=body,
+            headers=headers,
+        )
+
+        fixture: dict[str, Any] = {
+            "request": {
+                "method": request.method,
+                "path": path,
+                "query": request.url.query,
+            },
+            "status": upstream.status_code,
+            "headers": {
+                k: v
+                for k, v in upstream.headers.items()
+                if k.lower() not in HOP_BY_HOP_HEADERS and k.lower() != "set-cookie"
+            },
+        }
+        try:
+            fixture["body"] = upstream.json()
+        except ValueError:
+            fixture["body_b64"] = base64.b64encode(upstream.content).decode()
+
+        recorded.parent.mkdir(parents=True, exist_ok=True)
+        recorded.write_text(json.dumps(fixture, indent=2) + "\n")
+        print(f"recorded {request.method} {host}{path} -> {recorded.name}")
+        return Response(
+            upstream.content,
+            status_code=upstream.status_code,
+            headers=fixture["headers"],
+        )
+
+    async def stats(self, request: Request) -> Response:
+        return JSONResponse(dict(self.counts))
+
+
+def create_app(profile_name: str, seed: int, record: bool) -> Starlette:
+    fake = FakeUpstream(load_profile(profile_name), seed, record)
+    return Starlette(
+        routes=[
+            Route("/_fake/stats", fake.stats),
+            Route("/{host}/{path:path}", fake.handle, methods=["GET", "POST"]),
+        ]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake upstream providers")
+    parser.add_argument("--profile", default="healthy")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="forward to the real upstreams and save their responses as fixtures",
+    )
+    args = parser.parse_args()
+
+    uvicorn.run(
+        create_app(args.profile, args.seed, args.record),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
@@ -0,0 +1,188 @@
+"""
+fake_upstream/stale_check.py
+
+Checks that every provider answers from its stale cache entry when the
+upstream is down (stale-if-error):
+
+    hypixel_api_key=fake WYNN_TOKEN=fake mcci_api_key=fake donut_api_key=fake \
+        uv run python fake_upstream/stale_check.py
+
+Each case is first served through the fake upstream, run in-process with the
+"instant" profile, which fills the cache in the Redis from redis_manager (the
+local one in development, like cache_cli). Then the upstream is replaced by
+one that refuses connections, and for each case the clock is moved just past
+its policy's revalidate window, while Redis still has the entry. A case passes
+when the same call is answered from the stale entry instead of raising.
+"""
+
+import asyncio
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from redis.asyncio import Redis  # noqa: E402
+
+from cache_envelope import CachePolicy, track_stale_resources  # noqa: E402
+from capes import (  # noqa: E402
+    GENERIC_CAPES_POLICY,
+    USER_CAPES_POLICY,
+    get_capes_for_user,
+    get_generic_cape_data,
+)
+from donut_manager import DONUT_POLICY, get_donut_data  # noqa: E402
+from fake_upstream.server import create_app  # noqa: E402
+from hypixel_manager import HYPIXEL_POLICY, get_hypixel_data  # noqa: E402
+from mcci_manager import (  # noqa: E402
+    MCCI_STATUS_POLICY,
+    MCCIPlayerParams,
+    get_mcci_player,
+)
+from minecraft_manager import MINECRAFT_POLICY, get_minecraft_data  # noqa: E402
+from redis_manager import get_redis  # noqa: E402
+from upstream_clients import UpstreamClients  # noqa: E402
+from wynncraft_ability_tree import (  # noqa: E402
+    STATIC_DATA_POLICY,
+    get_tree_abilities,
+    get_tree_structure,
+)
+from wynncraft_manager import WYNNCRAFT_POLICY, get_wynncraft_data  # noqa: E402
+
+# requests are sent as <origin>/<original host>/<original path>, see server.py
+FAKE_ORIGIN = "http://fake-upstream"
+UUID = "5a6b1c1fd2e24a7f9c3e8b0d4f2a6c1e"
+USERNAME = "StaleCheck"
+
+_clock_offset = 0.0
+
+
+@dataclass(frozen=True)
+class Case:
+    name: str
+    # what mark_stale records for it, "<provider>:<resource>"
+    stale_prefix: str
+    policy: CachePolicy
+    call: Callable[[UpstreamClients, Redis], Awaitable[Any]]
+
+
+CASES = [
+    Case(
+        "mojang profile",
+        "mojang:profile",
+        MINECRAFT_POLICY,
+        lambda client, redis: get_minecraft_data(USERNAME, client, redis),
+    ),
+    Case(
+        "hypixel player",
+        "hypixel:player",
+        HYPIXEL_POLICY,
+        lambda client, redis: get_hypixel_data(UUID, client, redis),
+    ),
+    Case(
+        "wynncraft player",
+        "wynncraft:player",
+        WYNNCRAFT_POLICY,
+        lambda client, redis: get_wynncraft_data(UUID, client, redis),
+    ),
+    Case(
+        "wynncraft tree structure",
+        "wynncraft:tree_structure",
+        STATIC_DATA_POLICY,
+        lambda client, redis: get_tree_structure("mage", client, redis),
+    ),
+    Case(
+        "wynncraft tree abilities",
+        "wynncraft:tree_abilities",
+        STATIC_DATA_POLICY,
+        lambda client, redis: get_tree_abilities("mage", client, redis),
+    ),
+    Case(
+        "capes catalog",
+        "capes:catalog",
+        GENERIC_CAPES_POLICY,
+        lambda client, redis: get_generic_cape_data(client, redis),
+    ),
+    Case(
+        "capes user",
+        "capes:user",
+        USER_CAPES_POLICY,
+        lambda client, redis: get_capes_for_user(UUID, client, redis),
+    ),
+    Case(
+        "mcci player",
+        "mcci:",
+        # the status section, the first one to go stale
+        MCCI_STATUS_POLICY,
+        lambda client, redis: get_mcci_player(UUID, MCCIPlayerParams(), client, redis),
+    ),
+    Case(
+        "donut stats",
+        "donut:stats",
+        DONUT_POLICY,
+        lambda client, redis: get_donut_data(USERNAME, client, redis),
+    ),
+]
+
+
+def refuse(request: httpx.Request) -> httpx.Response:
+    raise httpx.ConnectError("connection refused (stale_check)", request=request)
+
+
+def use_transport(clients: UpstreamClients, transport: httpx.AsyncBaseTransport):
+    for provider in clients.clients.values():
+        provider.override_url = FAKE_ORIGIN
+        provider.client = httpx.AsyncClient(
+            transport=transport, headers=provider.client.headers
+        )
+
+
+def install_clock() -> None:
+    """Makes time.time run `_clock_offset` seconds ahead from now on"""
+    real_time = time.time
+    time.time = lambda: real_time() + _clock_offset
+
+
+async def main() -> int:
+    global _clock_offset
+    install_clock()
+    redis = await get_redis()
+    clients = UpstreamClients()
+    use_transport(
+        clients, httpx.ASGITransport(app=create_app("instant", 0, record=False))
+    )
+
+    for case in CASES:
+        await case.call(clients, redis)
+
+    use_transport(clients, httpx.MockTransport(refuse))
+
+    failures = 0
+    for case in CASES:
+        # fresh and revalidate windows both over, the entry hasn't expired
+        policy = case.policy
+        _clock_offset = policy.fresh_seconds + policy.revalidate_seconds + 1
+        stale = track_stale_resources()
+        try:
+            await case.call(clients, redis)
+        except Exception as e:
+            outcome = f"FAIL  raised {type(e).__name__}: {e}"
+        else:
+            if any(resource.startswith(case.stale_prefix) for resource in stale):
+                outcome = "ok    served stale"
+            else:
+                outcome = f"FAIL  not marked stale ({sorted(stale)})"
+        failures += outcome.startswith("FAIL")
+        print(f"{case.name:<26} {outcome}")
+
+    await clients.aclose()
+    await redis.aclose()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -8,6 +8,8 @@ from typing import List
 import math
 import httpx
 import asyncio
+from upstream_clients import UpstreamClients
+from hypixel_quota import HypixelPriority, scheduled_get
 
 logger = logging.getLogger(__name__)
 
@@ -146,17 +148,20 @@ class HypixelFullData(BaseModel):
     guild: HypixelGuild | None
 
 
-async def get_core_hypixel_data(uuid, http_client: httpx.AsyncClient) -> HypixelPlayer:
+async def get_core_hypixel_data(
+    uuid, http_client: UpstreamClients, priority: HypixelPriority = "interactive"
+) -> HypixelPlayer:
     payload = {"uuid": uuid}
 
     assert hypixel_api_key is not None, "Hypixel API key not found"
 
     try:
-        player_data_raw = await http_client.get(
+        player_data_raw = await scheduled_get(
+            http_client,
+            priority,
             url="https://api.hypixel.net/v2/player",
             params=payload,
             headers={"API-Key": hypixel_api_key},
-            timeout=10,
         )
 
         player_data_raw.raise_for_status()
@@ -166,14 +171,19 @@ async def get_core_hypixel_data(uuid, http_client: httpx.AsyncClient) -> Hypixel
     except httpx.TimeoutException:
         raise exceptions.UpstreamTimeoutError()
 
-    except httpx.HTTPError as e:
-        if player_data_raw.status_code == 403:
-            logger.error(f"Invalid API key: {e}\nerror message: {player_data_raw.text}")
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 403:
+            logger.error(f"Invalid API key: {e}\nerror message: {e.response.text}")
             raise exceptions.ServiceAPIKeyError()
         else:
             logger.error(f"HTTP error occurred: {e}")
             raise exceptions.UpstreamError()
 
+    except httpx.HTTPError as e:
+        # connection errors, there's no response to look at
+        logger.error(f"Request exception occurred: {e}")
+        raise exceptions.UpstreamError()
+
     if player_data.get("player") is None:
         raise exceptions.NotFound()
 
@@ -355,7 +365,10 @@ def get_guild_level(exp: int) -> int:
 
 
 async def get_guild_data(
-    http_client: httpx.AsyncClient, uuid: str | None = None, id: str | None = None
+    http_client: UpstreamClients,
+    uuid: str | None = None,
+    id: str | None = None,
+    priority: HypixelPriority = "interactive",
 ) -> HypixelGuild:
     try:
         if uuid is None and id is None:
@@ -367,11 +380,12 @@ async def get_guild_data(
 
         assert hypixel_api_key is not None, "Hypixel API key not found"
 
-        guild_data_raw = await http_client.get(
+        guild_data_raw = await scheduled_get(
+            http_client,
+            priority,
             url="https://api.hypixel.net/v2/guild",
             params=payload,
             headers={"API-Key": hypixel_api_key},
-            timeout=10,
         )
 
         guild_data_raw.raise_for_status()
@@ -379,14 +393,19 @@ async def get_guild_data(
     except httpx.TimeoutException:
         raise exceptions.UpstreamTimeoutError()
 
-    except httpx.HTTPError as e:
-        if guild_data_raw.status_code == 403:
-            logger.error(f"Invalid API key: {e}\nerror message: {guild_data_raw.text}")
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 403:
+            logger.error(f"Invalid API key: {e}\nerror message: {e.response.text}")
             raise exceptions.ServiceAPIKeyError()
         else:
             logger.error(f"HTTP error occurred: {e}")
             raise exceptions.UpstreamError()
 
+    except httpx.HTTPError as e:
+        # connection errors, there's no response to look at
+        logger.error(f"Request exception occurred: {e}")
+        raise exceptions.UpstreamError()
+
     guild_data: dict = guild_data_raw.json().get("guild")
 
     if guild_data is None:
@@ -442,7 +461,9 @@ if __name__ == "__main__":
         # uuid = "e533388b2ebc4bb1a6705ba522d4e5d6"
         # print(calculate_bedwars_level(315820))
         # data = get_core_hypixel_data(uuid)
-        data = await get_guild_data(httpx.AsyncClient(), uuid)
+        http_client = UpstreamClients()
+        data = await get_guild_data(http_client, uuid)
         print(data)
+        await http_client.aclose()
 
     asyncio.run(main())
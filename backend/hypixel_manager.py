@@ -7,6 +7,7 @@ from hypixel_api import (
     get_core_hypixel_data,
     get_guild_data,
 )
+from hypixel_quota import HypixelPriority
 from utils import check_valid_uuid
 import exceptions
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -19,77 +20,147 @@ from minecraft_manager import (
 )
 from fastapi import BackgroundTasks
 import asyncio
-import httpx
+from upstream_clients import UpstreamClients
 from redis.asyncio import Redis
 from pydantic import BaseModel, Field
 from metrics_manager import add_value
-import json
+import json_codec
+from cache_envelope import (
+    CachePolicy,
+    Cached,
+    forget_missing,
+    is_known_missing,
+    read_entry,
+    remember_missing,
+    serve_cached,
+    wrap,
+)
+from cache_namespaces import HYPIXEL_GUILD, HYPIXEL_PLAYER, HYPIXEL_PLAYER_GUILD
 
 # in seconds
 HYPIXEL_TTL = 60 * 3
-
-
-HYPIXEL_PLAYER_KEY = "aspexis:hypixel:player:"
-HYPIXEL_GUILD_KEY = "aspexis:hypixel:guild:"
-HYPIXEL_PLAYER_GUILD_KEY = "aspexis:hypixel:player_guild:"
+HYPIXEL_POLICY = CachePolicy(
+    fresh_seconds=HYPIXEL_TTL,
+    revalidate_seconds=60 * 10,
+    hard_seconds=60 * 60,
+)
 
 
 async def get_hypixel_player_cache(
     uuid: str, redis: Redis
-) -> Tuple[HypixelPlayer, Optional[str]] | None:
-    data = await redis.get(f"{HYPIXEL_PLAYER_KEY}{uuid}")
-    if data is not None:
+) -> Cached[Tuple[HypixelPlayer, Optional[str]]] | None:
+    cached = await read_entry(redis, HYPIXEL_PLAYER, uuid)
+    if cached is not None:
+        payload, stored_at = cached
         try:
-            parsed_data = json.loads(data)
-            player_data = HypixelPlayer(source="cache", **parsed_data.get("data", {}))
-            guild_id = parsed_data.get("guild_id")
-            return player_data, guild_id
+            player_data = HypixelPlayer(source="cache", **payload.get("player", {}))
+            guild_id = payload.get("guild_id")
+            return Cached((player_data, guild_id), stored_at)
         except Exception:
             return None
     return None
 
 
+async def get_hypixel_full_cache(
+    uuid: str, redis: Redis
+) -> Cached[HypixelFullData] | None:
+    player_cache = await get_hypixel_player_cache(uuid, redis)
+    if player_cache is None:
+        return None
+
+    player_data, guild_id = player_cache.value
+    guild_data = None
+    stored_at = player_cache.stored_at
+    if guild_id is not None:
+        guild_cache = await get_hypixel_guild_cache(guild_id, redis)
+        if guild_cache is None:
+            return None
+        guild_data = guild_cache.value
+        stored_at = min(stored_at, guild_cache.stored_at)
+
+    return Cached(HypixelFullData(player=player_data, guild=guild_data), stored_at)
+
+
+def mark_hypixel_stale(data: HypixelFullData) -> HypixelFullData:
+    return HypixelFullData(
+        player=data.player.model_copy(update={"source": "stale_cache"}),
+        guild=(
+            data.guild.model_copy(update={"source": "stale_cache"})
+            if data.guild is not None
+            else None
+        ),
+    )
+
+
 async def get_hypixel_data(
-    uuid: str, http_client: httpx.AsyncClient, redis: Redis
+    uuid: str, http_client: UpstreamClients, redis: Redis
 ) -> HypixelFullData:
     if not check_valid_uuid(uuid):
         raise exceptions.InvalidUserUUID()
 
+    async def fetch() -> HypixelFullData:
+        # the player part may still be fresh when only the guild expired
+        player_cache = await get_hypixel_player_cache(uuid, redis)
+        if player_cache is not None and player_cache.age < HYPIXEL_TTL:
+            return await build_hypixel_data(
+                uuid, player_cache.value, http_client, redis
+            )
+        return await build_hypixel_data(uuid, None, http_client, redis)
+
+    return await serve_cached(
+        redis,
+        ("hypixel", "player", uuid),
+        HYPIXEL_POLICY,
+        lambda: get_hypixel_full_cache(uuid, redis),
+        fetch,
+        as_stale=mark_hypixel_stale,
+    )
+
+
+async def build_hypixel_data(
+    uuid: str,
+    player_cache: Tuple[HypixelPlayer, Optional[str]] | None,
+    http_client: UpstreamClients,
+    redis: Redis,
+    priority: HypixelPriority = "interactive",
+) -> HypixelFullData:
     player_data = None
     guild_data = None
     guild_id = None
     hypixel_cache_valid = False
+    guildless_key = ("hypixel", "player_guild", uuid)
 
-    player_cache = await get_hypixel_player_cache(uuid, redis)
     if player_cache is not None:
         player_data, guild_id = player_cache
         hypixel_cache_valid = True
 
     if guild_id is None:
-        cached_guild_id = await redis.get(f"{HYPIXEL_PLAYER_GUILD_KEY}{uuid}")
+        cached_guild_id = await redis.get(HYPIXEL_PLAYER_GUILD.key(uuid))
         if cached_guild_id:
-            guild_id = (
-                cached_guild_id.decode("utf-8")
-                if isinstance(cached_guild_id, bytes)
-                else str(cached_guild_id)
-            )
+            guild_id = json_codec.to_str(cached_guild_id)
 
     if player_data is None:
-        player_data = await get_core_hypixel_data(uuid, http_client)
+        player_data = await get_core_hypixel_data(uuid, http_client, priority)
 
     if guild_id is not None:
-        guild_data = await get_hypixel_guild_cache(guild_id, redis)
+        guild_cache = await get_hypixel_guild_cache(guild_id, redis)
+        if guild_cache is not None and guild_cache.age < HYPIXEL_TTL:
+            guild_data = guild_cache.value
 
     if guild_data is None:
         if hypixel_cache_valid and guild_id is None:
             # Player is definitively known to be guildless from valid cache
             pass
+        elif guild_id is None and await is_known_missing(redis, guildless_key):
+            # the player cache expired, but they were guildless a moment ago
+            pass
         else:
             # Cache expired OR we know they might have a guild, need to fetch from API
             try:
-                guild_data = await get_guild_data(http_client, uuid)
+                guild_data = await get_guild_data(http_client, uuid, priority=priority)
             except exceptions.NotFound:
                 guild_data = None
+                await remember_missing(redis, guildless_key)
 
     hypixel_data = HypixelFullData(player=player_data, guild=guild_data)
 
@@ -115,24 +186,26 @@ async def get_hypixel_data(
 async def set_hypixel_player_cache(
     uuid: str, data: HypixelPlayer, guild_id: Optional[str], redis: Redis
 ) -> None:
-    cache_dict = {"data": data.model_dump(exclude={"source"}), "guild_id": guild_id}
+    cache_data = wrap(
+        {"player": data.model_dump(exclude={"source"}), "guild_id": guild_id}
+    )
     if guild_id is not None:
         pipe = redis.pipeline()
-        pipe.set(f"{HYPIXEL_PLAYER_KEY}{uuid}", json.dumps(cache_dict), ex=HYPIXEL_TTL)
-        pipe.set(f"{HYPIXEL_PLAYER_GUILD_KEY}{uuid}", guild_id, ex=HYPIXEL_TTL)
+        pipe.set(HYPIXEL_PLAYER.key(uuid), cache_data, ex=HYPIXEL_POLICY.hard_seconds)
+        pipe.set(HYPIXEL_PLAYER_GUILD.key(uuid), guild_id, ex=HYPIXEL_TTL)
         await pipe.execute()
     else:
         await redis.set(
-            f"{HYPIXEL_PLAYER_KEY}{uuid}", json.dumps(cache_dict), ex=HYPIXEL_TTL
+            HYPIXEL_PLAYER.key(uuid), cache_data, ex=HYPIXEL_POLICY.hard_seconds
         )
 
 
-async def get_hypixel_guild_cache(id: str, redis: Redis) -> HypixelGuild | None:
-    data = await redis.get(f"{HYPIXEL_GUILD_KEY}{id}")
-    if data is not None:
+async def get_hypixel_guild_cache(id: str, redis: Redis) -> Cached[HypixelGuild] | None:
+    cached = await read_entry(redis, HYPIXEL_GUILD, id)
+    if cached is not None:
+        payload, stored_at = cached
         try:
-            parsed_data = json.loads(data)
-            return HypixelGuild(source="cache", **parsed_data.get("data", {}))
+            return Cached(HypixelGuild(source="cache", **payload), stored_at)
         except Exception as e:
             print(f"Couldn't validate HypixelGuild from cache: {e}")
             return None
@@ -142,12 +215,32 @@ async def get_hypixel_guild_cache(id: str, redis: Redis) -> HypixelGuild | None:
 
 
 async def set_hypixel_guild_cache(id: str, data: HypixelGuild, redis: Redis) -> None:
-    cache_dict = {"data": data.model_dump(exclude={"source"})}
     pipe = redis.pipeline()
-    pipe.set(f"{HYPIXEL_GUILD_KEY}{id}", json.dumps(cache_dict), ex=HYPIXEL_TTL)
+    pipe.set(
+        HYPIXEL_GUILD.key(id),
+        wrap(data.model_dump(exclude={"source"})),
+        ex=HYPIXEL_POLICY.hard_seconds,
+    )
     for member in data.members:
-        pipe.set(f"{HYPIXEL_PLAYER_GUILD_KEY}{member.uuid}", id, ex=HYPIXEL_TTL)
+        pipe.set(HYPIXEL_PLAYER_GUILD.key(member.uuid), id, ex=HYPIXEL_TTL)
     await pipe.execute()
+    # members that were remembered as guildless have joined since
+    await forget_missing(
+        redis, *(("hypixel", "player_guild", member.uuid) for member in data.members)
+    )
+
+
+async def fetch_hypixel_guild(
+    id: str,
+    http_client: UpstreamClients,
+    redis: Redis,
+    priority: HypixelPriority = "fanout",
+) -> HypixelGuild | None:
+    print("source: hypixel api")
+    guild_data = await get_guild_data(http_client, id=id, priority=priority)
+    if guild_data is not None:
+        await set_hypixel_guild_cache(id, guild_data, redis)
+    return guild_data
 
 
 # params for fastapi
@@ -160,19 +253,20 @@ async def get_full_guild_members(
     id: str,
     session: AsyncSession,
     amount_to_load: int,
-    http_client: httpx.AsyncClient,
+    http_client: UpstreamClients,
     redis: Redis,
     offset: int = 0,
     background_tasks: BackgroundTasks | None = None,
 ) -> List[HypixelGuildMemberFull]:
-    guild_data = await get_hypixel_guild_cache(id, redis)
-    if guild_data is not None:
-        print("source: cache")
-    else:
-        print("source: hypixel api")
-        guild_data = await get_guild_data(http_client, id=id)
-        if guild_data is not None:
-            await set_hypixel_guild_cache(id, guild_data, redis)
+
+    guild_data = await serve_cached(
+        redis,
+        ("hypixel", "guild", id),
+        HYPIXEL_POLICY,
+        lambda: get_hypixel_guild_cache(id, redis),
+        lambda: fetch_hypixel_guild(id, http_client, redis),
+        as_stale=lambda guild: guild.model_copy(update={"source": "stale_cache"}),
+    )
 
     if guild_data is None:
         raise exceptions.ServiceError()
@@ -208,7 +302,7 @@ async def get_member(
     member: HypixelGuildMember,
     unsolved_uuids: list,
     resolved_uuids: list,
-    http_client: httpx.AsyncClient,
+    http_client: UpstreamClients,
     redis: Redis,
     session: AsyncSession,
     background_tasks: BackgroundTasks | None = None,
@@ -217,7 +311,7 @@ async def get_member(
         data = await get_minecraft_data(
             member.uuid, http_client, redis
         )  # this fetches live data
-        if background_tasks and data.source != "cache":
+        if background_tasks and data.source == "mojang_api":
             background_tasks.add_task(update_player_history, data, session)
         return HypixelGuildMemberFull(
             username=data.username,
@@ -255,6 +349,6 @@ async def add_hypixel_stats_to_db(hypixel_data: HypixelFullData):
 
 if __name__ == "__main__":
     hypixel_data = get_hypixel_data(
-        "3ff2e63ad63045e0b96f57cd0eae708d", httpx.AsyncClient(), Redis()
+        "3ff2e63ad63045e0b96f57cd0eae708d", UpstreamClients(), Redis()
     )
     print(hypixel_data)
@@ -0,0 +1,174 @@
+"""
+hypixel_quota.py
+
+Outbound scheduler for the Hypixel API key. Hypixel reports the key's quota on
+every response through the RateLimit-Limit/-Remaining/-Reset headers; we keep
+that in Redis so every worker shares one view of it, and take a unit of quota
+before each request.
+
+Lower priorities keep a reserve untouched so interactive player lookups can
+still go out when tracker polls and guild fan-out have used up most of the
+window. A request that can't get quota waits for the window to reset (up to a
+per-priority limit) instead of being sent and turning into a 429.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Literal
+
+import httpx
+
+import exceptions
+from cache_namespaces import HYPIXEL_QUOTA
+from redis_manager import get_redis
+from upstream_clients import UpstreamClients
+
+logger = logging.getLogger(__name__)
+
+HypixelPriority = Literal["interactive", "tracker", "fanout", "refresh"]
+
+HYPIXEL_QUOTA_KEY = HYPIXEL_QUOTA.key()
+
+# share of the window's limit each priority has to leave for higher priorities
+QUOTA_RESERVE: dict[str, float] = {
+    "interactive": 0.0,
+    "tracker": 0.1,
+    "fanout": 0.25,
+    # refresh-ahead warming, only ever uses quota nobody else needs
+    "refresh": 0.5,
+}
+
+# how long a request may queue for quota before giving up
+MAX_WAIT_SECONDS: dict[str, float] = {
+    "interactive": 2.0,
+    "tracker": 30.0,
+    "fanout": 10.0,
+    "refresh": 0.0,
+}
+
+QUOTA_POLL_SECONDS = 0.25
+
+# Hypixel's default key limit, only used until the first response tells us the real one
+DEFAULT_LIMIT = 300
+
+# returns {1, 0} when a unit of quota was taken, otherwise {0, ms_until_reset}
+ACQUIRE_SCRIPT = """
+local remaining = tonumber(redis.call("hget", KEYS[1], "remaining"))
+local limit = tonumber(redis.call("hget", KEYS[1], "limit")) or tonumber(ARGV[3])
+local reset_at = tonumber(redis.call("hget", KEYS[1], "reset_at")) or 0
+local now = tonumber(ARGV[1])
+
+if remaining == nil or now >= reset_at then
+    return {1, 0}
+end
+
+if remaining > math.floor(limit * tonumber(ARGV[2])) then
+    redis.call("hincrby", KEYS[1], "remaining", -1)
+    return {1, 0}
+end
+
+return {0, math.ceil((reset_at - now) * 1000)}
+"""
+
+# responses can arrive out of order, so within the same window keep the lowest count
+RECORD_SCRIPT = """
+local stored_reset = tonumber(redis.call("hget", KEYS[1], "reset_at"))
+local stored_remaining = tonumber(redis.call("hget", KEYS[1], "remaining"))
+local remaining = tonumber(ARGV[1])
+local reset_at = tonumber(ARGV[3])
+
+if stored_reset ~= nil and stored_remaining ~= nil and math.abs(stored_reset - reset_at) < 2 then
+    remaining = math.min(remaining, stored_remaining)
+    reset_at = math.max(reset_at, stored_reset)
+end
+
+redis.call("hset", KEYS[1], "remaining", remaining, "limit", ARGV[2], "reset_at", reset_at)
+redis.call("expire", KEYS[1], math.ceil(reset_at - tonumber(ARGV[4])) + 60)
+return remaining
+"""
+
+
+def _header_int(response: httpx.Response, name: str) -> int | None:
+    value = response.headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def acquire(priority: HypixelPriority) -> None:
+    """Waits until a unit of quota is available for this priority"""
+    redis = await get_redis()
+    deadline = time.monotonic() + MAX_WAIT_SECONDS[priority]
+
+    while True:
+        try:
+            allowed, wait_ms = await redis.eval(
+                ACQUIRE_SCRIPT,
+                1,
+                HYPIXEL_QUOTA_KEY,
+                time.time(),
+                QUOTA_RESERVE[priority],
+                DEFAULT_LIMIT,
+            )
+        except Exception as e:
+            # without Redis we can't coordinate, so don't hold requests back
+            logger.warning(f"Couldn't check Hypixel quota: {e}")
+            return
+
+        if int(allowed) == 1:
+            return
+
+        time_left = deadline - time.monotonic()
+        if time_left <= 0:
+            logger.warning(
+                f"Hypixel quota exhausted, dropping {priority} request "
+                f"({int(wait_ms) / 1000:.1f}s until reset)"
+            )
+            raise exceptions.UpstreamError()
+
+        await asyncio.sleep(min(int(wait_ms) / 1000, time_left, QUOTA_POLL_SECONDS))
+
+
+async def record_response(response: httpx.Response) -> None:
+    """Stores the quota Hypixel reported on a response"""
+    limit = _header_int(response, "RateLimit-Limit")
+    remaining = _header_int(response, "RateLimit-Remaining")
+    reset = _header_int(response, "RateLimit-Reset")
+
+    if response.status_code == 429:
+        remaining = 0
+        if reset is None:
+            reset = _header_int(response, "Retry-After")
+
+    if remaining is None or reset is None:
+        return
+
+    now = time.time()
+    try:
+        redis = await get_redis()
+        await redis.eval(
+            RECORD_SCRIPT,
+            1,
+            HYPIXEL_QUOTA_KEY,
+            remaining,
+            limit if limit is not None else DEFAULT_LIMIT,
+            now + reset,
+            now,
+        )
+    except Exception as e:
+        logger.warning(f"Couldn't store Hypixel quota: {e}")
+
+
+async def scheduled_get(
+    http_client: UpstreamClients,
+    priority: HypixelPriority,
+    url: str,
+    **kwargs,
+) -> httpx.Response:
+    """GET against api.hypixel.net once the key has quota for this priority"""
+    await acquire(priority)
+    response = await http_client.provider("hypixel").get(url, **kwargs)
+    await record_response(response)
+    return response
@@ -0,0 +1,35 @@
+"""
+json_codec.py
+
+JSON encoding and decoding backed by orjson. Cache values are written with
+cache_codec, which falls back to this for entries written as JSON.
+
+`loads` takes str as well as bytes, and `to_str` turns plain Redis string
+values (ids, ETags) into str whichever way the client was configured.
+"""
+
+from typing import Any
+
+import orjson
+from pydantic import BaseModel
+
+# stdlib json turned int dict keys into strings, keep doing that
+_DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+def dumps(obj: Any) -> bytes:
+    return orjson.dumps(obj, option=_DUMPS_OPTIONS)
+
+
+def loads(raw: str | bytes) -> Any:
+    return orjson.loads(raw)
+
+
+def dump_model(model: BaseModel, **kwargs) -> bytes:
+    """`model_dump` straight to JSON bytes, kwargs go to model_dump"""
+    return orjson.dumps(model.model_dump(**kwargs), option=_DUMPS_OPTIONS)
+
+
+def to_str(value: str | bytes | None) -> str | None:
+    """Plain Redis string values (ids, ETags) as str from either client"""
+    return value.decode("utf-8") if isinstance(value, bytes) else value
@@ -0,0 +1,110 @@
+"""
+loadtest/compare.py
+
+Diffs two reports written by loadtest/run.py, e.g. one from main and one from
+a branch:
+
+    uv run python loadtest/compare.py results/before.json results/after.json
+
+Latency changes above --threshold percent are marked, and with --fail the
+script exits with 1 if any route got slower than that.
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any
+
+
+def change(before: float, after: float) -> float | None:
+    if not before:
+        return None
+    return (after - before) / before * 100
+
+
+def format_change(before: float, after: float, threshold: float) -> tuple[str, bool]:
+    percent = change(before, after)
+    if percent is None:
+        return f"{after:>9}", False
+    regressed = percent > threshold
+    marker = " !" if regressed else "  "
+    return f"{after:>9} ({percent:+6.1f}%){marker}", regressed
+
+
+def compare_section(
+    title: str,
+    before: dict[str, Any],
+    after: dict[str, Any],
+    metric: str,
+    threshold: float,
+) -> bool:
+    print(f"\n{title} ({metric} ms)")
+    regressed = False
+    for name in sorted(before.keys() | after.keys()):
+        if name not in before or name not in after:
+            print(f"  {name}: only in {'after' if name in after else 'before'}")
+            continue
+        old = before[name]["latency_ms"][metric]
+        new = after[name]["latency_ms"][metric]
+        text, slower = format_change(old, new, threshold)
+        regressed |= slower
+        print(f"  {name:<72} {old:>9} -> {text}")
+    return regressed
+
+
+def compare(
+    before: dict[str, Any], after: dict[str, Any], metrics: list[str], threshold: float
+) -> bool:
+    print(f"before: {before['meta']['commit']} at {before['meta']['started_at']}")
+    print(f"after:  {after['meta']['commit']} at {after['meta']['started_at']}")
+    if before["meta"]["target_rps"] != after["meta"]["target_rps"]:
+        print("warning: the runs used a different --rps")
+
+    old, new = before["overall"], after["overall"]
+    print(f"\nthroughput: {old['throughput_rps']} -> {new['throughput_rps']} req/s")
+    print(f"statuses:   {old['statuses']} -> {new['statuses']}")
+
+    regressed = False
+    for metric in metrics:
+        regressed |= compare_section(
+            "routes", before["routes"], after["routes"], metric, threshold
+        )
+        regressed |= compare_section(
+            "scenarios", before["scenarios"], after["scenarios"], metric, threshold
+        )
+
+    print("\nruntime")
+    for key in sorted(before["runtime"].keys() | after["runtime"].keys()):
+        print(
+            f"  {key:<32} {before['runtime'].get(key)} -> {after['runtime'].get(key)}"
+        )
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two load test reports")
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    parser.add_argument(
+        "--metric",
+        action="append",
+        choices=["p50", "p95", "p99", "max"],
+        help="latency percentiles to compare (repeatable), defaults to p50 and p99",
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="percent slower to flag"
+    )
+    parser.add_argument(
+        "--fail", action="store_true", help="exit with 1 when a route regressed"
+    )
+    args = parser.parse_args()
+
+    regressed = compare(
+        json.loads(args.before.read_text()),
+        json.loads(args.after.read_text()),
+        args.metric or ["p50", "p99"],
+        args.threshold,
+    )
+    if regressed and args.fail:
+        sys.exit(1)
@@ -0,0 +1,146 @@
+"""
+loadtest/rate_limit_bench.py
+
+Microbenchmark of the per-request rate limiting overhead, without the rest
+of the app:
+
+    uv run python loadtest/rate_limit_bench.py --requests 200000
+
+"compiled" is what the middleware does now: rate_limiter.check_request with
+the policy compiled from a few routes, plus the (skipped) RateLimit
+dependency. "legacy" replays the previous flow: the IP parsed with
+ip_network by the middleware and again by the dependency, three check_limit
+calls for the global tiers and a fourth with the route's key. Both use the
+same in-memory bucket store, so the difference is the evaluation itself.
+"""
+
+import argparse
+import asyncio
+import ipaddress
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi import Depends, FastAPI, Request  # noqa: E402
+
+import rate_limiter  # noqa: E402
+from rate_limiter import RateLimit, TokenBucketLimiter  # noqa: E402
+
+ROUTE_LIMIT = RateLimit(60, 60)
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/", dependencies=[Depends(RateLimit(60, 60))])
+    async def root():
+        return {}
+
+    @app.get("/mojang/{search_term}", dependencies=[Depends(ROUTE_LIMIT)])
+    async def mojang(search_term: str):
+        return {}
+
+    @app.get("/hypixel/{uuid}", dependencies=[Depends(RateLimit(30, 60))])
+    async def hypixel(uuid: str):
+        return {}
+
+    @app.get("/hypixel/guild/{id}", dependencies=[Depends(RateLimit(30, 60))])
+    async def guild(id: str):
+        return {}
+
+    return app
+
+
+def legacy_normalize_ip(ip: str) -> str:
+    try:
+        addr = ipaddress.ip_address(ip)
+        if isinstance(addr, ipaddress.IPv6Address):
+            network = ipaddress.ip_network(f"{ip}/64", strict=False)
+            return str(network.network_address)
+    except ValueError:
+        pass
+    return ip
+
+
+def legacy_client_ip(request: Request) -> str:
+    forwarded = request.headers.get("x-forwarded-for")
+    if forwarded:
+        return legacy_normalize_ip(forwarded.split(",")[-1].strip())
+    raw = request.client.host if request.client else "127.0.0.1"
+    return legacy_normalize_ip(raw)
+
+
+def legacy(request: Request, limiter: TokenBucketLimiter) -> None:
+    # global_rate_limit_middleware
+    ip = legacy_client_ip(request)
+    limiter.check_limit(f"{ip}:global_1m", 180, 60)
+    limiter.check_limit(f"{ip}:global_10m", 1000, 600)
+    limiter.check_limit(f"{ip}:global_1d", 10000, 86400)
+    # RateLimit dependency
+    ip = legacy_client_ip(request)
+    limiter.check_limit(f"{ip}:/mojang/{{search_term}}", 60, 60)
+
+
+async def compiled(request: Request) -> None:
+    await rate_limiter.check_request(request)
+    await ROUTE_LIMIT(request)
+
+
+def make_scope(app: FastAPI, ip: str, path: str) -> dict:
+    return {
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "headers": [(b"x-forwarded-for", f"10.0.0.1, {ip}".encode())],
+        "client": ("10.0.0.1", 1234),
+        "app": app,
+        "query_string": b"",
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    random.seed(args.seed)
+    app = build_app()
+    app.state.rate_limit_policy = rate_limiter.compile_policy(app.routes)
+
+    # a mix of IPv4 and IPv6 visitors, each making several requests
+    visitors = [
+        (
+            f"203.0.{i >> 8 & 255}.{i & 255}"
+            if i % 2
+            else f"2001:db8:{i:x}::{random.randrange(1 << 16):x}"
+        )
+        for i in range(args.clients)
+    ]
+    ips = [random.choice(visitors) for _ in range(args.requests)]
+
+    # fresh limiters, with limits high enough that nothing is rejected
+    legacy_limiter = TokenBucketLimiter()
+    rate_limiter.limiter = TokenBucketLimiter()
+
+    for name in ["legacy", "compiled"] * 2:
+        # each run gets its own requests, a Request's state is per request
+        requests = [
+            Request(make_scope(app, ip, f"/mojang/player{n % 97}"))
+            for n, ip in enumerate(ips)
+        ]
+        start = time.perf_counter()
+        if name == "legacy":
+            for request in requests:
+                legacy(request, legacy_limiter)
+        else:
+            for request in requests:
+                await compiled(request)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<9} {elapsed / args.requests * 1e6:6.2f} us/request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rate limiter microbenchmark")
+    parser.add_argument("--requests", type=int, default=100_000)
+    parser.add_argument("--clients", type=int, default=2_000)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
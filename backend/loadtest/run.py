@@ -0,0 +1,448 @@
+"""
+loadtest/run.py
+
+Open-loop load generator for the API. Virtual users arrive at a steady
+average rate (Poisson arrivals, so the request rate does not drop when the
+API slows down) and each one walks through a scenario, i.e. the sequence of
+calls a page of the frontend makes:
+
+    uv run python loadtest/run.py --rps 20 --duration 60
+
+Every route in main.py is covered by at least one scenario. While the run is
+going /v1/status/runtime is sampled for event-loop lag and pool usage, and at
+the end a JSON report is written to loadtest/results, which
+loadtest/compare.py can diff against a report from another commit.
+
+The API is meant to be pointed at fake_upstream (UPSTREAM_OVERRIDE_URL), so
+made-up usernames resolve and no real quota is spent.
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import subprocess
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+LOADTEST_DIR = Path(__file__).parent
+RESULTS_DIR = LOADTEST_DIR / "results"
+
+PERCENTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies: list[float]) -> dict[str, float]:
+    ordered = sorted(latencies)
+    summary = {
+        name: round(percentile(ordered, fraction) * 1000, 2)
+        for name, fraction in PERCENTILES.items()
+    }
+    summary["max"] = round(ordered[-1] * 1000, 2) if ordered else 0.0
+    return summary
+
+
+@dataclass
+class Samples:
+    latencies: list[float] = field(default_factory=list)
+    statuses: Counter[str] = field(default_factory=Counter)
+
+    def report(self, elapsed: float) -> dict[str, Any]:
+        return {
+            "count": len(self.latencies),
+            "throughput_rps": round(len(self.latencies) / elapsed, 2),
+            "latency_ms": summarize(self.latencies),
+            "statuses": dict(sorted(self.statuses.items())),
+        }
+
+
+class Recorder:
+    def __init__(self):
+        self.routes: defaultdict[str, Samples] = defaultdict(Samples)
+        self.scenarios: defaultdict[str, Samples] = defaultdict(Samples)
+        self.runtime: list[dict[str, Any]] = []
+        self.dropped = 0
+
+    def record(self, route: str, elapsed: float, status: str) -> None:
+        samples = self.routes[route]
+        samples.latencies.append(elapsed)
+        samples.statuses[status] += 1
+
+
+class VirtualUser:
+    """One visitor: its own client IP, so the per-IP limits apply per user"""
+
+    def __init__(
+        self, client: httpx.AsyncClient, recorder: Recorder, ip: str, args: Any
+    ):
+        self.client = client
+        self.recorder = recorder
+        self.headers = {"X-Forwarded-For": ip}
+        self.args = args
+
+    async def get(self, route: str, path: str, **params) -> Any:
+        """GETs `path`, recording it under the route template `route`"""
+        start = time.perf_counter()
+        try:
+            response = await self.client.get(path, params=params, headers=self.headers)
+        except httpx.HTTPError as e:
+            self.recorder.record(route, time.perf_counter() - start, type(e).__name__)
+            return None
+        self.recorder.record(
+            route, time.perf_counter() - start, str(response.status_code)
+        )
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    async def stream(self, route: str, path: str, hold: float) -> None:
+        """
+        Opens an SSE connection and keeps it for `hold` seconds. The recorded
+        latency is the time until the response headers arrived.
+        """
+        start = time.perf_counter()
+        try:
+            async with self.client.stream(
+                "GET", path, headers=self.headers, timeout=hold + 30
+            ) as response:
+                self.recorder.record(
+                    route, time.perf_counter() - start, str(response.status_code)
+                )
+                if response.status_code != 200:
+                    return
+                try:
+                    async with asyncio.timeout(hold):
+                        async for _ in response.aiter_bytes():
+                            pass
+                except TimeoutError:
+                    pass
+        except httpx.HTTPError as e:
+            self.recorder.record(route, time.perf_counter() - start, type(e).__name__)
+
+
+class Players:
+    """
+    Made-up player names with a skewed popularity, so that like in production
+    a few players get most of the lookups and the caches see repeat hits.
+    """
+
+    def __init__(self, count: int, rng: random.Random):
+        self.names = [f"LoadTest{i}" for i in range(count)]
+        self.rng = rng
+
+    def pick(self) -> str:
+        index = int(self.rng.paretovariate(1.2)) - 1
+        return self.names[index % len(self.names)]
+
+
+async def resolve_uuid(user: VirtualUser, username: str) -> str | None:
+    profile = await user.get(
+        "/v1/players/mojang/{identifier}", f"/v1/players/mojang/{username}"
+    )
+    return profile["uuid"] if profile else None
+
+
+async def player_page(user: VirtualUser, username: str) -> None:
+    uuid = await resolve_uuid(user, username)
+    if uuid is None:
+        return
+    await asyncio.gather(
+        user.get("/v1/players/hypixel/{uuid}", f"/v1/players/hypixel/{uuid}"),
+        user.get("/v1/players/capes/{uuid}", f"/v1/players/capes/{uuid}"),
+        user.get("/v1/players/status/{uuid}", f"/v1/players/status/{uuid}"),
+    )
+
+
+async def hypixel_guild_page(user: VirtualUser, username: str) -> None:
+    uuid = await resolve_uuid(user, username)
+    if uuid is None:
+        return
+    data = await user.get("/v1/players/hypixel/{uuid}", f"/v1/players/hypixel/{uuid}")
+    if not data or not data.get("guild"):
+        return
+    guild_id = data["guild"]["id"]
+    for offset in (0, 50):
+        await user.get(
+            "/v1/hypixel/guilds/{id}",
+            f"/v1/hypixel/guilds/{guild_id}",
+            limit=50,
+            offset=offset,
+        )
+
+
+async def wynncraft_page(user: VirtualUser, username: str) -> None:
+    uuid = await resolve_uuid(user, username)
+    if uuid is None:
+        return
+    player, _ = await asyncio.gather(
+        user.get("/v1/players/wynncraft/{uuid}", f"/v1/players/wynncraft/{uuid}"),
+        user.get("/v1/wynncraft/max_content", "/v1/wynncraft/max_content"),
+    )
+    if not player:
+        return
+    if player.get("guild_prefix"):
+        await user.get(
+            "/v1/wynncraft/guilds/{prefix}",
+            f"/v1/wynncraft/guilds/{player['guild_prefix']}",
+        )
+    for character in player.get("characters", [])[:2]:
+        await user.get(
+            "/v1/players/wynncraft/{uuid}/characters/{character_uuid}/ability-tree",
+            f"/v1/players/wynncraft/{uuid}/characters/"
+            f"{character['character_uuid']}/ability-tree",
+            **{"class": character["character_class"].lower()},
+        )
+
+
+async def other_servers_page(user: VirtualUser, username: str) -> None:
+    uuid = await resolve_uuid(user, username)
+    if uuid is None:
+        return
+    await asyncio.gather(
+        user.get("/v1/players/donutsmp/{username}", f"/v1/players/donutsmp/{username}"),
+        user.get("/v1/players/mccisland/{uuid}", f"/v1/players/mccisland/{uuid}"),
+        user.get(
+            "/v1/metrics/{metric_key}/distribution/{player_uuid}",
+            f"/v1/metrics/{user.args.metric_key}/distribution/{uuid}",
+        ),
+    )
+
+
+async def tracker(user: VirtualUser, username: str) -> None:
+    uuid = await resolve_uuid(user, username)
+    if uuid is None:
+        return
+    await user.stream(
+        "/v1/tracker/{uuid}/status",
+        f"/v1/tracker/{uuid}/status",
+        user.args.sse_hold,
+    )
+
+
+async def general(user: VirtualUser, username: str) -> None:
+    await user.get("/", "/")
+    await user.get("/healthz", "/healthz")
+    await user.get("/v1/status/upstreams", "/v1/status/upstreams")
+
+
+Scenario = Callable[[VirtualUser, str], Awaitable[None]]
+
+# name: (scenario, weight, requests it usually makes)
+SCENARIOS: dict[str, tuple[Scenario, float, int]] = {
+    "player_page": (player_page, 0.4, 4),
+    "hypixel_guild_page": (hypixel_guild_page, 0.1, 4),
+    "wynncraft_page": (wynncraft_page, 0.2, 6),
+    "other_servers_page": (other_servers_page, 0.2, 4),
+    "tracker": (tracker, 0.05, 2),
+    "general": (general, 0.05, 3),
+}
+
+
+async def sample_runtime(
+    client: httpx.AsyncClient, recorder: Recorder, interval: float
+) -> None:
+    # its own IP, so sampling never counts against the virtual users
+    headers = {"X-Forwarded-For": "10.255.255.254"}
+    start = time.monotonic()
+    while True:
+        try:
+            response = await client.get("/v1/status/runtime", headers=headers)
+            if response.status_code == 200:
+                sample = response.json()
+                sample["at"] = round(time.monotonic() - start, 1)
+                recorder.runtime.append(sample)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+
+def summarize_runtime(samples: list[dict[str, Any]]) -> dict[str, Any]:
+    if not samples:
+        return {}
+
+    def peak(*path: str) -> float:
+        values = []
+        for sample in samples:
+            value: Any = sample
+            for part in path:
+                value = value.get(part) if value else None
+            if value is not None:
+                values.append(value)
+        return max(values, default=0)
+
+    return {
+        "samples": len(samples),
+        "event_loop_lag_p99_ms_max": peak("event_loop_lag", "p99_ms"),
+        "event_loop_lag_max_ms": peak("event_loop_lag", "max_ms"),
+        "tasks_max": peak("tasks"),
+        "database_checked_out_max": peak("database_pool", "checked_out"),
+        "database_saturation_max": peak("database_pool", "saturation"),
+        "redis_in_use_max": peak("redis_pool", "in_use"),
+        "redis_created_max": peak("redis_pool", "created"),
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=LOADTEST_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    rng = random.Random(args.seed)
+    players = Players(args.players, rng)
+    scenarios = {name: SCENARIOS[name] for name in args.scenario or SCENARIOS}
+    names = list(scenarios)
+    weights = [scenarios[name][1] for name in names]
+
+    # --rps is in requests, arrivals are in visits
+    requests_per_visit = sum(
+        weight * scenarios[name][2] for name, weight in zip(names, weights)
+    ) / sum(weights)
+    arrival_rate = args.rps / requests_per_visit
+
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.max_in_flight * 2)
+    timeout = httpx.Timeout(args.timeout)
+    async with httpx.AsyncClient(
+        base_url=args.base_url, limits=limits, timeout=timeout
+    ) as client:
+        sampler = asyncio.create_task(
+            sample_runtime(client, recorder, args.sample_interval)
+        )
+        in_flight: set[asyncio.Task] = set()
+
+        async def visit(name: str, user: VirtualUser, username: str) -> None:
+            start = time.perf_counter()
+            await scenarios[name][0](user, username)
+            recorder.scenarios[name].latencies.append(time.perf_counter() - start)
+            recorder.scenarios[name].statuses["completed"] += 1
+
+        started = time.perf_counter()
+        next_arrival = started
+        visitors = 0
+        while next_arrival - started < args.duration:
+            await asyncio.sleep(max(0.0, next_arrival - time.perf_counter()))
+            next_arrival += rng.expovariate(arrival_rate)
+            if len(in_flight) >= args.max_in_flight:
+                # the API can't keep up, count it rather than queueing forever
+                recorder.dropped += 1
+                continue
+            visitors += 1
+            ip = f"10.{(visitors >> 16) & 255}.{(visitors >> 8) & 255}.{visitors & 255}"
+            user = VirtualUser(client, recorder, ip, args)
+            name = rng.choices(names, weights)[0]
+            task = asyncio.create_task(visit(name, user, players.pick()))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        if in_flight:
+            await asyncio.wait(in_flight, timeout=args.timeout + args.sse_hold)
+        elapsed = time.perf_counter() - started
+        sampler.cancel()
+
+    all_requests = Samples()
+    for samples in recorder.routes.values():
+        all_requests.latencies.extend(samples.latencies)
+        all_requests.statuses.update(samples.statuses)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "base_url": args.base_url,
+            "target_rps": args.rps,
+            "duration_seconds": args.duration,
+            "elapsed_seconds": round(elapsed, 2),
+            "scenarios": names,
+            "players": args.players,
+            "seed": args.seed,
+            "visitors": visitors,
+            "dropped_visitors": recorder.dropped,
+        },
+        "overall": all_requests.report(elapsed),
+        "routes": {
+            route: samples.report(elapsed)
+            for route, samples in sorted(recorder.routes.items())
+        },
+        "scenarios": {
+            name: samples.report(elapsed)
+            for name, samples in sorted(recorder.scenarios.items())
+        },
+        "runtime": summarize_runtime(recorder.runtime),
+        "runtime_samples": recorder.runtime,
+    }
+
+
+def print_report(report: dict[str, Any]) -> None:
+    overall = report["overall"]
+    print(
+        f"{overall['count']} requests, {overall['throughput_rps']} req/s, "
+        f"statuses {overall['statuses']}"
+    )
+    print(f"{'route':<72} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for route, stats in report["routes"].items():
+        latency = stats["latency_ms"]
+        print(
+            f"{route:<72} {stats['count']:>6} {latency['p50']:>8} "
+            f"{latency['p95']:>8} {latency['p99']:>8}"
+        )
+    for key, value in report["runtime"].items():
+        print(f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the API")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--rps", type=float, default=10, help="target requests/s")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="only run these scenarios (repeatable), defaults to the full mix",
+    )
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-in-flight", type=int, default=500)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument(
+        "--sse-hold", type=float, default=10, help="seconds to keep a tracker open"
+    )
+    parser.add_argument("--sample-interval", type=float, default=3)
+    parser.add_argument("--metric-key", default="wynncraft_raids_completed")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="report path, defaults to loadtest/results/<time>-<commit>.json",
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+
+    output = args.output
+    if output is None:
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = RESULTS_DIR / f"{stamp}-{report['meta']['commit'] or 'nogit'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Saved {output}")
@@ -0,0 +1,205 @@
+"""
+local_cache.py
+
+Small in-process cache (L1) in front of Redis for the few hot keys that hardly
+ever change, like the ability tree structures, the capes.me catalog and the
+Wynncraft max content. A hit skips the Redis round trip, the JSON decode and
+the pydantic validation.
+
+Each LocalCache is a namespace with its own TTL and a maximum number of
+entries, evicted least recently used first. Values are the already validated
+objects and are shared between requests, so callers must copy before
+changing them.
+
+Every worker has its own L1, so whoever rewrites the Redis entry calls
+`invalidate`, which drops the entry locally and publishes the key on
+INVALIDATION_CHANNEL; `listen_for_invalidations` (started in the lifespan)
+drops it in the other workers. The TTL bounds how long a worker can miss
+such a message. After a 304 the payload hasn't changed, so `touch` only moves
+the entry's `stored_at` everywhere instead of making every worker reload it.
+"""
+
+import asyncio
+import dataclasses
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, TypeVar
+
+from pydantic import BaseModel
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+import json_codec
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+INVALIDATION_CHANNEL = "aspexis:local_cache:invalidate"
+RESUBSCRIBE_DELAY_SECONDS = 5
+
+
+class LocalCacheStats(BaseModel):
+    name: str
+    entries: int
+    max_entries: int
+    ttl_seconds: float
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+
+
+class LocalCache:
+    def __init__(self, name: str, ttl_seconds: float, max_entries: int):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (expires_at, value), oldest use first
+        self.entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str) -> Any | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: Any) -> None:
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, key: str | None = None) -> None:
+        """Drops `key`, or every entry when no key is given"""
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+        self.invalidations += 1
+
+    def touch(self, key: str, stored_at: float) -> None:
+        """
+        Keeps `key`'s value but dates it `stored_at` and restarts its TTL.
+        Only for values that are cache_envelope.Cached, others are dropped.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        expires_at, value = entry
+        if expires_at <= time.monotonic() or not hasattr(value, "stored_at"):
+            self.discard(key)
+            return
+        if value.stored_at < stored_at:
+            value = dataclasses.replace(value, stored_at=stored_at)
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, value)
+
+    async def get_or_load(
+        self, key: str, load: Callable[[], Awaitable[T | None]]
+    ) -> T | None:
+        """Read-through: on a miss `load` reads Redis, a None result isn't kept"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = await load()
+        if value is not None:
+            self.set(key, value)
+        return value
+
+    def stats(self) -> LocalCacheStats:
+        return LocalCacheStats(
+            name=self.name,
+            entries=len(self.entries),
+            max_entries=self.max_entries,
+            ttl_seconds=self.ttl_seconds,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            invalidations=self.invalidations,
+        )
+
+
+_caches: dict[str, LocalCache] = {}
+
+
+def local_cache(name: str, ttl_seconds: float, max_entries: int) -> LocalCache:
+    """Creates the namespace `name`, called once at import by the owning module"""
+    if name in _caches:
+        raise ValueError(f"local cache {name} already exists")
+    cache = LocalCache(name, ttl_seconds, max_entries)
+    _caches[name] = cache
+    return cache
+
+
+def local_cache_stats() -> list[LocalCacheStats]:
+    return [cache.stats() for cache in _caches.values()]
+
+
+async def invalidate(redis: Redis, cache: LocalCache, key: str | None = None) -> None:
+    """Drops `key` from `cache` in this worker and asks the others to do the same"""
+    cache.discard(key)
+    try:
+        await redis.publish(
+            INVALIDATION_CHANNEL, json_codec.dumps({"cache": cache.name, "key": key})
+        )
+    except RedisError as e:
+        # the other workers catch up once their entry's TTL runs out
+        logger.warning(f"Could not publish invalidation of {cache.name}: {e}")
+
+
+async def touch(redis: Redis, cache: LocalCache, key: str, stored_at: float) -> None:
+    """`LocalCache.touch` in this worker and the others, see touch_conditional"""
+    cache.touch(key, stored_at)
+    try:
+        await redis.publish(
+            INVALIDATION_CHANNEL,
+            json_codec.dumps({"cache": cache.name, "key": key, "touch": stored_at}),
+        )
+    except RedisError as e:
+        # the other workers refresh their entry once its TTL runs out
+        logger.warning(f"Could not publish touch of {cache.name}: {e}")
+
+
+def _apply_invalidation(raw: str | bytes) -> None:
+    try:
+        message = json_codec.loads(raw)
+        cache = _caches.get(message["cache"])
+    except (ValueError, TypeError, KeyError):
+        logger.warning(f"Ignoring malformed local cache invalidation: {raw!r}")
+        return
+    if cache is None:
+        return
+    if message.get("touch") is not None and message.get("key") is not None:
+        cache.touch(message["key"], message["touch"])
+    else:
+        cache.discard(message.get("key"))
+
+
+async def listen_for_invalidations(redis: Redis) -> None:
+    """Runs for the lifetime of the app, resubscribing if Redis goes away"""
+    while True:
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    _apply_invalidation(message["data"])
+        except RedisError as e:
+            logger.warning(f"Local cache invalidation listener lost Redis: {e}")
+            # anything published meanwhile was missed
+            for cache in _caches.values():
+                cache.discard()
+        finally:
+            await pubsub.aclose()
+        await asyncio.sleep(RESUBSCRIBE_DELAY_SECONDS)
@@ -3,19 +3,21 @@ from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from wynncraft_api import (
-    get_wynncraft_player_data,
     get_wynncraft_guild_data,
     WynncraftPlayerSummary,
     WynncraftGuildInfo,
     add_wynncraft_stats_to_db,
 )
 from online_status import get_status, PlayerStatus
+from wynncraft_manager import get_wynncraft_data
 from dotenv import load_dotenv
 import os
 import logging
 from minecraft_api import MojangData
-from donut_api import get_donut_stats, DonutPlayerStats, add_donut_stats_to_db
-from mcci_api import MCCIPlayer, get_mcci_data
+from donut_api import DonutPlayerStats, add_donut_stats_to_db
+from donut_manager import get_donut_data
+from mcci_api import MCCIPlayer
+from mcci_manager import MCCIPlayerParams, get_mcci_player
 from metrics_manager import get_stats, HistogramData
 from db import get_db
 
@@ -35,7 +37,7 @@ from minecraft_manager import get_minecraft_data, update_player_history
 from typing import List, Annotated, Literal, Any
 import time
 import uuid
-from telemetry_queue import TelemetryEvent, enqueue, run_worker
+from telemetry_queue import TelemetryEvent, drain, enqueue, run_worker
 from capes import get_capes_for_user, UserCapeData
 from wynncraft_ability_tree import get_ability_tree, AbilityTreePage
 from wynncraft_content_max import (
@@ -44,15 +46,26 @@ from wynncraft_content_max import (
     get_wynncraft_content_max,
 )
 
-from fastapi.responses import JSONResponse
-from rate_limiter import limiter, RateLimit, get_client_ip
+from fastapi.responses import JSONResponse, ORJSONResponse
+from rate_limiter import (
+    check_request,
+    compile_policy,
+    limiter,
+    RateLimit,
+    settle_request,
+)
+from request_cost import track_request_cost
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from contextlib import asynccontextmanager
 import datetime
-import httpx
+from upstream_clients import UpstreamClients, ProviderStats
+from cache_envelope import track_stale_resources
+from runtime_stats import RuntimeStats, monitor_event_loop_lag, runtime_stats
+from local_cache import listen_for_invalidations
 from utils import normalize_uuid
 from redis_manager import get_redis
+import popularity
 from redis.asyncio import Redis
 
 
@@ -88,17 +101,15 @@ COMMON_ERROR_RESPONSES: dict[int | str, dict[str, Any]] = {
 
 # client management
 
-client: httpx.AsyncClient | None = None
+client: UpstreamClients | None = None
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     global client
-    client = httpx.AsyncClient(
-        timeout=httpx.Timeout(10.0, connect=5.0),
-        headers=BROWSER_HEADERS,
-    )
+    client = UpstreamClients(headers=BROWSER_HEADERS)
+    app.state.rate_limit_policy = compile_policy(app.routes)
     scheduler = AsyncIOScheduler()
     scheduler.add_job(
         update_content_max,
@@ -112,16 +123,35 @@ async def lifespan(app: FastAPI):
         trigger="interval",
         minutes=10,
     )
+    scheduler.add_job(
+        popularity.flush_popularity,
+        trigger="interval",
+        seconds=popularity.FLUSH_INTERVAL_SECONDS,
+        args=[await get_redis()],
+    )
+    scheduler.add_job(
+        popularity.refresh_ahead,
+        trigger="interval",
+        seconds=popularity.REFRESH_INTERVAL_SECONDS,
+        args=[await get_client(), await get_redis()],
+    )
     scheduler.start()
     telemetry_worker = asyncio.create_task(run_worker())
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    local_cache_listener = asyncio.create_task(
+        listen_for_invalidations(await get_redis())
+    )
     yield
     # Shutdown
-    telemetry_worker.cancel()
+    local_cache_listener.cancel()
+    lag_monitor.cancel()
+    await drain(telemetry_worker)
     scheduler.shutdown()
     await client.aclose()
 
 
-async def get_client():
+async def get_client() -> UpstreamClients:
+    assert client is not None, "Upstream clients are not initialized"
     return client
 
 
@@ -138,6 +168,7 @@ app = FastAPI(
         "name": "MIT",
     },
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 
@@ -155,36 +186,37 @@ app.add_middleware(
 )
 
 
+@app.middleware("http")
+async def stale_cache_middleware(request: Request, call_next):
+    # lists the (provider, resource) pairs served from a stale cache entry
+    stale = track_stale_resources()
+    response = await call_next(request)
+    if stale:
+        response.headers["X-Cache-Stale"] = ", ".join(sorted(stale))
+    return response
+
+
 @app.middleware("http")
 async def global_rate_limit_middleware(request: Request, call_next):
     if request.url.path == "/healthz":
         return await call_next(request)
 
-    ip = get_client_ip(request)
     _429 = {"description": "Too Many Requests", "detail": "Rate limit exceeded"}
 
-    # 180/minute — broad per-minute ceiling for every IP
-    allowed, retry_after = limiter.check_limit(f"{ip}:global_1m", 180, 60)
-    if not allowed:
-        return JSONResponse(
-            status_code=429, content=_429, headers={"Retry-After": str(retry_after)}
-        )
-
-    # 1000/10 minutes
-    allowed, retry_after = limiter.check_limit(f"{ip}:global_10m", 1000, 600)
-    if not allowed:
-        return JSONResponse(
-            status_code=429, content=_429, headers={"Retry-After": str(retry_after)}
-        )
+    # adds up the upstream calls, cache misses and CPU time of the request
+    cost = track_request_cost()
 
-    # 10000/day
-    allowed, retry_after = limiter.check_limit(f"{ip}:global_1d", 10000, 86400)
+    # the global limits and the route's own RateLimit, in one check
+    allowed, retry_after = await check_request(request)
     if not allowed:
         return JSONResponse(
             status_code=429, content=_429, headers={"Retry-After": str(retry_after)}
         )
 
-    return await call_next(request)
+    try:
+        return await call_next(request)
+    finally:
+        await settle_request(request, cost)
 
 
 @app.middleware("http")
@@ -245,6 +277,32 @@ def health_check():
     return {"status": "ok"}
 
 
+@app.get(
+    "/v1/status/upstreams",
+    tags=["General"],
+    response_model=List[ProviderStats],
+    name="Upstream Provider Stats",
+    description="Connection pool occupancy and circuit breaker state for each upstream provider. Rate limit: 30/min.",
+    dependencies=[Depends(RateLimit(30, 60))],
+)
+async def get_upstream_stats(
+    http_client: UpstreamClients = Depends(get_client),
+) -> List[ProviderStats]:
+    return http_client.stats()
+
+
+@app.get(
+    "/v1/status/runtime",
+    tags=["General"],
+    response_model=RuntimeStats,
+    name="Runtime Stats",
+    description="Event loop lag and database/Redis connection pool usage of this worker. Rate limit: 30/min.",
+    dependencies=[Depends(RateLimit(30, 60))],
+)
+async def get_runtime_stats() -> RuntimeStats:
+    return runtime_stats()
+
+
 @app.get(
     "/v1/players/mojang/{identifier}",
     responses=COMMON_ERROR_RESPONSES,
@@ -260,14 +318,15 @@ async def get_profile(
     identifier,
     background_tasks: BackgroundTasks,
     allow_stale: bool = False,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
     redis: Redis = Depends(get_redis),
     session: AsyncSession = Depends(get_db),
 ) -> MojangData:
     data = await get_minecraft_data(
         identifier, http_client, redis, allow_stale=allow_stale
     )
-    if data.source != "cache":
+    popularity.record("minecraft", data.uuid)
+    if data.source == "mojang_api":
         background_tasks.add_task(update_player_history, data, session)
     return data
 
@@ -283,7 +342,7 @@ async def get_profile(
 )
 async def get_capes(
     uuid: str,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
     redis: Redis = Depends(get_redis),
 ) -> List[UserCapeData]:
     uuid = normalize_uuid(uuid)
@@ -303,11 +362,14 @@ async def get_hypixel(
     request: Request,
     uuid: str,
     background_tasks: BackgroundTasks,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
     redis: Redis = Depends(get_redis),
 ) -> HypixelFullData:
     uuid = normalize_uuid(uuid)
     data = await get_hypixel_data(uuid, http_client, redis)
+    popularity.record("hypixel", uuid)
+    if data.guild is not None and data.guild.id:
+        popularity.record("hypixel_guild", data.guild.id)
     background_tasks.add_task(add_hypixel_stats_to_db, data)
     return data
 
@@ -318,17 +380,18 @@ async def get_hypixel(
     responses=COMMON_ERROR_RESPONSES,
     response_model=List[HypixelGuildMemberFull],
     name="Get Hypixel Guild Members",
-    description="Retrieves a list of members for a specific Hypixel guild with pagination. Rate limit: 30/min.",
-    dependencies=[Depends(RateLimit(30, 60))],
+    description="Retrieves a list of members for a specific Hypixel guild with pagination. Rate limit: 30/min, weighted by the upstream lookups a request needs, at most 2 requests in progress per client.",
+    dependencies=[Depends(RateLimit(30, 60, weighted=True, max_concurrent=2))],
 )
 async def get_guild(
     id,
     query_params: Annotated[HypixelGuildMemberParams, Query()],
     background_tasks: BackgroundTasks,
     session: AsyncSession = Depends(get_db),
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
     redis: Redis = Depends(get_redis),
 ) -> List[HypixelGuildMemberFull]:
+    popularity.record("hypixel_guild", id)
     return await get_full_guild_members(
         id,
         session,
@@ -351,10 +414,11 @@ async def get_guild(
 )
 async def get_player_status(
     uuid: str,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
+    redis: Redis = Depends(get_redis),
 ) -> PlayerStatus:
     uuid = normalize_uuid(uuid)
-    return await get_status(uuid, http_client)
+    return await get_status(uuid, http_client, redis)
 
 
 # wynncraft endpoints
@@ -372,10 +436,12 @@ async def get_player_status(
 async def get_wynncraft(
     uuid: str,
     background_tasks: BackgroundTasks,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
+    redis: Redis = Depends(get_redis),
 ) -> WynncraftPlayerSummary:
     uuid = normalize_uuid(uuid)
-    player_data = await get_wynncraft_player_data(uuid, http_client)
+    player_data = await get_wynncraft_data(uuid, http_client, redis)
+    popularity.record("wynncraft", uuid)
     background_tasks.add_task(add_wynncraft_stats_to_db, player_data)
     return player_data
 
@@ -391,7 +457,7 @@ async def get_wynncraft(
 )
 async def get_wynncraft_guild(
     prefix,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
 ) -> WynncraftGuildInfo:
     return await get_wynncraft_guild_data(prefix, http_client)
 
@@ -418,7 +484,7 @@ async def get_wynncraft_character_ability_tree(
     uuid: str,
     character_uuid: str,
     class_type: ClassType = Query(..., alias="class"),
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
     redis: Redis = Depends(get_redis),
 ) -> list[AbilityTreePage]:
     uuid = normalize_uuid(uuid)
@@ -440,7 +506,7 @@ async def get_wynncraft_character_ability_tree(
     dependencies=[Depends(RateLimit(60, 60))],
 )
 async def get_wynncraft_max_content(
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
     redis: Redis = Depends(get_redis),
 ):
     return await get_wynncraft_content_max(http_client, redis)
@@ -459,14 +525,11 @@ async def get_wynncraft_max_content(
 async def get_donut(
     username: str,
     background_tasks: BackgroundTasks,
-    session: AsyncSession = Depends(get_db),
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
     redis: Redis = Depends(get_redis),
 ) -> DonutPlayerStats:
-    player_data = await get_donut_stats(username, http_client)
-    background_tasks.add_task(
-        add_donut_stats_to_db, player_data, username, session, http_client, redis
-    )
+    player_data, uuid = await get_donut_data(username, http_client, redis)
+    background_tasks.add_task(add_donut_stats_to_db, player_data, uuid)
     return player_data
 
 
@@ -477,15 +540,17 @@ async def get_donut(
     responses=COMMON_ERROR_RESPONSES,
     response_model=MCCIPlayer,
     name="Get MCC Island Stats",
-    description="Fetches player statistics and progress from the MCC Island server. Rate limit: 60/min.",
+    description="Fetches player statistics and progress from the MCC Island server. Stats and friends can be left out, friends are paginated. Rate limit: 60/min.",
     dependencies=[Depends(RateLimit(60, 60))],
 )
 async def get_mcc_island(
     uuid: str,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    query_params: Annotated[MCCIPlayerParams, Query()],
+    http_client: UpstreamClients = Depends(get_client),
+    redis: Redis = Depends(get_redis),
 ) -> MCCIPlayer:
     uuid = normalize_uuid(uuid)
-    return await get_mcci_data(uuid, http_client)
+    return await get_mcci_player(uuid, query_params, http_client, redis)
 
 
 # metrics
@@ -514,10 +579,11 @@ async def get_metric(metric_key: str, player_uuid: str) -> HistogramData:
 async def track_player(
     uuid: str,
     request: Request,
-    http_client: httpx.AsyncClient = Depends(get_client),
+    http_client: UpstreamClients = Depends(get_client),
+    redis: Redis = Depends(get_redis),
 ):
     uuid = normalize_uuid(uuid)
-    queue = await subscribe(uuid, http_client)
+    queue = await subscribe(uuid, http_client, redis)
 
     async def event_generator():
         try:
@@ -3,10 +3,10 @@ import asyncio
 from utils import dashify_uuid
 from dotenv import load_dotenv
 import os
-from fastapi import HTTPException
 from pydantic import BaseModel
 from typing import Optional, List
 import exceptions
+from upstream_clients import UpstreamClients
 
 load_dotenv()
 mcci_api_key = os.getenv("mcci_api_key")
@@ -39,28 +39,28 @@ class MCCIPlayer(BaseModel):
     first_join: Optional[str]
     last_join: Optional[str]
     friends: List[MCCIFriend]
+    # every friend, of which `friends` is one page; None when not requested
+    friends_total: Optional[int] = None
     stats: Optional[MCCIStats]
     plus_subscribed: bool
 
 
-query = """
-query player($uuid: UUID!) {
-  player(uuid: $uuid) {
-    uuid
-    username
-    ranks
+# the player query is put together from the sections a request needs, each
+# section is cached on its own by mcci_manager
+QUERY_SECTIONS = {
+    "status": """
     status {
       online
       firstJoin
       lastJoin
-    }
-    social {
-      friends {
-        uuid
-        username
-        ranks
-      }
-    }
+    }""",
+    "profile": """
+    username
+    ranks
+    mccPlusStatus {
+      evolution
+    }""",
+    "stats": """
     collections {
       currency {
         coins
@@ -68,35 +68,38 @@ query player($uuid: UUID!) {
         anglrTokens
       }
     }
-    mccPlusStatus {
-      evolution
-      streakStart
-      totalDays
-    }
     crownLevel {
       levelData {
         level
         evolution
-        nextEvolutionLevel
-        nextLevelProgress {
-          obtained
-          obtainable
-        }
-      }
-      fishingLevelData {
-        level
-        evolution
-        nextEvolutionLevel
       }
       trophies {
         obtained
         obtainable
       }
-    }
-  }
+    }""",
+    "friends": """
+    social {
+      friends {
+        uuid
+        username
+        ranks
+      }
+    }""",
 }
+
+
+def build_query(sections: list[str]) -> str:
+    fields = "".join(QUERY_SECTIONS[section] for section in sections)
+    return f"""
+query player($uuid: UUID!) {{
+  player(uuid: $uuid) {{
+    uuid{fields}
+  }}
+}}
 """
 
+
 RANK_MAP = {
     "CHAMP": "Champ",
     "GRAND_CHAMP": "Grand Champ",
@@ -117,61 +120,61 @@ def get_rank(ranks: list) -> str | None:
             return ranks[0]
 
 
-async def get_mcci_data(uuid: str, http_client: httpx.AsyncClient):
+async def fetch_mcci_player(
+    uuid: str, http_client: UpstreamClients, sections: list[str]
+) -> dict:
+    """The raw player object, with only the fields of `sections`"""
     variables = {"uuid": dashify_uuid(uuid)}
 
     assert mcci_api_key is not None, "MCCCI API key not found"
-    
+
     try:
-        mcci_response_raw = await http_client.post(
+        mcci_response_raw = await http_client.provider("mcci").post(
             "https://api.mccisland.net/graphql",
-            json={"query": query, "variables": variables},
+            json={"query": build_query(sections), "variables": variables},
             headers={"X-API-Key": mcci_api_key},
         )
         mcci_response_raw.raise_for_status()
 
     except httpx.TimeoutException:
         raise exceptions.UpstreamTimeoutError()
-    except httpx.RequestError:
+    except (httpx.RequestError, httpx.HTTPStatusError):
         raise exceptions.UpstreamError()
 
     mcci_response: dict = mcci_response_raw.json()
-    if mcci_response["data"] == {}:
-        raise HTTPException(404, {"message": "player was not found"})
+    player = (mcci_response.get("data") or {}).get("player")
+    if not player:
+        raise exceptions.NotFound()
+    return player
 
-    rank = get_rank(mcci_response["data"]["player"]["ranks"])
-
-    player: dict = mcci_response.get("data", {}).get("player", {})
 
+def process_status(player: dict) -> dict:
     status = player.get("status")
-    if status is not None:
-        online = status.get("online")
-        first_join = status.get("firstJoin")
-        last_join = status.get("lastJoin")
-    else:
-        online = False
-        first_join = None
-        last_join = None
+    if status is None:
+        return {"online": False, "first_join": None, "last_join": None}
+    return {
+        "online": status.get("online"),
+        "first_join": status.get("firstJoin"),
+        "last_join": status.get("lastJoin"),
+    }
 
-    friends = player.get("social", {}).get("friends")
 
-    player_friends = []
-    if friends is not None:
-        for friend in friends:
-            player_friends.append(
-                MCCIFriend(
-                    uuid=friend["uuid"],
-                    username=friend["username"],
-                    rank=get_rank(friend["ranks"]),
-                )
-            )
+def process_profile(player: dict) -> dict:
+    return {
+        "uuid": player["uuid"],
+        "username": player.get("username"),
+        "rank": get_rank(player.get("ranks", [])),
+        "plus_subscribed": player.get("mccPlusStatus") is not None,
+    }
+
 
-    currency: dict = player.get("collections", {}).get("currency", {})
-    crown_level: dict = player.get("crownLevel", {})
-    trophies: dict = crown_level.get("trophies", {})
-    level_data: dict = crown_level.get("levelData", {})
+def process_stats(player: dict) -> dict:
+    currency: dict = (player.get("collections") or {}).get("currency") or {}
+    crown_level: dict = player.get("crownLevel") or {}
+    trophies: dict = crown_level.get("trophies") or {}
+    level_data: dict = crown_level.get("levelData") or {}
 
-    player_stats = MCCIStats(
+    return MCCIStats(
         coins=currency.get("coins"),
         royal_reputation=currency.get("royalReputation"),
         anglr_token=currency.get("anglrTokens"),
@@ -179,26 +182,71 @@ async def get_mcci_data(uuid: str, http_client: httpx.AsyncClient):
         max_trophies=trophies.get("obtainable"),
         level=level_data.get("level"),
         level_evolution=level_data.get("evolution"),
-    )
+    ).model_dump()
 
-    mcc_plus = player.get("mccPlusStatus")
-    if mcc_plus is not None:
-        plus_subscribed = True
-    else:
-        plus_subscribed = False
-
-    player_response = MCCIPlayer(
-        uuid=player["uuid"],
-        username=player.get("username"),
-        rank=rank,
-        online=online,
-        first_join=first_join,
-        last_join=last_join,
+
+def process_friends(player: dict) -> list:
+    """[uuid, username, rank] per friend, validated into MCCIFriend per page"""
+    friends = (player.get("social") or {}).get("friends") or []
+    return [
+        [friend["uuid"], friend["username"], get_rank(friend["ranks"])]
+        for friend in friends
+    ]
+
+
+SECTION_PROCESSORS = {
+    "status": process_status,
+    "profile": process_profile,
+    "stats": process_stats,
+    "friends": process_friends,
+}
+
+
+def build_mcci_player(
+    sections: dict,
+    friends_offset: int = 0,
+    friends_limit: int | None = None,
+) -> MCCIPlayer:
+    """
+    Puts the processed `sections` together, only the requested page of
+    friends is turned into models
+    """
+    status = sections["status"]
+    profile = sections["profile"]
+    stats = sections.get("stats")
+    friends = sections.get("friends")
+
+    player_friends = []
+    friends_total = None
+    if friends is not None:
+        friends_total = len(friends)
+        end = None if friends_limit is None else friends_offset + friends_limit
+        for friend_uuid, username, rank in friends[friends_offset:end]:
+            player_friends.append(
+                MCCIFriend(uuid=friend_uuid, username=username, rank=rank)
+            )
+
+    return MCCIPlayer(
+        uuid=profile["uuid"],
+        username=profile["username"],
+        rank=profile["rank"],
+        online=status["online"],
+        first_join=status["first_join"],
+        last_join=status["last_join"],
         friends=player_friends,
-        stats=player_stats,
-        plus_subscribed=plus_subscribed,
+        friends_total=friends_total,
+        stats=MCCIStats(**stats) if stats is not None else None,
+        plus_subscribed=profile["plus_subscribed"],
     )
-    return player_response
+
+
+async def get_mcci_data(uuid: str, http_client: UpstreamClients) -> MCCIPlayer:
+    """Every section straight from the API, without the cache"""
+    player = await fetch_mcci_player(uuid, http_client, list(QUERY_SECTIONS))
+    sections = {
+        section: process(player) for section, process in SECTION_PROCESSORS.items()
+    }
+    return build_mcci_player(sections)
 
 
 if __name__ == "__main__":
@@ -206,6 +254,6 @@ if __name__ == "__main__":
     # 069a79f444e94726a5befca90e38aaf5
     # good testing uuid 03fa539c41d34b86b0f47a0d695757e7
     data = asyncio.run(
-        get_mcci_data("03fa539c41d34b86b0f47a0d695757e7", httpx.AsyncClient())
+        get_mcci_data("03fa539c41d34b86b0f47a0d695757e7", UpstreamClients())
     )
     print(data)
@@ -0,0 +1,190 @@
+"""
+mcci_manager.py
+
+Redis cache for the MCC Island GraphQL API. A player is cached in sections
+that each have their own query fields and CachePolicy: the online status
+changes by the minute, while the profile, stats and friends list hardly
+change between views. A request reads only the sections it asked for and
+sends one query for the ones that are missing or expired, so a repeat view
+usually costs a status-only query, or nothing at all.
+
+Friends are cached as compact [uuid, username, rank] lists and only the
+requested page is turned into MCCIFriend models.
+"""
+
+import logging
+from typing import Any
+
+from pydantic import BaseModel, Field
+from redis.asyncio import Redis
+
+import exceptions
+import request_cost
+from cache_envelope import (
+    STALE_IF_ERROR_EXCEPTIONS,
+    CachePolicy,
+    Cached,
+    is_known_missing,
+    mark_stale,
+    read_entries,
+    refresh_in_background,
+    remember_missing,
+    wrap,
+)
+from cache_namespaces import MCCI
+from mcci_api import (
+    MCCIPlayer,
+    SECTION_PROCESSORS,
+    build_mcci_player,
+    fetch_mcci_player,
+)
+from single_flight import single_flight
+from upstream_clients import UpstreamClients
+
+logger = logging.getLogger(__name__)
+
+MCCI_STATUS_POLICY = CachePolicy(
+    fresh_seconds=60,
+    revalidate_seconds=0,
+    hard_seconds=60 * 10,
+)
+MCCI_PROFILE_POLICY = CachePolicy(
+    fresh_seconds=60 * 10,
+    revalidate_seconds=60 * 50,
+    hard_seconds=60 * 60 * 6,
+)
+SECTION_POLICIES = {
+    "status": MCCI_STATUS_POLICY,
+    "profile": MCCI_PROFILE_POLICY,
+    "stats": MCCI_PROFILE_POLICY,
+    "friends": MCCI_PROFILE_POLICY,
+}
+
+
+# params for fastapi
+class MCCIPlayerParams(BaseModel):
+    stats: bool = True
+    friends: bool = True
+    # the whole list unless asked for a page, friends_total is set either way
+    friends_limit: int | None = Field(None, gt=0, le=200)
+    friends_offset: int = Field(0, ge=0)
+
+
+def section_key(section: str, uuid: str) -> str:
+    return MCCI.key(f"{section}:{uuid}")
+
+
+def is_fresh(section: str, cached: Cached) -> bool:
+    return cached.age < SECTION_POLICIES[section].fresh_seconds
+
+
+async def get_mcci_sections_cache(
+    uuid: str, sections: list[str], redis: Redis
+) -> dict[str, Cached]:
+    cached = {}
+    entries = await read_entries(
+        redis, MCCI, [f"{section}:{uuid}" for section in sections]
+    )
+    for section, entry in zip(sections, entries):
+        if entry is not None:
+            cached[section] = Cached(*entry)
+    return cached
+
+
+async def fetch_mcci_sections(
+    uuid: str, sections: list[str], http_client: UpstreamClients, redis: Redis
+) -> dict[str, Any]:
+    try:
+        player = await fetch_mcci_player(uuid, http_client, sections)
+    except exceptions.NotFound:
+        await remember_missing(redis, ("mcci", "player", uuid))
+        raise
+    data = {section: SECTION_PROCESSORS[section](player) for section in sections}
+
+    pipe = redis.pipeline()
+    for section, value in data.items():
+        pipe.set(
+            section_key(section, uuid),
+            wrap(value),
+            ex=SECTION_POLICIES[section].hard_seconds,
+        )
+    await pipe.execute()
+    return data
+
+
+async def get_mcci_sections(
+    uuid: str, sections: list[str], http_client: UpstreamClients, redis: Redis
+) -> dict[str, Any]:
+    """
+    serve_cached for several sections at once: fresh sections are served as
+    is, the rest are fetched together in one query. Sections within their
+    revalidate window are refreshed in the background, unless a query has to
+    be made anyway.
+    """
+    cached = await get_mcci_sections_cache(uuid, sections, redis)
+    values = {section: entry.value for section, entry in cached.items()}
+
+    revalidate = []
+    expired = []
+    for section in sections:
+        entry = cached.get(section)
+        if entry is not None and is_fresh(section, entry):
+            continue
+        policy = SECTION_POLICIES[section]
+        if (
+            entry is not None
+            and entry.age < policy.fresh_seconds + policy.revalidate_seconds
+        ):
+            revalidate.append(section)
+        else:
+            expired.append(section)
+
+    async def load(wanted: list[str]) -> dict[str, Any]:
+        # another request or worker may have refreshed some of them meanwhile
+        latest = await get_mcci_sections_cache(uuid, wanted, redis)
+        data = {
+            section: entry.value
+            for section, entry in latest.items()
+            if is_fresh(section, entry)
+        }
+        stale = [section for section in wanted if section not in data]
+        if stale:
+            data.update(await fetch_mcci_sections(uuid, stale, http_client, redis))
+        return data
+
+    if any(section not in cached for section in expired) and await is_known_missing(
+        redis, ("mcci", "player", uuid)
+    ):
+        raise exceptions.NotFound()
+
+    if expired:
+        request_cost.add_cache_miss()
+        # the query is made anyway, so it takes the revalidations along
+        wanted = expired + revalidate
+        key = ("mcci", "+".join(wanted), uuid)
+        try:
+            values.update(await single_flight(redis, key, lambda: load(wanted)))
+        except STALE_IF_ERROR_EXCEPTIONS as e:
+            if any(section not in cached for section in wanted):
+                raise
+            logger.warning(f"Serving stale {':'.join(key)} after upstream error: {e}")
+            mark_stale(key)
+    elif revalidate:
+        key = ("mcci", "+".join(revalidate), uuid)
+        refresh_in_background(redis, key, lambda: load(revalidate))
+        mark_stale(key)
+
+    return values
+
+
+async def get_mcci_player(
+    uuid: str, params: MCCIPlayerParams, http_client: UpstreamClients, redis: Redis
+) -> MCCIPlayer:
+    sections = ["status", "profile"]
+    if params.stats:
+        sections.append("stats")
+    if params.friends:
+        sections.append("friends")
+
+    data = await get_mcci_sections(uuid, sections, http_client, redis)
+    return build_mcci_player(data, params.friends_offset, params.friends_limit)
@@ -1,4 +1,4 @@
-from utils import pillow_to_b64, check_valid_uuid
+from utils import pillow_to_bytes, check_valid_uuid
 import re
 import json
 import base64
@@ -10,6 +10,17 @@ import logging
 from pydantic import BaseModel
 from typing import Optional
 import exceptions
+from request_cost import measure_cpu
+from upstream_clients import UpstreamClients
+from redis.asyncio import Redis
+from texture_store import (
+    CAPE,
+    SKIN_FACE,
+    get_textures,
+    set_texture,
+    texture_hash,
+    texture_key,
+)
 
 
 class MojangData(BaseModel):
@@ -65,7 +76,11 @@ CAPE_MAP = {
 
 class GetMojangAPIData:
     def __init__(
-        self, client: httpx.AsyncClient, username: str | None, uuid: str | None = None
+        self,
+        client: UpstreamClients,
+        username: str | None,
+        uuid: str | None = None,
+        redis: Redis | None = None,
     ):
         self.username = username
         self.uuid = uuid
@@ -81,6 +96,8 @@ class GetMojangAPIData:
         self.cape_showcase_b64 = None
         self.cape_showcase_b64 = None
         self.client = client
+        # texture store, renders are redone every time without it
+        self.redis = redis
 
     async def get_data(self) -> MojangData:
         """
@@ -126,9 +143,8 @@ class GetMojangAPIData:
             raise exceptions.NotFound()
 
         try:
-            uuid_response_raw = await self.client.get(
+            uuid_response_raw = await self.client.provider("mojang").get(
                 f"https://api.minecraftservices.com/minecraft/profile/lookup/name/{self.username}",
-                timeout=10,
             )
             uuid_response_raw.raise_for_status()
 
@@ -173,6 +189,9 @@ class GetMojangAPIData:
         except httpx.RequestError as e:
             logger.error(f"Request exception occurred: {e}")
             raise exceptions.UpstreamError()
+        except exceptions.UpstreamError:
+            # circuit breaker is open
+            raise
         except Exception as e:
             logger.warning(f"something went wrong while getting Minecraft UUID: {e}")
             raise exceptions.ServiceError()
@@ -190,9 +209,8 @@ class GetMojangAPIData:
         """
 
         try:
-            player_profile_raw = await self.client.get(
+            player_profile_raw = await self.client.provider("sessionserver").get(
                 f"https://sessionserver.mojang.com/session/minecraft/profile/{self.uuid}",
-                timeout=10,
             )
             player_profile_raw.raise_for_status()
 
@@ -245,6 +263,9 @@ class GetMojangAPIData:
                 repr(e),
             )
             raise exceptions.UpstreamError()
+        except exceptions.UpstreamError:
+            # circuit breaker is open
+            raise
         except Exception as e:
             logger.warning(
                 f"something went wrong while getting Minecraft skin data: {e}"
@@ -279,93 +300,82 @@ class GetMojangAPIData:
 
     async def get_skin_images(self):
         """
-        This downloads the images from skin url and optionally cape url(if it exists)
+        Gets the skin face and, if there is a cape, its front and back crops.
+        Renders already in the texture store are reused, only textures it
+        doesn't have yet are downloaded, cropped and stored.
         """
+        skin_key = texture_key(SKIN_FACE, texture_hash(self.skin_url))
+        cape_key = None
+        if self.has_cape:
+            cape_key = texture_key(CAPE, texture_hash(self.cape_url))
+
+        stored_skin, stored_cape = None, None
+        if self.redis is not None:
+            keys = [skin_key] if cape_key is None else [skin_key, cape_key]
+            stored = await get_textures(self.redis, keys, touch=True)
+            stored_skin = stored[0]
+            stored_cape = stored[1] if cape_key is not None else None
+
         # Prepare fetch tasks
-        skin_task = self.client.get(self.skin_url)
+        textures_client = self.client.provider("textures")
+        skin_task = None
+        if stored_skin is None:
+            skin_task = textures_client.get(self.skin_url)
         cape_task = None
-        if self.has_cape:
-            cape_task = self.client.get(self.cape_url)
+        if self.has_cape and stored_cape is None:
+            cape_task = textures_client.get(self.cape_url)
 
         try:
-            # Execute fetches concurrently
-            if cape_task:
-                response_skin, response_cape = await asyncio.gather(
-                    skin_task, cape_task
+            # Execute fetches concurrently, sleep(0) stands in for a stored one
+            response_skin, response_cape = await asyncio.gather(
+                skin_task or asyncio.sleep(0), cape_task or asyncio.sleep(0)
+            )
+
+            if stored_skin is None:
+                with measure_cpu():
+                    face = self.render_skin_face(response_skin.content)
+                if face is not None:
+                    stored_skin = {"face": face}
+                    if self.redis is not None:
+                        await set_texture(self.redis, skin_key, stored_skin)
+            if stored_skin is not None:
+                self.skin_showcase_b64 = base64.b64encode(stored_skin["face"]).decode(
+                    "utf-8"
                 )
-            else:
-                response_skin = await skin_task
-                response_cape = None
 
-            # Process skin
-            skin_bytes = io.BytesIO(response_skin.content)
-            full_skin_image = Image.open(skin_bytes)
-            logger.debug("skin image opened successfully")
+            if not self.has_cape:
+                logger.info(f"no cape for user {self.username}")
+                return self.skin_showcase_b64, None, None
 
-            try:
-                crop_area = (8, 8, 16, 16)
-                self.skin_showcase = full_skin_image.crop(crop_area)  # base skin face
-
-                crop_area = (40, 8, 48, 16)
-                skin_showcase_overlay = full_skin_image.crop(
-                    crop_area
-                )  # skin face overlay
-                _, _, _, alpha_mask = skin_showcase_overlay.split()
-
-                paste_area = (0, 0)
-                self.skin_showcase.paste(
-                    skin_showcase_overlay, paste_area, mask=alpha_mask
+            if stored_cape is None and response_cape is not None:
+                with measure_cpu():
+                    crops = self.render_cape(response_cape.content)
+                if crops is not None:
+                    stored_cape = {"front": crops[0], "back": crops[1]}
+                    if self.redis is not None:
+                        await set_texture(self.redis, cape_key, stored_cape)
+            if stored_cape is not None:
+                self.cape_showcase_b64 = base64.b64encode(stored_cape["front"]).decode(
+                    "utf-8"
                 )
-
-                self.skin_showcase_b64 = pillow_to_b64(self.skin_showcase)
-
-            except Exception as e:
-                logger.error(f"something went wrong while cropping skin image: {e}")
-
-            # Process cape if available
-            if self.has_cape and response_cape:
-                try:
-                    cape_bytes = io.BytesIO(response_cape.content)
-                    full_cape_image = Image.open(cape_bytes)  # uncropped cape image
-                    logger.info("cape image opened successfully")
-                except Exception as e:
-                    logger.error(f"something went wrong while fetching cape image: {e}")
-
-                try:
-                    crop_area = (1, 1, 11, 17)
-                    self.cape_showcase = full_cape_image.crop(crop_area)
-                except Exception as e:
-                    logger.error(f"something went wrong while cropping cape image: {e}")
-
-                try:
-                    crop_area = (12, 1, 22, 17)
-                    self.cape_back = full_cape_image.crop(crop_area)
-                except Exception as e:
-                    logger.error(
-                        f"something went wrong while cropping back of cape: {e}"
-                    )
-
-                self.cape_showcase_b64 = pillow_to_b64(self.cape_showcase)
-                self.cape_back_b64 = pillow_to_b64(self.cape_back)
-
-                raw_cape_data = self.cape_url[-32:]
-                try:
-                    logger.info(f"trying to access {raw_cape_data}")
-                    self.cape_name = CAPE_MAP[raw_cape_data]
-                    logger.info(f"Identified {self.cape_name} cape!")
-                except KeyError:
-                    logger.warning("Cape not regonized")
-                    self.cape_name = "Unknown cape"
-
-                return (
-                    self.skin_showcase_b64,
-                    self.cape_showcase_b64,
-                    self.cape_back_b64,
+                self.cape_back_b64 = base64.b64encode(stored_cape["back"]).decode(
+                    "utf-8"
                 )
 
-            else:
-                logger.info(f"no cape for user {self.username}")
-                return self.skin_showcase_b64, None, None
+            raw_cape_data = self.cape_url[-32:]
+            try:
+                logger.info(f"trying to access {raw_cape_data}")
+                self.cape_name = CAPE_MAP[raw_cape_data]
+                logger.info(f"Identified {self.cape_name} cape!")
+            except KeyError:
+                logger.warning("Cape not regonized")
+                self.cape_name = "Unknown cape"
+
+            return (
+                self.skin_showcase_b64,
+                self.cape_showcase_b64,
+                self.cape_back_b64,
+            )
 
         except Exception as e:
             logger.error(f"something went wrong in get_skin_images: {e}")
@@ -373,6 +383,48 @@ class GetMojangAPIData:
             # but strict preservation of behavior suggests swallowing
             # (though the original code swallowed exceptions somewhat liberally)
 
+    @staticmethod
+    def render_skin_face(skin: bytes) -> bytes | None:
+        """The face with its overlay layer on top, as PNG"""
+        full_skin_image = Image.open(io.BytesIO(skin))
+        logger.debug("skin image opened successfully")
+
+        try:
+            crop_area = (8, 8, 16, 16)
+            skin_showcase = full_skin_image.crop(crop_area)  # base skin face
+
+            crop_area = (40, 8, 48, 16)
+            skin_showcase_overlay = full_skin_image.crop(crop_area)  # skin face overlay
+            _, _, _, alpha_mask = skin_showcase_overlay.split()
+
+            paste_area = (0, 0)
+            skin_showcase.paste(skin_showcase_overlay, paste_area, mask=alpha_mask)
+
+            return pillow_to_bytes(skin_showcase)
+
+        except Exception as e:
+            logger.error(f"something went wrong while cropping skin image: {e}")
+            return None
+
+    @staticmethod
+    def render_cape(cape: bytes) -> tuple[bytes, bytes] | None:
+        """The front and back of the cape, as PNGs"""
+        try:
+            full_cape_image = Image.open(io.BytesIO(cape))  # uncropped cape image
+            logger.info("cape image opened successfully")
+
+            crop_area = (1, 1, 11, 17)
+            cape_showcase = full_cape_image.crop(crop_area)
+
+            crop_area = (12, 1, 22, 17)
+            cape_back = full_cape_image.crop(crop_area)
+
+            return pillow_to_bytes(cape_showcase), pillow_to_bytes(cape_back)
+
+        except Exception as e:
+            logger.error(f"something went wrong while cropping cape image: {e}")
+            return None
+
 
 if __name__ == "__main__":
     pass
@@ -1,55 +1,123 @@
 from minecraft_api import GetMojangAPIData, MojangData
-import time
-import httpx
+from upstream_clients import UpstreamClients
 from utils import normalize_uuid, is_valid_uuid
 from redis.asyncio import Redis
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-import json
+from cache_envelope import (
+    CachePolicy,
+    Cached,
+    forget_missing,
+    read_entries,
+    read_entry,
+    serve_cached,
+    wrap,
+)
+from cache_namespaces import MINECRAFT_DATA, MINECRAFT_USERNAME
+import cache_codec
+from cache_codec import bytes_to_b64
+import json_codec
+from texture_store import CAPE, SKIN_FACE, get_textures, texture_hash, texture_key
 
 HARD_MINECRAFT_TTL = 60 * 60 * 24 * 7
 MINECRAFT_TTL = 60 * 3
 # we want to keep minecraft data fresh for normal searches, but
 # hypixel guild lookups can quickly get rate-limited, so we consider
 # data stale much later than normal searches
+MINECRAFT_POLICY = CachePolicy(
+    fresh_seconds=MINECRAFT_TTL,
+    revalidate_seconds=60 * 60,
+    hard_seconds=HARD_MINECRAFT_TTL,
+)
+ALLOW_STALE_MINECRAFT_POLICY = CachePolicy(
+    fresh_seconds=HARD_MINECRAFT_TTL,
+    revalidate_seconds=0,
+    hard_seconds=HARD_MINECRAFT_TTL,
+)
 
-MINECRAFT_DATA_KEY = "aspexis:minecraft:data:"
-MINECRAFT_USERNAME_KEY = "aspexis:minecraft:username:"
+# kept in the texture store, entries only reference them by hash (older ones
+# have them inline)
+IMAGE_FIELDS = ("skin_showcase_b64", "cape_front_b64", "cape_back_b64")
 
 
 async def get_minecraft_cache(
-    search_term: str, redis: Redis, allow_stale: bool = False
-) -> MojangData | None:
-    """Gets cache data for one search term with the default TTL"""
+    search_term: str, redis: Redis
+) -> Cached[MojangData] | None:
+    """Gets cache data for one search term, whatever its age"""
 
     if not is_valid_uuid(search_term):
-        uuid = await redis.get(f"{MINECRAFT_USERNAME_KEY}{search_term.lower()}")
+        uuid = await redis.get(MINECRAFT_USERNAME.key(search_term.lower()))
         if not uuid:
             return None
+        uuid = json_codec.to_str(uuid)
     else:
         uuid = search_term
 
-    data = await redis.get(f"{MINECRAFT_DATA_KEY}{uuid}")
+    cached = await read_entry(redis, MINECRAFT_DATA, uuid)
+    if cached is None:
+        return None
 
-    if data is not None:
-        data = json.loads(data)
-        timestamp = data.get("timestamp", 0)
-        if allow_stale or (time.time() - timestamp < MINECRAFT_TTL):
-            return MojangData(source="cache", **data["data"])
+    payload, stored_at = cached
+    if "skin_hash" in payload:
+        payload = await attach_textures(payload, redis)
+        if payload is None:
+            return None
+    data = MojangData(source="cache", **bytes_to_b64(payload, IMAGE_FIELDS))
+    # the name may have been taken by someone else since we cached it
+    if not is_valid_uuid(search_term) and data.username.lower() != search_term.lower():
+        return None
+    return Cached(data, stored_at)
 
-    return None
+
+async def attach_textures(payload: dict, redis: Redis) -> dict | None:
+    """
+    Fills in the images of an entry from the texture store, None if one of
+    them has expired (the entry is then refetched, which renders it again)
+    """
+    keys = [texture_key(SKIN_FACE, payload["skin_hash"])]
+    if payload.get("cape_hash"):
+        keys.append(texture_key(CAPE, payload["cape_hash"]))
+    textures = await get_textures(redis, keys)
+    if any(texture is None for texture in textures):
+        return None
+
+    payload = {**payload, "skin_showcase_b64": textures[0]["face"]}
+    if len(textures) > 1:
+        payload["cape_front_b64"] = textures[1]["front"]
+        payload["cape_back_b64"] = textures[1]["back"]
+    else:
+        payload["cape_front_b64"] = payload["cape_back_b64"] = None
+    return payload
 
 
 async def set_minecraft_cache(data: MojangData, redis: Redis):
-    cache_dict = {"timestamp": time.time(), "data": data.model_dump(exclude={"source"})}
+    """The images themselves were stored by GetMojangAPIData"""
+    if cache_codec.WRITE_FORMAT == "json":
+        # older workers expect the images inline
+        entry = data.model_dump(exclude={"source"})
+    else:
+        entry = data.model_dump(exclude={"source", *IMAGE_FIELDS})
+        entry["skin_hash"] = texture_hash(data.skin_url)
+        entry["cape_hash"] = None
+        if data.cape_url and data.cape_front_b64 is not None:
+            entry["cape_hash"] = texture_hash(data.cape_url)
+
     await redis.set(
-        f"{MINECRAFT_USERNAME_KEY}{data.username.lower()}", data.uuid, ex=MINECRAFT_TTL
+        MINECRAFT_USERNAME.key(data.username.lower()),
+        data.uuid,
+        ex=HARD_MINECRAFT_TTL,
     )
     await redis.set(
-        f"{MINECRAFT_DATA_KEY}{data.uuid}",
-        json.dumps(cache_dict),
+        MINECRAFT_DATA.key(data.uuid),
+        wrap(entry),
         ex=HARD_MINECRAFT_TTL,
     )
+    # the name may have been looked up before it was registered
+    await forget_missing(
+        redis,
+        ("mojang", "profile", data.username.lower()),
+        ("mojang", "profile", data.uuid),
+    )
 
 
 async def bulk_get_usernames_cache(
@@ -67,24 +135,37 @@ async def bulk_get_usernames_cache(
     # Normalize UUIDs
     normalized_uuids = [normalize_uuid(u) for u in uuids]
 
-    keys = [f"{MINECRAFT_DATA_KEY}{uuid}" for uuid in normalized_uuids]
-
-    results = await redis.mget(keys)
+    results = await read_entries(redis, MINECRAFT_DATA, normalized_uuids)
 
     resolved_results: list[dict[str, str]] = []
     unresolved_uuids: list[str] = []
+    payloads: list[tuple[str, dict]] = []
 
-    for uuid, raw in zip(normalized_uuids, results):
-        if not raw:
+    for uuid, cached in zip(normalized_uuids, results):
+        if not cached or not cached[0]:
             unresolved_uuids.append(uuid)
             continue
+        payloads.append((uuid, cached[0]))
+
+    # members often share a skin, each face is only read once
+    face_keys = list(
+        {
+            texture_key(SKIN_FACE, payload["skin_hash"])
+            for _, payload in payloads
+            if "skin_hash" in payload
+        }
+    )
+    faces = dict(zip(face_keys, await get_textures(redis, face_keys)))
 
+    for uuid, payload in payloads:
         try:
-            parsed = json.loads(raw)
-            payload = parsed.get("data")
-            if not payload:
-                unresolved_uuids.append(uuid)
-                continue
+            if "skin_hash" in payload:
+                face = faces.get(texture_key(SKIN_FACE, payload["skin_hash"]))
+                if face is None:
+                    unresolved_uuids.append(uuid)
+                    continue
+                payload = {**payload, "skin_showcase_b64": face["face"]}
+            payload = bytes_to_b64(payload, ("skin_showcase_b64",))
 
             resolved_results.append(
                 {
@@ -100,25 +181,34 @@ async def bulk_get_usernames_cache(
     return resolved_results, unresolved_uuids
 
 
+async def fetch_minecraft_data(
+    search_term: str, http_client: UpstreamClients, redis: Redis
+) -> MojangData:
+    if len(search_term) <= 20:
+        mojang_instance = GetMojangAPIData(http_client, search_term, redis=redis)
+    else:
+        mojang_instance = GetMojangAPIData(
+            http_client, None, normalize_uuid(search_term), redis=redis
+        )
+    data = await mojang_instance.get_data()
+    await set_minecraft_cache(data, redis)
+    return data
+
+
 async def get_minecraft_data(
     search_term: str,
-    http_client: httpx.AsyncClient,
+    http_client: UpstreamClients,
     redis: Redis,
     allow_stale: bool = False,
 ) -> MojangData:
-
-    data = await get_minecraft_cache(search_term, redis, allow_stale=allow_stale)
-
-    if data is None:
-        if len(search_term) <= 20:
-            mojang_instance = GetMojangAPIData(http_client, search_term)
-        else:
-            search_term = normalize_uuid(search_term)
-            mojang_instance = GetMojangAPIData(http_client, None, search_term)
-        data = await mojang_instance.get_data()
-        await set_minecraft_cache(data, redis)
-
-    return data
+    return await serve_cached(
+        redis,
+        ("mojang", "profile", search_term.lower()),
+        ALLOW_STALE_MINECRAFT_POLICY if allow_stale else MINECRAFT_POLICY,
+        lambda: get_minecraft_cache(search_term, redis),
+        lambda: fetch_minecraft_data(search_term, http_client, redis),
+        as_stale=lambda data: data.model_copy(update={"source": "stale_cache"}),
+    )
 
 
 async def update_player_history(data: MojangData, session: AsyncSession):
@@ -174,7 +264,7 @@ async def update_player_history(data: MojangData, session: AsyncSession):
         # 2. Update Skin History
         if data.skin_url:
             # Extract hash after the base url
-            skin_hash = data.skin_url.split("http://textures.minecraft.net/texture/")[-1]
+            skin_hash = texture_hash(data.skin_url)
             await session.execute(
                 text(
                     """
@@ -188,7 +278,7 @@ async def update_player_history(data: MojangData, session: AsyncSession):
             
         # 3. Update Cape History
         if data.cape_url:
-            cape_hash = data.cape_url.split("http://textures.minecraft.net/texture/")[-1]
+            cape_hash = texture_hash(data.cape_url)
             await session.execute(
                 text(
                     """
@@ -1,10 +1,12 @@
 import asyncio
-import httpx
 import logging
 from dotenv import load_dotenv
-from utils import dashify_uuid
 import os
 import exceptions
+from redis.asyncio import Redis
+from upstream_clients import UpstreamClients
+from wynncraft_manager import get_wynncraft_status
+from hypixel_quota import scheduled_get
 from pydantic import BaseModel
 from typing import Optional, Dict, Any
 
@@ -23,12 +25,8 @@ class PlayerStatus(BaseModel):
     hypixel_mode: str | None
 
 
-wynn_token = os.getenv("WYNN_TOKEN")
 hypixel_api_key = os.getenv("hypixel_api_key")
 
-if not wynn_token:
-    raise RuntimeError("Wynncraft Token not set in environment variables.")
-
 if not hypixel_api_key:
     raise RuntimeError("Hypixel Api key not set in environment vairables.")
 
@@ -69,9 +67,11 @@ if hypixel_api_key is None:
     raise Exception("No Hypixel API Key found while getting status")
 
 
-async def get_status(uuid: str, http_client: httpx.AsyncClient) -> PlayerStatus:
+async def get_status(
+    uuid: str, http_client: UpstreamClients, redis: Redis
+) -> PlayerStatus:
     wynncraft_raw, hypixel_raw = await asyncio.gather(
-        get_wynncraft_status(http_client, uuid),
+        get_wynncraft_status(uuid, http_client, redis),
         get_hypixel_status(http_client, uuid),
         return_exceptions=True,
     )
@@ -148,27 +148,15 @@ async def get_status(uuid: str, http_client: httpx.AsyncClient) -> PlayerStatus:
     )
 
 
-async def get_wynncraft_status(client: httpx.AsyncClient, uuid: str):
-    dashed_uuid = dashify_uuid(uuid)
-    response = await client.get(
-        f"https://api.wynncraft.com/v3/player/{dashed_uuid}",
-        headers={"Authorization": f"Bearer {wynn_token}"},
-    )
-
-    if response.status_code == 404:
-        raise exceptions.NotFound()
-
-    response.raise_for_status()
-    return response.json()
-
-
-async def get_hypixel_status(client: httpx.AsyncClient, uuid: str):
+async def get_hypixel_status(client: UpstreamClients, uuid: str):
     assert hypixel_api_key is not None, "Hypixel API Key is None, cannot fetch status"
 
     headers = {"API-Key": hypixel_api_key}
     params = {"uuid": uuid}
 
-    response = await client.get(
+    response = await scheduled_get(
+        client,
+        "interactive",
         "https://api.hypixel.net/v2/status",
         params=params,
         headers=headers,
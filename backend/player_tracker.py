@@ -1,21 +1,19 @@
 import asyncio
 from typing import Dict, Set, Optional
 from pydantic import BaseModel
-import httpx
 import os
 from dotenv import load_dotenv
-from utils import dashify_uuid
 import exceptions
+from redis.asyncio import Redis
+from upstream_clients import UpstreamClients
+import wynncraft_manager
+from hypixel_quota import scheduled_get
 from fastapi import HTTPException
 
 load_dotenv()
 
-wynn_token = os.getenv("WYNN_TOKEN")
 hypixel_api_key = os.getenv("hypixel_api_key")
 
-if not wynn_token:
-    raise RuntimeError("Wynncraft Token not set in environment variables.")
-
 if not hypixel_api_key:
     raise RuntimeError("Hypixel Api key not set in environment vairables.")
 
@@ -67,12 +65,12 @@ subscribers: Dict[str, Set[asyncio.Queue]] = {}  # uuid, queue
 ignored_sources: Dict[str, Set[str]] = {}  # uuid, set["wynncraft", "hypixel"]
 
 
-async def poller(uuid: str, http_client: httpx.AsyncClient):
+async def poller(uuid: str, http_client: UpstreamClients, redis: Redis):
     print(f"poller started for {uuid}")
     try:
         while True:
             try:
-                data = await get_status(uuid, http_client)
+                data = await get_status(uuid, http_client, redis)
                 message = f"event: data\ndata: {data.model_dump_json()}\n\n"
             except:
                 message = "event: error\ndata: {}\n\n"
@@ -87,7 +85,7 @@ async def poller(uuid: str, http_client: httpx.AsyncClient):
         print(f"something went wrong in poller: {e}")
 
 
-async def subscribe(uuid: str, http_client: httpx.AsyncClient):
+async def subscribe(uuid: str, http_client: UpstreamClients, redis: Redis):
     queue = asyncio.Queue()
 
     if uuid not in subscribers:
@@ -99,7 +97,7 @@ async def subscribe(uuid: str, http_client: httpx.AsyncClient):
         ignored_sources[uuid] = set()
 
     if uuid not in trackers:
-        task = asyncio.create_task(poller(uuid, http_client))
+        task = asyncio.create_task(poller(uuid, http_client, redis))
         trackers[uuid] = task
 
     return queue
@@ -121,10 +119,12 @@ def unsubscribe(uuid: str, queue: asyncio.Queue):
             del trackers[uuid]
 
 
-async def get_status(uuid: str, http_client: httpx.AsyncClient) -> PlayerStatus:
+async def get_status(
+    uuid: str, http_client: UpstreamClients, redis: Redis
+) -> PlayerStatus:
     print(f"ignored sources: {ignored_sources[uuid]}")
     results = await asyncio.gather(
-        get_wynncraft_status(http_client, uuid),
+        get_wynncraft_status(uuid, http_client, redis),
         get_hypixel_status(http_client, uuid),
         return_exceptions=True,
     )
@@ -198,29 +198,25 @@ async def get_status(uuid: str, http_client: httpx.AsyncClient) -> PlayerStatus:
     return player_status
 
 
-async def get_wynncraft_status(client: httpx.AsyncClient, uuid):
+async def get_wynncraft_status(uuid: str, http_client: UpstreamClients, redis: Redis):
     if "wynncraft" in ignored_sources[uuid]:
         print("wynncraft is ignored, passing")
         return None
-    dashed_uuid = dashify_uuid(uuid)
-    response = await client.get(
-        f"https://api.wynncraft.com/v3/player/{dashed_uuid}",
-        headers={"Authorization": f"Bearer {wynn_token}"},
-    )
-    if response.status_code == 404:
-        raise exceptions.NotFound()
-    response.raise_for_status()
-    return response.json()
+    return await wynncraft_manager.get_wynncraft_status(uuid, http_client, redis)
 
 
-async def get_hypixel_status(client: httpx.AsyncClient, uuid):
+async def get_hypixel_status(client: UpstreamClients, uuid):
     if "hypixel" in ignored_sources[uuid]:
         return None
     headers = {"API-Key": hypixel_api_key}
     params = {"uuid": uuid}
 
-    response = await client.get(
-        "https://api.hypixel.net/v2/status", params=params, headers=headers
+    response = await scheduled_get(
+        client,
+        "tracker",
+        "https://api.hypixel.net/v2/status",
+        params=params,
+        headers=headers,
     )
     if (
         response.status_code == 404
@@ -0,0 +1,242 @@
+"""
+popularity.py
+
+Refresh-ahead for the players and guilds people keep looking at. Routes call
+`record` for every view; the counts are buffered in memory and added to one
+Redis sorted set per kind of entry every few seconds, so all workers share
+one ranking. The scores decay by half every POPULARITY_HALF_LIFE_SECONDS, so
+the ranking follows what is popular now rather than what was popular once.
+
+`refresh_ahead` runs on the scheduler. Its cache entries are refreshed when
+they are about to stop being fresh, hottest first, so the next visitor gets a
+fresh hit instead of paying for the upstream call. A run never makes more
+than REFRESH_AHEAD_BUDGET upstream fetches, and Hypixel fetches use the
+"refresh" quota priority, which only takes quota nobody else needs.
+"""
+
+import asyncio
+import logging
+import os
+from collections import Counter
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Awaitable, Callable
+
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+
+from cache_envelope import CachePolicy, Cached
+from cache_namespaces import POPULARITY, REFRESH_AHEAD_LOCK
+from hypixel_manager import (
+    HYPIXEL_POLICY,
+    build_hypixel_data,
+    fetch_hypixel_guild,
+    get_hypixel_guild_cache,
+    get_hypixel_player_cache,
+)
+from minecraft_manager import (
+    MINECRAFT_POLICY,
+    fetch_minecraft_data,
+    get_minecraft_cache,
+)
+from single_flight import single_flight
+from upstream_clients import UpstreamClients
+from wynncraft_manager import (
+    WYNNCRAFT_POLICY,
+    fetch_wynncraft_player_data,
+    get_wynncraft_player_cache,
+)
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 10
+REFRESH_INTERVAL_SECONDS = 60
+POPULARITY_HALF_LIFE_SECONDS = 60 * 60
+# applied once per refresh run
+DECAY_FACTOR = 0.5 ** (REFRESH_INTERVAL_SECONDS / POPULARITY_HALF_LIFE_SECONDS)
+# entries below this have decayed to nothing and are dropped
+MIN_SCORE = 0.1
+MAX_TRACKED = 1000
+
+# most viewed entries of each kind that are considered for refreshing
+REFRESH_AHEAD_TOP = int(os.getenv("REFRESH_AHEAD_TOP", "50"))
+# upstream fetches per run, across all kinds
+REFRESH_AHEAD_BUDGET = int(os.getenv("REFRESH_AHEAD_BUDGET", "20"))
+REFRESH_AHEAD_CONCURRENCY = 4
+# a single view isn't popular
+REFRESH_AHEAD_MIN_SCORE = 2.0
+# refreshed once they are this close to going stale, a little over one run
+# so an entry doesn't go stale between two runs
+REFRESH_AHEAD_LEAD_SECONDS = REFRESH_INTERVAL_SECONDS + 30
+
+
+@dataclass(frozen=True)
+class Warmable:
+    # same key as the manager's serve_cached, so the refresh coalesces with
+    # requests for the same entry
+    provider: str
+    resource: str
+    policy: CachePolicy
+    read_cache: Callable[[str, Redis], Awaitable[Cached[Any] | None]]
+    fetch: Callable[[str, UpstreamClients, Redis], Awaitable[Any]]
+
+
+WARMABLE: dict[str, Warmable] = {
+    "minecraft": Warmable(
+        "mojang",
+        "profile",
+        MINECRAFT_POLICY,
+        get_minecraft_cache,
+        fetch_minecraft_data,
+    ),
+    "hypixel": Warmable(
+        "hypixel",
+        "player",
+        HYPIXEL_POLICY,
+        # only the player part, the guild is kept warm on its own since the
+        # player route counts a view of it too
+        get_hypixel_player_cache,
+        lambda uuid, http_client, redis: build_hypixel_data(
+            uuid, None, http_client, redis, priority="refresh"
+        ),
+    ),
+    "hypixel_guild": Warmable(
+        "hypixel",
+        "guild",
+        HYPIXEL_POLICY,
+        get_hypixel_guild_cache,
+        lambda id, http_client, redis: fetch_hypixel_guild(
+            id, http_client, redis, priority="refresh"
+        ),
+    ),
+    "wynncraft": Warmable(
+        "wynncraft",
+        "player",
+        WYNNCRAFT_POLICY,
+        get_wynncraft_player_cache,
+        fetch_wynncraft_player_data,
+    ),
+}
+
+_pending: Counter[tuple[str, str]] = Counter()
+
+
+def record(kind: str, id: str) -> None:
+    """Counts a view of `id`, a key of WARMABLE as `kind`"""
+    _pending[(kind, id)] += 1
+
+
+async def flush_popularity(redis: Redis) -> None:
+    if not _pending:
+        return
+    counts = dict(_pending)
+    _pending.clear()
+
+    pipe = redis.pipeline(transaction=False)
+    for (kind, id), views in counts.items():
+        pipe.zincrby(POPULARITY.key(kind), views, id)
+    try:
+        await pipe.execute()
+    except RedisError as e:
+        # a few lost views only make the ranking slightly less accurate
+        logger.warning(f"Couldn't flush popularity counts: {e}")
+
+
+async def decay_popularity(redis: Redis) -> None:
+    pipe = redis.pipeline(transaction=False)
+    for kind in WARMABLE:
+        key = POPULARITY.key(kind)
+        pipe.zunionstore(key, {key: DECAY_FACTOR})
+        pipe.zremrangebyscore(key, "-inf", MIN_SCORE)
+        pipe.zremrangebyrank(key, 0, -MAX_TRACKED - 1)
+    await pipe.execute()
+
+
+def needs_refresh(warmable: Warmable, cached: Cached | None) -> bool:
+    # missing entries have either never been fetched or expired for good,
+    # there's nothing to keep warm
+    if cached is None:
+        return False
+    return cached.age >= warmable.policy.fresh_seconds - REFRESH_AHEAD_LEAD_SECONDS
+
+
+async def refresh_entry(
+    kind: str, id: str, http_client: UpstreamClients, redis: Redis
+) -> bool:
+    """Refreshes one entry if it still needs it, True if it did"""
+    warmable = WARMABLE[kind]
+    # a request may have refreshed it in the meantime
+    if not needs_refresh(warmable, await warmable.read_cache(id, redis)):
+        return False
+    # requests for the entry can join this flight, so it has to produce the
+    # same value as their fetch does, hence the manager's fetch as is
+    await single_flight(
+        redis,
+        (warmable.provider, warmable.resource, id),
+        partial(warmable.fetch, id, http_client, redis),
+    )
+    return True
+
+
+async def refresh_candidates(redis: Redis) -> list[tuple[float, str, str]]:
+    """(score, kind, id) of the popular entries about to go stale, hottest first"""
+    pipe = redis.pipeline(transaction=False)
+    for kind in WARMABLE:
+        pipe.zrevrangebyscore(
+            POPULARITY.key(kind),
+            "+inf",
+            REFRESH_AHEAD_MIN_SCORE,
+            start=0,
+            num=REFRESH_AHEAD_TOP,
+            withscores=True,
+        )
+    rankings = await pipe.execute()
+
+    popular = [
+        (score, kind, raw_id.decode() if isinstance(raw_id, bytes) else raw_id)
+        for kind, ranking in zip(WARMABLE, rankings)
+        for raw_id, score in ranking
+    ]
+    cached = await asyncio.gather(
+        *(WARMABLE[kind].read_cache(id, redis) for _, kind, id in popular)
+    )
+    candidates = [
+        entry
+        for entry, entry_cache in zip(popular, cached)
+        if needs_refresh(WARMABLE[entry[1]], entry_cache)
+    ]
+    candidates.sort(reverse=True)
+    return candidates
+
+
+async def refresh_ahead(http_client: UpstreamClients, redis: Redis) -> None:
+    # one worker per interval, the others only contribute their counts
+    try:
+        if not await redis.set(
+            REFRESH_AHEAD_LOCK.key(), "1", nx=True, ex=REFRESH_INTERVAL_SECONDS - 1
+        ):
+            return
+        await decay_popularity(redis)
+        candidates = await refresh_candidates(redis)
+    except RedisError as e:
+        logger.warning(f"Refresh-ahead skipped: {e}")
+        return
+
+    semaphore = asyncio.Semaphore(REFRESH_AHEAD_CONCURRENCY)
+
+    async def refresh(kind: str, id: str) -> bool:
+        async with semaphore:
+            try:
+                return await refresh_entry(kind, id, http_client, redis)
+            except Exception as e:
+                logger.warning(f"Refresh-ahead of {kind} {id} failed: {e}")
+                return False
+
+    results = await asyncio.gather(
+        *(refresh(kind, id) for _, kind, id in candidates[:REFRESH_AHEAD_BUDGET])
+    )
+    if candidates:
+        logger.info(
+            f"Refresh-ahead refreshed {sum(results)} of {len(candidates)} "
+            f"popular entries going stale (budget {REFRESH_AHEAD_BUDGET})"
+        )
@@ -1,14 +1,156 @@
+"""
+rate_limiter.py
+
+Per-IP token buckets. A check can cover several tiers at once (e.g. the
+global per-minute, per-10-minutes and per-day limits); a request is only let
+through when every tier has a token, and then takes one from each.
+
+Two backends:
+
+- memory: buckets live in the worker's own BucketStore, at most
+  RATE_LIMIT_MAX_BUCKETS of them. Every uvicorn worker counts on its own, so
+  with N workers the effective limits are N times higher.
+- redis: buckets live in Redis and all tiers of a check are evaluated in one
+  Lua script, so the limits hold across workers and instances. Buckets expire
+  once they would have refilled completely. If Redis can't be reached the
+  worker falls back to its in-memory buckets.
+
+RATE_LIMIT_BACKEND picks the backend, by default redis in production and
+memory otherwise.
+
+The limits are declared as GLOBAL_TIERS and per route as RateLimit(...)
+dependencies. compile_policy turns them into a CompiledPolicy once at
+startup, and the middleware checks a request's global and route tiers in a
+single check, with the client IP resolved once per request.
+
+A request is let in for one token. Once it's done, whatever else it cost
+(upstream calls, cache misses, CPU time, see request_cost) is charged to the
+global tiers and to the route's tier on `weighted` routes. The buckets can go
+into debt that way, which holds back the client's next requests instead.
+"""
+
 import time
 import math
 import ipaddress
-from typing import Dict, Tuple
-from fastapi import Request, HTTPException
+import logging
+import os
+import re
+import uuid
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Sequence
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.routing import APIRoute
+from starlette.routing import BaseRoute
+
+from bucket_store import BucketStore
+from cache_namespaces import RATE_LIMIT
+from redis_manager import ENV, get_redis
+from request_cost import RequestCost
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Tier:
+    name: str
+    max_tokens: int
+    refill_time_seconds: int
+
+
+# buckets the in-memory limiter keeps before evicting, about 100 bytes each
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "500000"))
+# a day's worth of seconds, the longest tier
+MAX_CLEANUP_TICKS = 86400
+
+GLOBAL_TIERS = (
+    # 180/minute — broad per-minute ceiling for every IP
+    Tier("global_1m", 180, 60),
+    # 1000/10 minutes
+    Tier("global_10m", 1000, 600),
+    # 10000/day
+    Tier("global_1d", 10000, 86400),
+)
+
+# normalized client IPs remembered, a request's IP is usually a recent one
+NORMALIZED_IP_CACHE_SIZE = 4096
+
+# how long a concurrency slot outlives a worker that died holding it
+CONCURRENCY_SLOT_TTL_SECONDS = 60
+# requests over a concurrency cap are let in again as soon as one finishes
+CONCURRENCY_RETRY_AFTER_SECONDS = 1
+
+# KEYS: one bucket per tier
+# ARGV: now, cost, 1 to take the cost even from buckets that don't have it,
+# then max_tokens and refill_time_seconds for each tier
+# returns {allowed, retry_after_seconds}
+TOKEN_BUCKET_SCRIPT = """
+local now = tonumber(ARGV[1])
+local cost = tonumber(ARGV[2])
+local force = ARGV[3] == "1"
+local levels = {}
+local rates = {}
+local retry_after = 0
+
+for i = 1, #KEYS do
+    local max_tokens = tonumber(ARGV[i * 2 + 2])
+    local rate = max_tokens / tonumber(ARGV[i * 2 + 3])
+    local bucket = redis.call("hmget", KEYS[i], "tokens", "updated_at")
+    local tokens = tonumber(bucket[1])
+    if tokens == nil then
+        tokens = max_tokens
+    else
+        local elapsed = math.max(now - tonumber(bucket[2]), 0)
+        tokens = math.min(tokens + elapsed * rate, max_tokens)
+    end
+    levels[i] = tokens
+    rates[i] = rate
+    if tokens < 1 then
+        retry_after = math.max(retry_after, math.ceil((1 - tokens) / rate))
+    end
+end
+
+local allowed = retry_after == 0
+for i = 1, #KEYS do
+    local tokens = levels[i]
+    if allowed or force then
+        tokens = tokens - cost
+    end
+    redis.call("hset", KEYS[i], "tokens", tokens, "updated_at", now)
+    -- a bucket that has refilled completely is the same as no bucket
+    local max_tokens = tonumber(ARGV[i * 2 + 2])
+    local full_in = math.ceil((max_tokens - tokens) / rates[i])
+    redis.call("expire", KEYS[i], math.max(full_in, 1))
+end
+
+if allowed then
+    return {1, 0}
+end
+return {0, retry_after}
+"""
+
+# KEYS: the slot holders, a sorted set scored by when they took the slot
+# ARGV: limit, now, ttl, holder
+ACQUIRE_SLOT_SCRIPT = """
+local now = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+-- holders a dead worker or a cancelled release never gave back
+redis.call("zremrangebyscore", KEYS[1], "-inf", now - ttl)
+if redis.call("zcard", KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call("zadd", KEYS[1], now, ARGV[4])
+redis.call("expire", KEYS[1], ttl)
+return 1
+"""
 
 
 class TokenBucketLimiter:
-    def __init__(self):
-        # Dictionary format: { "IP:Category": (tokens_remaining, last_update_time) }
-        self.buckets: Dict[str, Tuple[float, float]] = {}
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        # buckets per (IP, category), see bucket_store for the layout
+        self.buckets = BucketStore(max_buckets, time.time())
+        # requests in progress per "IP:name", for concurrency caps
+        self.in_flight: Dict[str, int] = {}
 
     def check_limit(
         self, key: str, max_tokens: int, refill_time_seconds: int
@@ -21,45 +163,183 @@ class TokenBucketLimiter:
         Returns:
             (allowed, retry_after_seconds) — retry_after is 0 when allowed.
         """
+        return self.check_tiers(key, (Tier("", max_tokens, refill_time_seconds),))
+
+    def check_tiers(
+        self, key: str, tiers: Sequence[Tier], cost: float = 1.0, force: bool = False
+    ) -> tuple[bool, int]:
+        """
+        Like check_limit for several tiers of `key` at once. The cost is only
+        taken when every tier has a token, the retry_after is the longest wait.
+        With `force` the cost is taken regardless, buckets can go into debt.
+        """
         now = time.time()
-        rate = max_tokens / refill_time_seconds
+        buckets = self.buckets
+        buckets.expire(now)
+        buckets.make_room(len(tiers))
 
-        if key not in self.buckets:
-            # First request, start with max_tokens - 1
-            self.buckets[key] = (float(max_tokens - 1), now)
-            return True, 0
+        bucket_ids = buckets.bucket_ids(key, [tier.name for tier in tiers])
+        slots = buckets.find(bucket_ids)
+        tokens_left = buckets.tokens
+        updated_at = buckets.updated_at
+        levels = []
+        retry_after = 0
 
-        tokens, last_update = self.buckets[key]
+        for tier, slot in zip(tiers, slots):
+            rate = tier.max_tokens / tier.refill_time_seconds
+            if slot is None:
+                # new or refilled and dropped
+                tokens = float(tier.max_tokens)
+            else:
+                # Add regenerated tokens over the elapsed time
+                elapsed = now - updated_at[slot]
+                tokens = min(tokens_left[slot] + elapsed * rate, tier.max_tokens)
+            levels.append(tokens)
+            if tokens < 1.0:
+                # Seconds until one full token will have regenerated
+                retry_after = max(retry_after, math.ceil((1.0 - tokens) / rate))
 
-        # Add regenerated tokens over the elapsed time
-        elapsed = now - last_update
-        tokens = min(tokens + elapsed * rate, float(max_tokens))
+        allowed = retry_after == 0
+        for tier, bucket_id, slot, tokens in zip(tiers, bucket_ids, slots, levels):
+            if allowed or force:
+                tokens -= cost
+            rate = tier.max_tokens / tier.refill_time_seconds
+            full_at = now + (tier.max_tokens - tokens) / rate
+            buckets.put(bucket_id, slot, tokens, now, full_at)
+        return allowed, retry_after
 
-        if tokens >= 1.0:
-            # We have enough tokens, consume one
-            self.buckets[key] = (tokens - 1.0, now)
-            return True, 0
-        else:
-            # Not enough tokens. Update timestamp but keep tokens as-is.
-            self.buckets[key] = (tokens, now)
-            # Seconds until one full token will have regenerated
-            retry_after = math.ceil((1.0 - tokens) / rate)
-            return False, retry_after
-
-    def cleanup(self, max_idle_seconds: int = 86400):
-        """Removes bucket tracking for IPs that haven't made a request in `max_idle_seconds`."""
-        now = time.time()
-        keys_to_delete = [
-            k for k, v in self.buckets.items() if (now - v[1]) > max_idle_seconds
-        ]
-        for k in keys_to_delete:
-            del self.buckets[k]
+    async def check(self, key: str, tiers: Sequence[Tier]) -> tuple[bool, int]:
+        return self.check_tiers(key, tiers)
+
+    async def charge(self, key: str, tiers: Sequence[Tier], cost: float) -> None:
+        """Takes `cost` more tokens for a request that has already been let in"""
+        self.check_tiers(key, tiers, cost, force=True)
+
+    def acquire_slot(self, key: str, name: str, limit: int) -> str | None:
+        slot_key = f"{key}:{name}"
+        in_flight = self.in_flight.get(slot_key, 0)
+        if in_flight >= limit:
+            return None
+        self.in_flight[slot_key] = in_flight + 1
+        return slot_key
+
+    def release_slot(self, key: str, name: str) -> None:
+        slot_key = f"{key}:{name}"
+        in_flight = self.in_flight.pop(slot_key, 0) - 1
+        if in_flight > 0:
+            self.in_flight[slot_key] = in_flight
+
+    async def acquire(self, key: str, name: str, limit: int) -> str | None:
+        """
+        Takes one of `limit` concurrent request slots. Returns the holder to
+        release it with, None if all are in use.
+        """
+        return self.acquire_slot(key, name, limit)
+
+    async def release(self, key: str, name: str, holder: str) -> None:
+        self.release_slot(key, name)
+
+    def cleanup(self):
+        """
+        Drops every bucket that has refilled by now. Checks already do this a
+        few seconds at a time, this catches up after quiet periods.
+        """
+        self.buckets.expire(time.time(), max_ticks=MAX_CLEANUP_TICKS)
+
+
+class RedisTokenBucketLimiter:
+    """Token buckets shared by every worker through Redis"""
+
+    def __init__(self, fallback: TokenBucketLimiter):
+        # used while Redis is unreachable, limits are per worker again then
+        self.fallback = fallback
+        # holders of slots taken from the fallback, released there too
+        self.fallback_holders: set[str] = set()
+
+    async def _eval_buckets(
+        self, key: str, tiers: Sequence[Tier], cost: float, force: bool
+    ) -> tuple[bool, int]:
+        # the hash tag keeps an IP's buckets in one slot on Redis Cluster
+        keys = [RATE_LIMIT.key(f"{{{key}}}:{tier.name}") for tier in tiers]
+        args = []
+        for tier in tiers:
+            args += [tier.max_tokens, tier.refill_time_seconds]
+
+        try:
+            redis = await get_redis()
+            allowed, retry_after = await redis.eval(
+                TOKEN_BUCKET_SCRIPT,
+                len(keys),
+                *keys,
+                time.time(),
+                cost,
+                1 if force else 0,
+                *args,
+            )
+        except Exception as e:
+            logger.warning(f"Couldn't check rate limit in Redis: {e}")
+            return self.fallback.check_tiers(key, tiers, cost, force)
+        return int(allowed) == 1, int(retry_after)
 
+    async def check(self, key: str, tiers: Sequence[Tier]) -> tuple[bool, int]:
+        return await self._eval_buckets(key, tiers, 1.0, False)
+
+    async def charge(self, key: str, tiers: Sequence[Tier], cost: float) -> None:
+        await self._eval_buckets(key, tiers, cost, True)
+
+    async def acquire(self, key: str, name: str, limit: int) -> str | None:
+        slot_key = RATE_LIMIT.key(f"{{{key}}}:{name}:in_flight")
+        holder = uuid.uuid4().hex
+        try:
+            redis = await get_redis()
+            acquired = await redis.eval(
+                ACQUIRE_SLOT_SCRIPT,
+                1,
+                slot_key,
+                limit,
+                time.time(),
+                CONCURRENCY_SLOT_TTL_SECONDS,
+                holder,
+            )
+        except Exception as e:
+            logger.warning(f"Couldn't take concurrency slot in Redis: {e}")
+            if self.fallback.acquire_slot(key, name, limit) is None:
+                return None
+            self.fallback_holders.add(holder)
+            return holder
+        return holder if int(acquired) == 1 else None
+
+    async def release(self, key: str, name: str, holder: str) -> None:
+        if holder in self.fallback_holders:
+            self.fallback_holders.discard(holder)
+            self.fallback.release_slot(key, name)
+            return
+        slot_key = RATE_LIMIT.key(f"{{{key}}}:{name}:in_flight")
+        try:
+            redis = await get_redis()
+            await redis.zrem(slot_key, holder)
+        except Exception as e:
+            logger.warning(f"Couldn't release concurrency slot in Redis: {e}")
+
+    def cleanup(self):
+        # Redis expires its buckets itself
+        self.fallback.cleanup()
+
+
+RATE_LIMIT_BACKEND = os.getenv(
+    "RATE_LIMIT_BACKEND", "redis" if ENV == "production" else "memory"
+)
 
 # Global instance
-limiter = TokenBucketLimiter()
+if RATE_LIMIT_BACKEND == "redis":
+    limiter = RedisTokenBucketLimiter(TokenBucketLimiter())
+elif RATE_LIMIT_BACKEND == "memory":
+    limiter = TokenBucketLimiter()
+else:
+    raise RuntimeError(f"Unknown RATE_LIMIT_BACKEND {RATE_LIMIT_BACKEND}")
 
 
+@lru_cache(maxsize=NORMALIZED_IP_CACHE_SIZE)
 def normalize_ip(ip: str) -> str:
     """
     Normalizes an IP address for use as a rate-limit key.
@@ -72,8 +352,8 @@ def normalize_ip(ip: str) -> str:
     try:
         addr = ipaddress.ip_address(ip)
         if isinstance(addr, ipaddress.IPv6Address):
-            network = ipaddress.ip_network(f"{ip}/64", strict=False)
-            return str(network.network_address)
+            prefix = int(addr) & ~((1 << 64) - 1)
+            return str(ipaddress.IPv6Address(prefix))
     except ValueError:
         pass
     return ip
@@ -89,39 +369,211 @@ def get_client_ip(request: Request) -> str:
     value (the historical default) would let any caller set an arbitrary IP via
     a crafted header and bypass all limits.
     """
+    # resolved once per request, the middleware and dependencies share it
+    ip = getattr(request.state, "client_ip", None)
+    if ip is not None:
+        return ip
+
     forwarded = request.headers.get("x-forwarded-for")
     if forwarded:
         # Rightmost entry is written by Render's load balancer — not user-controlled
         real_ip = forwarded.split(",")[-1].strip()
-        return normalize_ip(real_ip)
-    raw = request.client.host if request.client else "127.0.0.1"
-    return normalize_ip(raw)
+        ip = normalize_ip(real_ip)
+    else:
+        raw = request.client.host if request.client else "127.0.0.1"
+        ip = normalize_ip(raw)
+    request.state.client_ip = ip
+    return ip
 
 
 class RateLimit:
-    """FastAPI Dependency for Endpoint-Specific Rate Limiting"""
+    """
+    FastAPI Dependency for Endpoint-Specific Rate Limiting
+
+    `weighted` routes are charged the request's cost (see request_cost) in
+    their own tier too, not only in the global ones. `max_concurrent` caps
+    how many requests one IP can have in progress on the route.
+    """
 
-    def __init__(self, limit: int, window_seconds: int = 60, scope: str = ""):
+    def __init__(
+        self,
+        limit: int,
+        window_seconds: int = 60,
+        scope: str = "",
+        weighted: bool = False,
+        max_concurrent: int | None = None,
+    ):
         self.limit = limit
         self.window_seconds = window_seconds
         self.scope = scope
+        self.weighted = weighted
+        self.max_concurrent = max_concurrent
 
-    def __call__(self, request: Request):
-        ip = get_client_ip(request)
-
-        # Determine logical route path (groups parameterised requests like /mojang/{uuid} together)
-        if self.scope:
-            route_path = self.scope
-        else:
-            route = request.scope.get("route")
-            route_path = route.path if route else request.url.path
+    def tier(self, route_path: str) -> Tier:
+        # groups parameterised requests like /mojang/{uuid} together
+        return Tier(self.scope or route_path, self.limit, self.window_seconds)
 
-        key = f"{ip}:{route_path}"
+    async def __call__(self, request: Request):
+        if getattr(request.state, "rate_limit_checked", False):
+            # the middleware checked this route's tier along with the global ones
+            return
 
-        allowed, retry_after = limiter.check_limit(key, self.limit, self.window_seconds)
+        ip = get_client_ip(request)
+        route = request.scope.get("route")
+        tier = self.tier(route.path if route else request.url.path)
+        allowed, retry_after = await limiter.check(ip, (tier,))
         if not allowed:
             raise HTTPException(
                 status_code=429,
                 detail="Too Many Requests",
                 headers={"Retry-After": str(retry_after)},
             )
+
+
+def path_pattern(path: str) -> str:
+    """Regex for a route path like /mojang/{uuid}, matching like starlette's"""
+    parts = re.split(r"\{([^}]+)\}", path)
+    pattern = ""
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            pattern += re.escape(part)
+        else:
+            pattern += ".*" if part.endswith(":path") else "[^/]+"
+    return pattern
+
+
+@dataclass(frozen=True)
+class RoutePolicy:
+    # a token each on the way in
+    tiers: tuple[Tier, ...]
+    # charged the request's cost beyond that token once it's done
+    cost_tiers: tuple[Tier, ...]
+    # (name, limit) of the per-IP concurrency cap
+    concurrency: tuple[str, int] | None = None
+
+
+class CompiledPolicy:
+    """The RoutePolicy for each request path, global tiers first"""
+
+    def __init__(
+        self, global_tiers: Sequence[Tier], routes: list[tuple[str, RoutePolicy]]
+    ):
+        self.default = RoutePolicy(tuple(global_tiers), tuple(global_tiers))
+        self.static: dict[str, RoutePolicy] = {}
+        self.dynamic: list[RoutePolicy] = []
+        patterns = []
+
+        # in route order, the first route matching a path is the one serving it
+        for path, route_policy in routes:
+            if "{" in path:
+                patterns.append(f"(?P<r{len(self.dynamic)}>{path_pattern(path)})")
+                self.dynamic.append(route_policy)
+                continue
+            shadowed = any(re.fullmatch(pattern, path) for pattern in patterns)
+            if not shadowed:
+                self.static.setdefault(path, route_policy)
+        self.pattern = re.compile("|".join(patterns)) if patterns else None
+
+    def route_for(self, path: str) -> RoutePolicy:
+        route_policy = self.static.get(path)
+        if route_policy is not None:
+            return route_policy
+        if self.pattern is not None:
+            match = self.pattern.fullmatch(path)
+            if match is not None:
+                return self.dynamic[int(match.lastgroup[1:])]
+        # unknown paths still count towards the global limits
+        return self.default
+
+    def tiers_for(self, path: str) -> tuple[Tier, ...]:
+        return self.route_for(path).tiers
+
+
+def compile_route(
+    path: str, limit: RateLimit | None, global_tiers: tuple[Tier, ...]
+) -> RoutePolicy:
+    if limit is None:
+        return RoutePolicy(global_tiers, global_tiers)
+    tier = limit.tier(path)
+    concurrency = None
+    if limit.max_concurrent is not None:
+        concurrency = (tier.name, limit.max_concurrent)
+    return RoutePolicy(
+        global_tiers + (tier,),
+        global_tiers + (tier,) if limit.weighted else global_tiers,
+        concurrency,
+    )
+
+
+def compile_policy(
+    routes: list[BaseRoute], global_tiers: Sequence[Tier] = GLOBAL_TIERS
+) -> CompiledPolicy:
+    compiled = []
+    for route in routes:
+        if not isinstance(route, APIRoute):
+            continue
+        limits = [
+            dependency.dependency
+            for dependency in route.dependencies
+            if isinstance(dependency.dependency, RateLimit)
+        ]
+        limit = limits[0] if limits else None
+        compiled.append(
+            (route.path, compile_route(route.path, limit, tuple(global_tiers)))
+        )
+    return CompiledPolicy(global_tiers, compiled)
+
+
+def get_policy(app: FastAPI) -> CompiledPolicy:
+    policy = getattr(app.state, "rate_limit_policy", None)
+    if policy is None:
+        # normally compiled at startup, see main.lifespan
+        policy = app.state.rate_limit_policy = compile_policy(app.routes)
+    return policy
+
+
+async def check_request(request: Request) -> tuple[bool, int]:
+    """
+    Checks the global tiers and the route's own tier of a request at once,
+    and takes a concurrency slot on routes that have a cap. Returns
+    (allowed, retry_after_seconds) like check_limit, retry_after is the wait
+    until every exhausted tier has a token again.
+
+    Every allowed request has to be passed to `settle_request` once it's done.
+    """
+    ip = get_client_ip(request)
+    route_policy = get_policy(request.app).route_for(request.scope["path"])
+    request.state.rate_limit_route = route_policy
+    request.state.rate_limit_checked = True
+
+    request.state.rate_limit_slot = None
+    if route_policy.concurrency is not None:
+        holder = await limiter.acquire(ip, *route_policy.concurrency)
+        if holder is None:
+            request.state.rate_limit_route = None
+            return False, CONCURRENCY_RETRY_AFTER_SECONDS
+        request.state.rate_limit_slot = holder
+
+    allowed, retry_after = await limiter.check(ip, route_policy.tiers)
+    if not allowed:
+        if route_policy.concurrency is not None:
+            await limiter.release(ip, route_policy.concurrency[0], holder)
+        request.state.rate_limit_route = None
+    return allowed, retry_after
+
+
+async def settle_request(request: Request, cost: RequestCost) -> None:
+    """Charges what the request cost beyond its first token, frees its slot"""
+    route_policy: RoutePolicy | None = getattr(request.state, "rate_limit_route", None)
+    if route_policy is None:
+        return
+    request.state.rate_limit_route = None
+    ip = get_client_ip(request)
+
+    if route_policy.concurrency is not None:
+        await limiter.release(
+            ip, route_policy.concurrency[0], request.state.rate_limit_slot
+        )
+    extra = cost.tokens() - 1.0
+    if extra > 0:
+        await limiter.charge(ip, route_policy.cost_tiers, extra)
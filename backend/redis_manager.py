@@ -31,10 +31,10 @@ async def get_redis():
             health_check_interval=30,
         )
     else:
+        # bytes like in production, cache values are binary (see cache_codec)
         redis = Redis(
             host="localhost",
             port=6379,
-            decode_responses=True,
         )
 
     return redis
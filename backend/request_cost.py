@@ -0,0 +1,84 @@
+"""
+request_cost.py
+
+What a request actually cost to answer. The rate limit middleware starts a
+RequestCost for every request; upstream_clients counts the calls it makes,
+serve_cached the cache misses and the image renderers their CPU time, all
+through a ContextVar so handlers don't have to pass anything around.
+
+Once the response is ready, rate_limiter charges the request's `tokens()`
+beyond the one it was let in with, so a guild page that fans out to 50
+Mojang lookups counts for more than a cached max_content hit.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import Context, ContextVar, copy_context
+from dataclasses import dataclass
+from typing import Iterator
+
+# tokens per unit of work, a request that only reads the cache costs 1
+COST_PER_UPSTREAM_CALL = 1.0
+COST_PER_CACHE_MISS = 0.25
+COST_PER_CPU_SECOND = 200.0
+# so one pathological request can't lock a client out for long
+MAX_REQUEST_COST = 10.0
+
+
+@dataclass
+class RequestCost:
+    upstream_calls: int = 0
+    cache_misses: int = 0
+    cpu_seconds: float = 0.0
+
+    def tokens(self) -> float:
+        cost = (
+            self.upstream_calls * COST_PER_UPSTREAM_CALL
+            + self.cache_misses * COST_PER_CACHE_MISS
+            + self.cpu_seconds * COST_PER_CPU_SECOND
+        )
+        return min(max(cost, 1.0), MAX_REQUEST_COST)
+
+
+_request_cost: ContextVar[RequestCost | None] = ContextVar("request_cost", default=None)
+
+
+def track_request_cost() -> RequestCost:
+    """Called once per request, the returned RequestCost adds up as work is done"""
+    cost = RequestCost()
+    _request_cost.set(cost)
+    return cost
+
+
+def add_upstream_call() -> None:
+    cost = _request_cost.get()
+    if cost is not None:
+        cost.upstream_calls += 1
+
+
+def add_cache_miss() -> None:
+    cost = _request_cost.get()
+    if cost is not None:
+        cost.cache_misses += 1
+
+
+def untracked_context() -> Context:
+    """The current context minus the request's cost, for background work"""
+    context = copy_context()
+    context.run(_request_cost.set, None)
+    return context
+
+
+@contextmanager
+def measure_cpu() -> Iterator[None]:
+    """
+    Adds the CPU time of the block to the request. Only for blocks that don't
+    await, other tasks' work would be counted too otherwise.
+    """
+    start = time.thread_time()
+    try:
+        yield
+    finally:
+        cost = _request_cost.get()
+        if cost is not None:
+            cost.cpu_seconds += time.thread_time() - start
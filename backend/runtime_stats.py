@@ -0,0 +1,127 @@
+"""
+runtime_stats.py
+
+Process-level health numbers for /v1/status/runtime: how late the event loop
+wakes up, how busy the Postgres and Redis connection pools are, and the hit
+rates of the local caches and how full the telemetry queue is. The load
+test in /loadtest samples this endpoint while it runs, so a slow callback or
+an exhausted pool shows up next to the latency numbers it caused.
+"""
+
+import asyncio
+import time
+from collections import deque
+
+from pydantic import BaseModel
+
+import redis_manager
+from db import DB_MAX_OVERFLOW, DB_POOL_SIZE, engine
+from local_cache import LocalCacheStats, local_cache_stats
+from telemetry_queue import TelemetryQueueStats, telemetry_queue_stats
+
+LAG_CHECK_INTERVAL = 0.1
+# one minute of samples at the interval above
+LAG_WINDOW = 600
+
+
+class EventLoopLag(BaseModel):
+    samples: int
+    p50_ms: float
+    p99_ms: float
+    max_ms: float
+
+
+class DatabasePoolStats(BaseModel):
+    size: int
+    checked_out: int
+    overflow: int
+    capacity: int
+    saturation: float
+
+
+class RedisPoolStats(BaseModel):
+    created: int
+    in_use: int
+    available: int
+
+
+class RuntimeStats(BaseModel):
+    uptime_seconds: float
+    tasks: int
+    event_loop_lag: EventLoopLag
+    database_pool: DatabasePoolStats
+    redis_pool: RedisPoolStats | None
+    local_caches: list[LocalCacheStats]
+    telemetry_queue: TelemetryQueueStats
+
+
+_started_at = time.monotonic()
+_lag_samples: deque[float] = deque(maxlen=LAG_WINDOW)
+
+
+async def monitor_event_loop_lag() -> None:
+    """
+    Sleeps for LAG_CHECK_INTERVAL over and over and records how much later
+    than asked for it woke up. Anything blocking the loop (sync I/O, heavy
+    JSON, a long pure-Python loop) shows up as lag.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + LAG_CHECK_INTERVAL
+        await asyncio.sleep(LAG_CHECK_INTERVAL)
+        _lag_samples.append(max(0.0, loop.time() - expected))
+
+
+def _percentile(ordered: list[float], fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def event_loop_lag() -> EventLoopLag:
+    ordered = sorted(_lag_samples)
+    return EventLoopLag(
+        samples=len(ordered),
+        p50_ms=round(_percentile(ordered, 0.5) * 1000, 2),
+        p99_ms=round(_percentile(ordered, 0.99) * 1000, 2),
+        max_ms=round(ordered[-1] * 1000, 2) if ordered else 0.0,
+    )
+
+
+def database_pool() -> DatabasePoolStats:
+    pool = engine.pool
+    capacity = DB_POOL_SIZE + DB_MAX_OVERFLOW
+    checked_out = pool.checkedout()  # type: ignore[attr-defined]
+    return DatabasePoolStats(
+        size=pool.size(),  # type: ignore[attr-defined]
+        checked_out=checked_out,
+        overflow=max(0, pool.overflow()),  # type: ignore[attr-defined]
+        capacity=capacity,
+        saturation=round(checked_out / capacity, 3),
+    )
+
+
+def redis_pool() -> RedisPoolStats | None:
+    # the client is created lazily by the first request that needs it
+    if redis_manager.redis is None:
+        return None
+    pool = redis_manager.redis.connection_pool
+    in_use = len(pool._in_use_connections)
+    available = len(pool._available_connections)
+    return RedisPoolStats(
+        created=in_use + available,
+        in_use=in_use,
+        available=available,
+    )
+
+
+def runtime_stats() -> RuntimeStats:
+    return RuntimeStats(
+        uptime_seconds=round(time.monotonic() - _started_at, 1),
+        tasks=len(asyncio.all_tasks()),
+        event_loop_lag=event_loop_lag(),
+        database_pool=database_pool(),
+        redis_pool=redis_pool(),
+        local_caches=local_cache_stats(),
+        telemetry_queue=telemetry_queue_stats(),
+    )
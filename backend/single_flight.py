@@ -0,0 +1,132 @@
+"""
+single_flight.py
+
+Coalesces identical in-flight upstream fetches. Concurrent callers asking for the
+same (provider, resource, id) await one shared fetch, and therefore one cache
+write, instead of each missing Redis and calling the upstream on their own.
+
+Inside a worker the fetch runs as a single asyncio task that every caller awaits.
+Across uvicorn workers a short Redis lock marks the fetch as in progress; the
+other workers wait for it to clear and then read what the leader cached.
+"""
+
+import asyncio
+import logging
+import uuid
+from functools import partial
+from typing import Awaitable, Callable, TypeVar
+
+from redis.asyncio import Redis
+
+from cache_namespaces import SINGLE_FLIGHT_LOCK
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# upstream clients time out after 10s, so a lock older than that is abandoned
+LOCK_TTL_MS = 10_000
+LOCK_POLL_SECONDS = 0.05
+
+# only delete the lock if we still own it, it may have expired and been re-taken
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+_in_flight: dict[str, asyncio.Task] = {}
+
+
+def _forget(flight_key: str, task: asyncio.Task) -> None:
+    if _in_flight.get(flight_key) is task:
+        del _in_flight[flight_key]
+    # every caller may have been cancelled, so retrieve the exception here
+    # to avoid "exception was never retrieved" warnings
+    if not task.cancelled():
+        task.exception()
+
+
+async def _wait_for_lock(redis: Redis, lock_key: str) -> None:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LOCK_TTL_MS / 1000
+    while loop.time() < deadline:
+        await asyncio.sleep(LOCK_POLL_SECONDS)
+        try:
+            if not await redis.exists(lock_key):
+                return
+        except Exception as e:
+            logger.warning(f"Couldn't check single flight lock {lock_key}: {e}")
+            return
+
+
+async def _run_with_lock(
+    redis: Redis, flight_key: str, fetch: Callable[[], Awaitable[T]]
+) -> T:
+    lock_key = SINGLE_FLIGHT_LOCK.key(flight_key)
+    token = uuid.uuid4().hex
+
+    try:
+        acquired = await redis.set(lock_key, token, nx=True, px=LOCK_TTL_MS)
+    except Exception as e:
+        # Redis being unavailable shouldn't stop us from serving the request
+        logger.warning(f"Couldn't take single flight lock {lock_key}: {e}")
+        return await fetch()
+
+    if not acquired:
+        # another worker is already fetching this, once it's done the cache-first
+        # fetch below will find its result
+        await _wait_for_lock(redis, lock_key)
+        return await fetch()
+
+    try:
+        return await fetch()
+    finally:
+        try:
+            await redis.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except Exception as e:
+            logger.warning(f"Couldn't release single flight lock {lock_key}: {e}")
+
+
+async def single_flight(
+    redis: Redis, key: tuple[str, str, str], fetch: Callable[[], Awaitable[T]]
+) -> T:
+    """
+    Runs `fetch` once for all concurrent callers with the same
+    (provider, resource, id) key. `fetch` should read the cache before going
+    upstream, since workers that lose the lock race call it after the winner
+    has filled the cache.
+    """
+    flight_key = ":".join(key)
+    task = _in_flight.get(flight_key)
+    if task is None:
+        task = asyncio.create_task(_run_with_lock(redis, flight_key, fetch))
+        _in_flight[flight_key] = task
+        task.add_done_callback(partial(_forget, flight_key))
+
+    # shielded so a caller disconnecting doesn't cancel the fetch for everyone else
+    return await asyncio.shield(task)
+
+
+async def cached_single_flight(
+    redis: Redis,
+    key: tuple[str, str, str],
+    read_cache: Callable[[], Awaitable[T | None]],
+    fetch: Callable[[], Awaitable[T]],
+) -> T:
+    """
+    Returns the cached value if there is one, otherwise coalesces the upstream
+    fetch. `fetch` is responsible for writing the cache.
+    """
+    cached = await read_cache()
+    if cached is not None:
+        return cached
+
+    async def load() -> T:
+        cached = await read_cache()
+        if cached is not None:
+            return cached
+        return await fetch()
+
+    return await single_flight(redis, key, load)
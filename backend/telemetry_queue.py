@@ -7,25 +7,58 @@ instead of spawning a DB-bound coroutine per request.
 A single long-running background worker drains the queue and flushes to the
 database in batches, so the connection pool is never starved by concurrent
 telemetry writes.
+
+The queue is bounded: when the database can't keep up, new events are dropped
+and counted rather than piling up in memory. Batches are written with a binary
+COPY on the raw asyncpg connection, and the batch size follows the flush
+latency, growing while flushes are quick and shrinking when they slow down.
+On shutdown, `drain` flushes whatever is still queued.
 """
 
 import asyncio
 import logging
+import os
+import time
 from dataclasses import dataclass
 from typing import Optional
 
-from sqlalchemy import text
+from pydantic import BaseModel
 
-from db import AsyncSessionLocal
+import json_codec
+from db import engine
 
 logger = logging.getLogger(__name__)
 
-# Max rows to buffer before forcing a flush even when the timer hasn't fired.
-BATCH_SIZE = 50
+# Events held in memory at most, anything beyond is dropped.
+TELEMETRY_QUEUE_SIZE = int(os.getenv("TELEMETRY_QUEUE_SIZE", "10000"))
+
+# Bounds of the adaptive batch size, it starts at the lower one.
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 2000
+
+# Flushes quicker than half of this grow the batch, slower ones shrink it.
+TARGET_FLUSH_SECONDS = 0.25
 
 # Seconds to wait before flushing a partial batch.
 FLUSH_INTERVAL = 5.0
 
+# How long shutdown waits for the queue to be written out.
+DRAIN_TIMEOUT_SECONDS = 10.0
+
+# At most one "events dropped" warning per this many seconds.
+DROP_LOG_INTERVAL = 60.0
+
+COPY_COLUMNS = [
+    "path",
+    "provider",
+    "status_code",
+    "latency_ms",
+    "cache_hit",
+    "properties",
+    "request_id",
+    "user_agent",
+]
+
 
 @dataclass
 class TelemetryEvent:
@@ -39,8 +72,37 @@ class TelemetryEvent:
     user_agent: Optional[str] = None
 
 
+class TelemetryQueueStats(BaseModel):
+    depth: int
+    capacity: int
+    fill: float
+    max_depth: int
+    enqueued: int
+    dropped: int
+    flushed: int
+    failed: int
+    batch_size: int
+    last_flush_ms: float
+
+
+@dataclass
+class _Counters:
+    enqueued: int = 0
+    dropped: int = 0
+    flushed: int = 0
+    failed: int = 0
+    max_depth: int = 0
+    last_flush_seconds: float = 0.0
+    last_drop_log: float = 0.0
+
+
 # Module-level queue — populated by the middleware, drained by the worker.
-_queue: asyncio.Queue[TelemetryEvent] = asyncio.Queue()
+# None is only ever put by `drain` and tells the worker to finish up.
+_queue: asyncio.Queue[TelemetryEvent | None] = asyncio.Queue(
+    maxsize=TELEMETRY_QUEUE_SIZE
+)
+_counters = _Counters()
+_batch_size = MIN_BATCH_SIZE
 
 
 def enqueue(event: TelemetryEvent) -> None:
@@ -48,81 +110,158 @@ def enqueue(event: TelemetryEvent) -> None:
     try:
         _queue.put_nowait(event)
     except asyncio.QueueFull:
-        # Shouldn't happen with an unbounded queue, but guard anyway.
-        logger.warning("Telemetry queue full — event dropped.")
+        _counters.dropped += 1
+        now = time.monotonic()
+        if now - _counters.last_drop_log >= DROP_LOG_INTERVAL:
+            _counters.last_drop_log = now
+            logger.warning(
+                "Telemetry queue full — %d events dropped so far.", _counters.dropped
+            )
+        return
+    _counters.enqueued += 1
+    _counters.max_depth = max(_counters.max_depth, _queue.qsize())
+
+
+def telemetry_queue_stats() -> TelemetryQueueStats:
+    depth = _queue.qsize()
+    return TelemetryQueueStats(
+        depth=depth,
+        capacity=TELEMETRY_QUEUE_SIZE,
+        fill=round(depth / TELEMETRY_QUEUE_SIZE, 3),
+        max_depth=_counters.max_depth,
+        enqueued=_counters.enqueued,
+        dropped=_counters.dropped,
+        flushed=_counters.flushed,
+        failed=_counters.failed,
+        batch_size=_batch_size,
+        last_flush_ms=round(_counters.last_flush_seconds * 1000, 2),
+    )
+
+
+def _record(e: TelemetryEvent) -> tuple:
+    # SQLAlchemy's jsonb codec on the connection expects the JSON as text
+    properties = (
+        None if e.properties is None else json_codec.dumps(e.properties).decode()
+    )
+    return (
+        e.path,
+        e.provider,
+        e.status_code,
+        e.latency_ms,
+        e.cache_hit,
+        properties,
+        e.request_id,
+        e.user_agent,
+    )
 
 
 async def _flush_batch(batch: list[TelemetryEvent]) -> None:
-    """Insert a batch of telemetry events in a single DB round-trip."""
+    """Write a batch of telemetry events with a single binary COPY."""
     if not batch:
         return
-    rows = [
-        {
-            "path": e.path,
-            "provider": e.provider,
-            "status_code": e.status_code,
-            "latency_ms": e.latency_ms,
-            "cache_hit": e.cache_hit,
-            "properties": e.properties,
-            "request_id": e.request_id,
-            "user_agent": e.user_agent,
-        }
-        for e in batch
-    ]
-    async with AsyncSessionLocal() as session:
-        await session.execute(
-            text(
-                """
-                INSERT INTO telemetry_events
-                    (path, provider, status_code, latency_ms, cache_hit, properties, request_id, user_agent)
-                SELECT
-                    e->>'path',
-                    e->>'provider',
-                    (e->>'status_code')::int,
-                    (e->>'latency_ms')::int,
-                    (e->>'cache_hit')::boolean,
-                    (e->'properties'),
-                    e->>'request_id',
-                    e->>'user_agent'
-                FROM jsonb_array_elements(CAST(:rows AS jsonb)) AS e
-                """
-            ),
-            {"rows": __import__("json").dumps(rows)},
+    records = [_record(e) for e in batch]
+    async with engine.connect() as conn:
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            "telemetry_events", records=records, columns=COPY_COLUMNS
         )
-        await session.commit()
+
+
+def _adapt_batch_size(batch_len: int, seconds: float) -> None:
+    """Double the batch while full batches flush quickly, halve it when slow."""
+    global _batch_size
+    if seconds > TARGET_FLUSH_SECONDS:
+        _batch_size = max(MIN_BATCH_SIZE, _batch_size // 2)
+    elif seconds < TARGET_FLUSH_SECONDS / 2 and batch_len >= _batch_size:
+        _batch_size = min(MAX_BATCH_SIZE, _batch_size * 2)
+
+
+async def _flush(batch: list[TelemetryEvent]) -> None:
+    start = time.perf_counter()
+    try:
+        await _flush_batch(batch)
+    except Exception:
+        _counters.failed += len(batch)
+        logger.exception("Telemetry batch flush failed — %d events lost.", len(batch))
+        # a failing database is a slow one as far as the batch size goes
+        _adapt_batch_size(len(batch), TARGET_FLUSH_SECONDS * 2)
+        return
+    elapsed = time.perf_counter() - start
+    _counters.flushed += len(batch)
+    _counters.last_flush_seconds = elapsed
+    _adapt_batch_size(len(batch), elapsed)
+
+
+async def _collect(batch: list[TelemetryEvent]) -> bool:
+    """
+    Fill `batch` up to the current batch size or until FLUSH_INTERVAL has
+    passed. Returns False once `drain` has asked the worker to stop.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + FLUSH_INTERVAL
+    while len(batch) < _batch_size:
+        # take what's already queued without a wait_for per event
+        while len(batch) < _batch_size and not _queue.empty():
+            event = _queue.get_nowait()
+            if event is None:
+                return False
+            batch.append(event)
+        if len(batch) >= _batch_size:
+            break
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            event = await asyncio.wait_for(_queue.get(), timeout=remaining)
+        except asyncio.TimeoutError:
+            break  # Flush interval elapsed — flush whatever we have.
+        if event is None:
+            return False
+        batch.append(event)
+    return True
 
 
 async def run_worker() -> None:
     """
     Long-running background task started at app startup.
 
-    Collects events from the queue and flushes them to the DB either when
-    BATCH_SIZE is reached or FLUSH_INTERVAL seconds have passed, whichever
-    comes first.
+    Collects events from the queue and flushes them to the DB either when the
+    batch is full or FLUSH_INTERVAL seconds have passed, whichever comes
+    first. Returns after `drain`, once the queue is empty.
     """
     logger.info("Telemetry batch worker started.")
     batch: list[TelemetryEvent] = []
 
-    while True:
-        deadline = asyncio.get_event_loop().time() + FLUSH_INTERVAL
+    running = True
+    while running:
+        running = await _collect(batch)
+        if batch:
+            await _flush(batch)
+            batch.clear()
 
-        # Collect events until we hit the batch cap or the flush interval.
-        while len(batch) < BATCH_SIZE:
-            remaining = deadline - asyncio.get_event_loop().time()
-            if remaining <= 0:
-                break
-            try:
-                event = await asyncio.wait_for(_queue.get(), timeout=remaining)
+    # drain: whatever was enqueued before (or after) the stop marker
+    while not _queue.empty():
+        while len(batch) < _batch_size and not _queue.empty():
+            event = _queue.get_nowait()
+            if event is not None:
                 batch.append(event)
-            except asyncio.TimeoutError:
-                break  # Flush interval elapsed — flush whatever we have.
-
         if batch:
-            try:
-                await _flush_batch(batch)
-            except Exception:
-                logger.exception(
-                    "Telemetry batch flush failed — %d events lost.", len(batch)
-                )
-            finally:
-                batch.clear()
+            await _flush(batch)
+            batch.clear()
+    logger.info("Telemetry batch worker stopped.")
+
+
+async def drain(worker: asyncio.Task, timeout: float = DRAIN_TIMEOUT_SECONDS) -> None:
+    """
+    Called at shutdown in place of cancelling the worker: lets it write out
+    the queued events, then stops it. Gives up after `timeout` seconds.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        # waits for room if the queue is full, the worker is making some
+        await asyncio.wait_for(_queue.put(None), timeout)
+        await asyncio.wait_for(asyncio.shield(worker), max(0.0, deadline - loop.time()))
+    except asyncio.TimeoutError:
+        logger.warning("Telemetry drain timed out — %d events lost.", _queue.qsize())
+        worker.cancel()
@@ -0,0 +1,71 @@
+"""
+texture_store.py
+
+Rendered skin faces and cape crops, stored once per texture instead of once
+per player. textures.minecraft.net URLs end in a hash of the image, so the
+same hash always renders to the same crops: thousands of players with a
+default or shared skin point at one entry, and a player whose skin hash
+hasn't changed since the last refresh needs no download or image work.
+
+Entries are cache_codec maps of raw PNG bytes, in the TEXTURE namespace:
+
+- skin_face:<hash> -> {"face": ...}
+- cape:<hash> -> {"front": ..., "back": ...}
+
+Player entries in minecraft_manager only keep the hashes.
+"""
+
+from redis.asyncio import Redis
+
+import cache_codec
+from cache_namespaces import TEXTURE, get_versioned
+
+# renders of a hash never change, this only bounds unused entries
+TEXTURE_TTL = 60 * 60 * 24 * 30
+
+SKIN_FACE = "skin_face"
+CAPE = "cape"
+
+
+def texture_hash(url: str) -> str:
+    """The hash at the end of a textures.minecraft.net URL"""
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+
+def texture_key(kind: str, hash: str) -> str:
+    """The entry's id within the TEXTURE namespace"""
+    return f"{kind}:{hash}"
+
+
+async def get_textures(
+    redis: Redis, keys: list[str], touch: bool = False
+) -> list[dict[str, bytes] | None]:
+    """
+    Looks up texture_key()s in one round trip, None where missing. With
+    `touch` the entries found get a fresh TTL, for when a player entry starts
+    referencing them again.
+    """
+    if not keys:
+        return []
+    textures: list[dict[str, bytes] | None] = []
+    current: list[str] = []
+    for key, (raw, previous) in zip(keys, await get_versioned(redis, TEXTURE, keys)):
+        try:
+            textures.append(cache_codec.loads(raw) if raw else None)
+        except ValueError:
+            textures.append(None)
+            continue
+        if raw and not previous:
+            current.append(key)
+
+    # previous versions' entries are left to expire
+    if touch and current:
+        pipe = redis.pipeline()
+        for key in current:
+            pipe.expire(TEXTURE.key(key), TEXTURE_TTL)
+        await pipe.execute()
+    return textures
+
+
+async def set_texture(redis: Redis, key: str, images: dict[str, bytes]) -> None:
+    await redis.set(TEXTURE.key(key), cache_codec.dumps_binary(images), ex=TEXTURE_TTL)
@@ -0,0 +1,284 @@
+"""
+upstream_clients.py
+
+Every upstream provider gets its own httpx.AsyncClient (and therefore its own
+connection pool) so a slow provider can only exhaust its own connections.
+Before this, one shared client meant a Hypixel guild fan-out could occupy the
+whole pool and Mojang lookups would queue up behind it.
+
+API modules receive an UpstreamClients registry and pick the provider they talk
+to, e.g. `http_client.provider("hypixel").get(...)`.
+
+Setting UPSTREAM_OVERRIDE_URL sends every request to that server instead, as
+<override>/<original host>/<original path>; see fake_upstream/server.py.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+import httpx
+from pydantic import BaseModel
+
+import request_cost
+from circuit_breaker import CircuitBreaker, CircuitBreakerStats, MIN_LATENCY_SAMPLES
+
+logger = logging.getLogger(__name__)
+
+# every request adds this much hedge budget, one hedge costs 1.0, so at most
+# 1 in 10 requests gets hedged once the burst allowance is used up
+HEDGE_BUDGET_PER_REQUEST = 0.1
+HEDGE_BUDGET_BURST = 10.0
+
+UPSTREAM_OVERRIDE_URL = os.getenv("UPSTREAM_OVERRIDE_URL")
+
+
+@dataclass(frozen=True)
+class ProviderConfig:
+    name: str
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 5.0
+    read_timeout: float = 10.0
+    # how long a request may wait for a free connection from this provider's pool
+    pool_timeout: float = 5.0
+    http2: bool = True
+    # responses with these statuses count as failures for the circuit breaker
+    failure_statuses: frozenset[int] = frozenset({500, 502, 503, 504})
+    # send a second identical GET when the first one runs past the provider's p95
+    hedge: bool = False
+
+
+PROVIDER_CONFIGS: dict[str, ProviderConfig] = {
+    # api.minecraftservices.com, username -> uuid lookups
+    "mojang": ProviderConfig("mojang", max_connections=20, hedge=True),
+    "sessionserver": ProviderConfig("sessionserver", max_connections=20, hedge=True),
+    # skin and cape downloads, served over plain http so http2 never negotiates
+    "textures": ProviderConfig(
+        "textures",
+        max_connections=30,
+        max_keepalive_connections=15,
+        http2=False,
+        hedge=True,
+    ),
+    "hypixel": ProviderConfig("hypixel", max_connections=20),
+    "wynncraft": ProviderConfig("wynncraft", max_connections=20),
+    "capes": ProviderConfig("capes", max_connections=10, max_keepalive_connections=5),
+    "mcci": ProviderConfig("mcci", max_connections=10, max_keepalive_connections=5),
+    # DonutSMP answers lookups for offline players with a 500
+    "donut": ProviderConfig(
+        "donut",
+        max_connections=10,
+        max_keepalive_connections=5,
+        failure_statuses=frozenset({502, 503, 504}),
+    ),
+}
+
+
+class ProviderStats(BaseModel):
+    provider: str
+    http2: bool
+    max_connections: int
+    connections_open: int
+    connections_idle: int
+    in_flight: int
+    peak_in_flight: int
+    total_requests: int
+    hedges_sent: int
+    hedges_won: int
+    breaker: CircuitBreakerStats
+
+
+class ProviderClient:
+    """
+    Wraps one provider's httpx.AsyncClient, tracking pool occupancy and
+    guarding every request with the provider's circuit breaker
+    """
+
+    def __init__(
+        self,
+        config: ProviderConfig,
+        headers: dict[str, str] | None = None,
+        override_url: str | None = UPSTREAM_OVERRIDE_URL,
+    ):
+        self.config = config
+        self.override_url = override_url.rstrip("/") if override_url else None
+        self.client = httpx.AsyncClient(
+            http2=config.http2,
+            headers=headers,
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                config.read_timeout,
+                connect=config.connect_timeout,
+                pool=config.pool_timeout,
+            ),
+        )
+        self.breaker = CircuitBreaker(config.name, max_timeout=config.read_timeout)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_requests = 0
+        self.hedge_budget = HEDGE_BUDGET_BURST
+        self.hedges_sent = 0
+        self.hedges_won = 0
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        hedge_delay = self.hedge_delay() if method == "GET" else None
+        if hedge_delay is None:
+            return await self.send(method, url, **kwargs)
+        return await self.hedged_send(hedge_delay, method, url, **kwargs)
+
+    def hedge_delay(self) -> float | None:
+        """Seconds to wait before hedging, None if this provider shouldn't hedge yet"""
+        if not self.config.hedge or len(self.breaker.latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        self.hedge_budget = min(
+            HEDGE_BUDGET_BURST, self.hedge_budget + HEDGE_BUDGET_PER_REQUEST
+        )
+        return self.breaker.percentile(0.95)
+
+    async def hedged_send(
+        self, delay: float, method: str, url: str, **kwargs
+    ) -> httpx.Response:
+        """
+        Sends the request, and if it hasn't answered after `delay` seconds sends an
+        identical one. Whichever answers first wins and the other is cancelled.
+        """
+        start = time.monotonic()
+        primary = asyncio.create_task(self.send(method, url, **kwargs))
+        pending = {primary}
+        hedged = False
+        first_error: BaseException | None = None
+        try:
+            _, pending = await asyncio.wait(pending, timeout=delay)
+            if not pending or self.hedge_budget < 1.0:
+                return await primary
+
+            hedged = True
+            self.hedge_budget -= 1.0
+            self.hedges_sent += 1
+            hedge = asyncio.create_task(self.send(method, url, **kwargs))
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedges_won += 1
+                        return task.result()
+                    first_error = first_error or task.exception()
+            assert first_error is not None
+            raise first_error
+        finally:
+            for task in pending:
+                task.cancel()
+            if hedged and primary in pending:
+                # the primary took at least this long; leaving it out would
+                # drop the slowest requests from the p95 that sets the hedge
+                # delay and the p99 that sets the timeout
+                self.breaker.record_latency(time.monotonic() - start)
+
+    def target(self, url: str) -> str:
+        if self.override_url is None:
+            return url
+        parsed = httpx.URL(url)
+        return f"{self.override_url}/{parsed.host}{parsed.raw_path.decode('ascii')}"
+
+    async def send(self, method: str, url: str, **kwargs) -> httpx.Response:
+        # raises UpstreamError straight away while the provider's breaker is open
+        probe = self.breaker.before_request()
+        kwargs.setdefault(
+            "timeout",
+            httpx.Timeout(
+                self.breaker.timeout(),
+                connect=self.config.connect_timeout,
+                pool=self.config.pool_timeout,
+            ),
+        )
+
+        self.in_flight += 1
+        self.total_requests += 1
+        request_cost.add_upstream_call()
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        start = time.monotonic()
+        recorded = False
+        try:
+            response = await self.client.request(method, self.target(url), **kwargs)
+            ok = response.status_code not in self.config.failure_statuses
+            self.breaker.record(ok, time.monotonic() - start, probe=probe)
+            recorded = True
+            return response
+        except httpx.TransportError:
+            # timeouts, connection errors and pool exhaustion
+            self.breaker.record(False, probe=probe)
+            recorded = True
+            raise
+        finally:
+            self.in_flight -= 1
+            if probe and not recorded:
+                self.breaker.release_probe()
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def stats(self) -> ProviderStats:
+        # httpx doesn't expose its pool, but the underlying httpcore pool does
+        # have a public `connections` list
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        connections = list(getattr(pool, "connections", []))
+        return ProviderStats(
+            provider=self.config.name,
+            http2=self.config.http2,
+            max_connections=self.config.max_connections,
+            connections_open=len(connections),
+            connections_idle=sum(1 for c in connections if c.is_idle()),
+            in_flight=self.in_flight,
+            peak_in_flight=self.peak_in_flight,
+            total_requests=self.total_requests,
+            hedges_sent=self.hedges_sent,
+            hedges_won=self.hedges_won,
+            breaker=self.breaker.stats(),
+        )
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+class UpstreamClients:
+    """Provider-keyed registry of upstream clients, created once at app startup"""
+
+    def __init__(
+        self,
+        headers: dict[str, str] | None = None,
+        configs: dict[str, ProviderConfig] = PROVIDER_CONFIGS,
+    ):
+        self.clients: dict[str, ProviderClient] = {
+            name: ProviderClient(config, headers) for name, config in configs.items()
+        }
+
+    def provider(self, name: str) -> ProviderClient:
+        try:
+            return self.clients[name]
+        except KeyError:
+            raise ValueError(f"Unknown upstream provider: {name}")
+
+    def stats(self) -> list[ProviderStats]:
+        return [client.stats() for client in self.clients.values()]
+
+    async def aclose(self) -> None:
+        for client in self.clients.values():
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.warning(f"Failed to close {client.config.name} client: {e}")
@@ -5,11 +5,14 @@ import exceptions
 from uuid import UUID
 
 
-def pillow_to_b64(pil_image, img_format="PNG"):
+def pillow_to_bytes(pil_image, img_format="PNG") -> bytes:
     buffered = BytesIO()  # create a virtual buffer
     pil_image.save(buffered, format=img_format)  # save the image to that virtual buffer
+    return buffered.getvalue()  # get the data from that buffer
+
 
-    img_bytes_array = buffered.getvalue()  # get the data from that buffer
+def pillow_to_b64(pil_image, img_format="PNG"):
+    img_bytes_array = pillow_to_bytes(pil_image, img_format)
     base64_encoded_bytes = base64.b64encode(img_bytes_array)
     base64_encoded_string = base64_encoded_bytes.decode("utf-8")
     return base64_encoded_string
@@ -1,15 +1,34 @@
 import httpx
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 import asyncio
+from dataclasses import dataclass
 from utils import dashify_uuid
 from dotenv import load_dotenv
 import os
 from typing import Literal
 import exceptions
 from redis.asyncio import Redis
-import json
 from redis_manager import get_redis
 import re
+from upstream_clients import UpstreamClients
+from cache_envelope import (
+    NOT_MODIFIED,
+    CachePolicy,
+    Cached,
+    NotModified,
+    Validators,
+    read_conditional,
+    read_validators,
+    serve_cached,
+    touch_conditional,
+    write_conditional,
+)
+from cache_namespaces import (
+    WYNNCRAFT_PLAYER_STRUCTURE,
+    WYNNCRAFT_TREE_ABILITIES,
+    WYNNCRAFT_TREE_STRUCTURE,
+)
+from local_cache import invalidate, local_cache, touch
 
 load_dotenv()
 
@@ -26,12 +45,26 @@ BASE_CDN_URL = "https://cdn.wynncraft.com/nextgen/abilities/2.1"
 STATIC_DATA_TTL_SECONDS = 60 * 60 * 4
 DYNAMIC_DATA_TTL_SECONDS = 60 * 5
 
-TREE_STRUCTURE_KEY = "aspexis:wynncraft:tree:structure:"
-TREE_ABILITIES_KEY = "aspexis:wynncraft:tree:abilities:"
-PLAYER_STRUCTURE_KEY = "aspexis:wynncraft:player:structure:"
+STATIC_DATA_POLICY = CachePolicy(
+    fresh_seconds=STATIC_DATA_TTL_SECONDS,
+    revalidate_seconds=60 * 60 * 24,
+    hard_seconds=60 * 60 * 24 * 7,
+)
+DYNAMIC_DATA_POLICY = CachePolicy(
+    fresh_seconds=DYNAMIC_DATA_TTL_SECONDS,
+    revalidate_seconds=60 * 30,
+    hard_seconds=60 * 60 * 24,
+)
+
+
+# structure and abilities of each class, only changes with a Wynncraft update
+STATIC_TREE_CACHE = local_cache("wynncraft_tree", ttl_seconds=60 * 5, max_entries=16)
 
 
 class AbilityTreeNode(BaseModel):
+    # shared between requests by the local cache and the tree index
+    model_config = ConfigDict(frozen=True)
+
     node_type: Literal["ability", "connector"]
     name: str
     pretty_name: str | None  # has html
@@ -88,163 +121,226 @@ def get_node_id(
     return f"{page}:{node_type}:{icon_id}:{x}:{y}:{unlocked}"
 
 
-async def get_ability_tree(
-    uuid: str,
-    character_uuid: str,
-    class_type: str,
-    http_client: httpx.AsyncClient,
-    redis: Redis,
-):
-    if class_type not in VALID_CLASSES:
-        raise exceptions.UnprocessableEntity("invalid wynncraft class")
+# one (page, node type, x, y) position in a tree
+NodeKey = tuple[int, str, int, int]
 
-    structure_task = get_tree_structure(class_type, http_client, redis)
-    abilities_task = get_tree_abilities(class_type, http_client, redis)
-    player_task = get_player_structure(uuid, character_uuid, http_client, redis)
 
-    structure_pages, abilities_pages, player_pages = await asyncio.gather(
-        structure_task,
-        abilities_task,
-        player_task,
-    )
+@dataclass(frozen=True)
+class TreePageIndex:
+    page_number: int
+    # every node locked, in structure order, deduplicated by position
+    locked_nodes: tuple[AbilityTreeNode, ...]
+    # position in locked_nodes of each ability and connector
+    positions: dict[NodeKey, int]
+    # abilities with unlocked=True, prebuilt so a request only has to pick them
+    unlocked_abilities: dict[NodeKey, AbilityTreeNode]
+
+
+@dataclass(frozen=True)
+class ClassTreeIndex:
+    """
+    The static part of a class's tree with the descriptions merged in. Built
+    once per refresh of the structure or abilities, after that each request
+    only overlays the player's unlocked nodes.
+    """
 
-    # ------------------------------------------------------------------
-    # Ability descriptions lookup (abilities ONLY)
+    # the cached pages it was built from, to tell when it is out of date
+    structure_pages: list[AbilityTreePage]
+    abilities_pages: list[AbilityTreePage]
+    pages: tuple[TreePageIndex, ...]
+
+
+# class -> index, rebuilt when the pages behind it change
+_tree_indexes: dict[str, ClassTreeIndex] = {}
+
+
+def build_tree_index(
+    structure_pages: list[AbilityTreePage], abilities_pages: list[AbilityTreePage]
+) -> ClassTreeIndex:
     # Keyed by (page_number, ability_name)
-    # ------------------------------------------------------------------
     ability_descriptions: dict[tuple[int, str], AbilityTreeNode] = {}
-
     for page in abilities_pages:
-        for original_node in page.nodes:
-            node = original_node.model_copy(deep=True)
+        for node in page.nodes:
             ability_descriptions[(page.page_number, node.name)] = node
 
-    # ------------------------------------------------------------------
-    # Unlocked node lookup (abilities AND connectors)
-    # Keyed by (page_number, node_type, x, y)
-    # ------------------------------------------------------------------
-    unlocked_nodes: dict[tuple[int, str, int, int], AbilityTreeNode] = {}
+    pages: list[TreePageIndex] = []
+    for page in structure_pages:
+        locked_nodes: list[AbilityTreeNode] = []
+        positions: dict[NodeKey, int] = {}
+        unlocked_abilities: dict[NodeKey, AbilityTreeNode] = {}
 
-    for page in player_pages:
         for node in page.nodes:
-            key = (
-                page.page_number,
-                node.node_type,
-                node.x,
-                node.y,
+            key = (page.page_number, node.node_type, node.x, node.y)
+            if key in positions:
+                continue
+            positions[key] = len(locked_nodes)
+
+            if node.node_type == "connector":
+                locked_nodes.append(
+                    node.model_copy(
+                        update={
+                            "unlocked": False,
+                            "node_id": get_node_id(
+                                page.page_number,
+                                node.node_type,
+                                node.icon_id,
+                                False,
+                                node.x,
+                                node.y,
+                            ),
+                            "icon_url": get_icon_url(
+                                node.node_type, node.icon_id, False
+                            ),
+                        }
+                    )
+                )
+                continue
+
+            # Attach descriptions to abilities
+            desc_node = ability_descriptions.get((page.page_number, node.name))
+            described: dict = {}
+            if desc_node:
+                described = {
+                    "pretty_name": desc_node.pretty_name,
+                    "description": desc_node.description,
+                }
+            for unlocked in (False, True):
+                variant = node.model_copy(
+                    update={
+                        **described,
+                        "unlocked": unlocked,
+                        "node_id": get_node_id(
+                            page.page_number,
+                            node.node_type,
+                            node.icon_id,
+                            unlocked,
+                            node.x,
+                            node.y,
+                        ),
+                        "icon_url": get_icon_url(
+                            node.node_type, node.icon_id, unlocked
+                        ),
+                    }
+                )
+                if unlocked:
+                    unlocked_abilities[key] = variant
+                else:
+                    locked_nodes.append(variant)
+
+        pages.append(
+            TreePageIndex(
+                page_number=page.page_number,
+                locked_nodes=tuple(locked_nodes),
+                positions=positions,
+                unlocked_abilities=unlocked_abilities,
             )
-            unlocked_nodes[key] = node
+        )
 
-    # ------------------------------------------------------------------
-    # Merge structure + descriptions + unlock state
-    # ------------------------------------------------------------------
-    merged_pages: list[AbilityTreePage] = []
+    return ClassTreeIndex(structure_pages, abilities_pages, tuple(pages))
 
-    for page in structure_pages:
-        merged_nodes: list[AbilityTreeNode] = []
-        seen: set[tuple[str, int, int]] = set()
 
-        for original_node in page.nodes:
-            node = original_node.model_copy(deep=True)
+def get_tree_index(
+    class_type: str,
+    structure_pages: list[AbilityTreePage],
+    abilities_pages: list[AbilityTreePage],
+) -> ClassTreeIndex:
+    # the local cache hands out the same page lists until an entry is
+    # refreshed, so identity is enough to tell whether the index still holds
+    index = _tree_indexes.get(class_type)
+    if (
+        index is None
+        or index.structure_pages is not structure_pages
+        or index.abilities_pages is not abilities_pages
+    ):
+        index = build_tree_index(structure_pages, abilities_pages)
+        _tree_indexes[class_type] = index
+    return index
+
+
+def overlay_unlocked(
+    index: ClassTreeIndex, player_pages: list[AbilityTreePage]
+) -> list[AbilityTreePage]:
+    """
+    Puts the player's unlocked nodes on top of the locked tree. Unlocked
+    abilities replace their locked variant, unlocked connectors (which can
+    have a different icon than the structure's) are added after the locked
+    one.
+    """
+    unlocked_nodes: dict[int, list[AbilityTreeNode]] = {}
+    for page in player_pages:
+        unlocked_nodes.setdefault(page.page_number, []).extend(page.nodes)
 
-            key = (node.node_type, node.x, node.y)
-            if key in seen:
+    merged_pages: list[AbilityTreePage] = []
+    for page in index.pages:
+        nodes = list(page.locked_nodes)
+        connector_inserts: list[tuple[int, AbilityTreeNode]] = []
+
+        # a player page can list the same node twice, the last one counts
+        player_nodes = {
+            (page.page_number, node.node_type, node.x, node.y): node
+            for node in unlocked_nodes.get(page.page_number, ())
+        }
+        for key, unlocked_node in player_nodes.items():
+            position = page.positions.get(key)
+            if position is None:
                 continue
-            seen.add(key)
-
-            lookup_key = (
-                page.page_number,
-                node.node_type,
-                node.x,
-                node.y,
-            )
+            if unlocked_node.node_type == "ability":
+                nodes[position] = page.unlocked_abilities[key]
+            else:
+                connector_inserts.append((position, unlocked_node))
 
-            is_unlocked = lookup_key in unlocked_nodes
-
-            if node.node_type == "ability":
-                # Attach descriptions to abilities
-                desc_node = ability_descriptions.get((page.page_number, node.name))
-                if desc_node:
-                    node.pretty_name = desc_node.pretty_name
-                    node.description = desc_node.description
-
-                node.unlocked = is_unlocked
-                node.node_id = get_node_id(
-                    page.page_number,
-                    node.node_type,
-                    node.icon_id,
-                    node.unlocked,
-                    node.x,
-                    node.y,
-                )
-                node.icon_url = get_icon_url(
-                    node.node_type,
-                    node.icon_id,
-                    node.unlocked,
-                )
-                merged_nodes.append(node)
-
-            elif node.node_type == "connector":
-                # 1. Locked Connector (always present, from structure)
-                locked_node = node.model_copy(deep=True)
-                locked_node.unlocked = False
-                locked_node.node_id = get_node_id(
-                    page.page_number,
-                    node.node_type,
-                    node.icon_id,
-                    False,
-                    node.x,
-                    node.y,
-                )
-                locked_node.icon_url = get_icon_url(
-                    node.node_type,
-                    node.icon_id,
-                    False,
-                )
-                merged_nodes.append(locked_node)
-
-                # 2. Unlocked Connector (if unlocked, from player data)
-                if is_unlocked:
-                    unlocked_source = unlocked_nodes[lookup_key]
-
-                    unlocked_node = unlocked_source.model_copy(deep=True)
-                    unlocked_node.unlocked = True
-                    # Ensure node_id reflects unlocked state and specific details
-                    unlocked_node.node_id = get_node_id(
-                        page.page_number,
-                        unlocked_node.node_type,
-                        unlocked_node.icon_id,  # Use unlocked icon_id/connector_type
-                        True,
-                        unlocked_node.x,
-                        unlocked_node.y,
-                    )
-                    unlocked_node.icon_url = get_icon_url(
-                        unlocked_node.node_type,
-                        unlocked_node.icon_id,
-                        True,
-                    )
-                    merged_nodes.append(unlocked_node)
+        # back to front, so the positions still to insert at stay valid
+        for position, unlocked_node in sorted(
+            connector_inserts, key=lambda insert: insert[0], reverse=True
+        ):
+            nodes.insert(position + 1, unlocked_node)
 
         merged_pages.append(
-            AbilityTreePage(
-                page_number=page.page_number,
-                nodes=merged_nodes,
-            )
+            AbilityTreePage.model_construct(page_number=page.page_number, nodes=nodes)
         )
 
     return merged_pages
 
 
-async def fetch_tree_structure(
-    class_type: str, http_client: httpx.AsyncClient
-) -> list[AbilityTreePage]:
-    tree_response = await http_client.get(
-        f"https://api.wynncraft.com/v3/ability/map/{class_type}",
-        headers={"Authorization": f"Bearer {wynn_token}"},
+async def get_ability_tree(
+    uuid: str,
+    character_uuid: str,
+    class_type: str,
+    http_client: UpstreamClients,
+    redis: Redis,
+):
+    if class_type not in VALID_CLASSES:
+        raise exceptions.UnprocessableEntity("invalid wynncraft class")
+
+    structure_task = get_tree_structure(class_type, http_client, redis)
+    abilities_task = get_tree_abilities(class_type, http_client, redis)
+    player_task = get_player_structure(uuid, character_uuid, http_client, redis)
+
+    structure_pages, abilities_pages, player_pages = await asyncio.gather(
+        structure_task,
+        abilities_task,
+        player_task,
     )
 
+    index = get_tree_index(class_type, structure_pages, abilities_pages)
+    return overlay_unlocked(index, player_pages)
+
+
+async def fetch_tree_structure(
+    class_type: str,
+    http_client: UpstreamClients,
+    validators: Validators = Validators(),
+) -> tuple[list[AbilityTreePage], Validators] | NotModified:
     try:
+        tree_response = await http_client.provider("wynncraft").get(
+            f"https://api.wynncraft.com/v3/ability/map/{class_type}",
+            headers={"Authorization": f"Bearer {wynn_token}", **validators.headers()},
+        )
+        if tree_response.status_code == 304:
+            return NOT_MODIFIED
         tree_response.raise_for_status()
+    except httpx.HTTPStatusError:
+        raise exceptions.UpstreamError()
     except httpx.TimeoutException:
         raise exceptions.UpstreamTimeoutError()
     except httpx.RequestError:
@@ -300,27 +396,32 @@ async def fetch_tree_structure(
                 )
             )
 
-    return [
+    pages = [
         AbilityTreePage(page_number=page_num, nodes=nodes)
         for page_num, nodes in sorted(pages_nodes.items())
     ]
+    return pages, Validators.from_response(tree_response)
 
 
 async def fetch_player_structure(
-    uuid: str, character_uuid: str, http_client: httpx.AsyncClient
+    uuid: str, character_uuid: str, http_client: UpstreamClients
 ):
     # this is similar to get_tree_structure
     # but it only includes abilities which are unlocked by the player
-    player_response = await http_client.get(
-        f"https://api.wynncraft.com/v3/player/{dashify_uuid(uuid)}/characters/{character_uuid}/abilities",
-        headers={"Authorization": f"Bearer {wynn_token}"},
-    )
-    if player_response.status_code == 403:
-        raise exceptions.Forbidden(
-            "The player has disabled public access to their ability tree."
-        )
     try:
+        player_response = await http_client.provider("wynncraft").get(
+            f"https://api.wynncraft.com/v3/player/{dashify_uuid(uuid)}/characters/{character_uuid}/abilities",
+            headers={"Authorization": f"Bearer {wynn_token}"},
+        )
+        if player_response.status_code == 403:
+            raise exceptions.Forbidden(
+                "The player has disabled public access to their ability tree."
+            )
+        if player_response.status_code == 404:
+            raise exceptions.NotFound()
         player_response.raise_for_status()
+    except httpx.HTTPStatusError:
+        raise exceptions.UpstreamError()
     except httpx.TimeoutException:
         raise exceptions.UpstreamTimeoutError()
     except httpx.RequestError:
@@ -394,15 +495,21 @@ def join_description(parts: list[str]) -> str:
 
 
 async def fetch_tree_abilities(
-    class_type: str, http_client: httpx.AsyncClient
-) -> list[AbilityTreePage]:
+    class_type: str,
+    http_client: UpstreamClients,
+    validators: Validators = Validators(),
+) -> tuple[list[AbilityTreePage], Validators] | NotModified:
     # only abilities, but contains rich descriptions
-    tree_response = await http_client.get(
-        f"https://api.wynncraft.com/v3/ability/tree/{class_type}",
-        headers={"Authorization": f"Bearer {wynn_token}"},
-    )
     try:
+        tree_response = await http_client.provider("wynncraft").get(
+            f"https://api.wynncraft.com/v3/ability/tree/{class_type}",
+            headers={"Authorization": f"Bearer {wynn_token}", **validators.headers()},
+        )
+        if tree_response.status_code == 304:
+            return NOT_MODIFIED
         tree_response.raise_for_status()
+    except httpx.HTTPStatusError:
+        raise exceptions.UpstreamError()
     except httpx.TimeoutException:
         raise exceptions.UpstreamTimeoutError()
     except httpx.RequestError:
@@ -442,71 +549,120 @@ async def fetch_tree_abilities(
         tree_page = AbilityTreePage(page_number=page_number, nodes=processed_nodes)
         processed_pages.append(tree_page)
 
-    return processed_pages
+    return processed_pages, Validators.from_response(tree_response)
 
 
-async def get_tree_structure(
-    class_type: str, http_client: httpx.AsyncClient, redis: Redis
-) -> list[AbilityTreePage]:
-    key = f"{TREE_STRUCTURE_KEY}{class_type}"
-    cached = await redis.get(key)
+async def read_tree_cache(
+    key: str, redis: Redis
+) -> Cached[list[AbilityTreePage]] | None:
+    cached = await read_conditional(redis, key)
 
     if cached is not None:
-        raw_pages = json.loads(cached)
-        return [AbilityTreePage.model_validate(page) for page in raw_pages]
+        raw_pages, stored_at = cached
+        pages = [AbilityTreePage.model_validate(page) for page in raw_pages]
+        return Cached(pages, stored_at)
+
+    return None
 
-    pages = await fetch_tree_structure(class_type, http_client)
 
-    await redis.set(
+async def read_static_tree_cache(
+    key: str, redis: Redis
+) -> Cached[list[AbilityTreePage]] | None:
+    # the pages are shared between requests and immutable (frozen nodes),
+    # overlay_unlocked builds new pages around them instead of copying
+    return await STATIC_TREE_CACHE.get_or_load(key, lambda: read_tree_cache(key, redis))
+
+
+async def write_tree_cache(
+    key: str,
+    pages: list[AbilityTreePage],
+    policy: CachePolicy,
+    redis: Redis,
+    validators: Validators = Validators(),
+) -> None:
+    await write_conditional(
+        redis,
         key,
-        json.dumps([page.model_dump() for page in pages]),
-        ex=STATIC_DATA_TTL_SECONDS,
+        [page.model_dump() for page in pages],
+        policy.hard_seconds,
+        validators,
     )
 
-    return pages
-
 
-async def get_tree_abilities(
-    class_type: str, http_client: httpx.AsyncClient, redis: Redis
+async def get_tree_structure(
+    class_type: str, http_client: UpstreamClients, redis: Redis
 ) -> list[AbilityTreePage]:
-    key = f"{TREE_ABILITIES_KEY}{class_type}"
-    cached = await redis.get(key)
-
-    if cached is not None:
-        raw_pages = json.loads(cached)
-        return [AbilityTreePage.model_validate(page) for page in raw_pages]
+    key = WYNNCRAFT_TREE_STRUCTURE.key(class_type)
+
+    async def fetch() -> list[AbilityTreePage] | NotModified:
+        validators = await read_validators(redis, key)
+        result = await fetch_tree_structure(class_type, http_client, validators)
+        if isinstance(result, NotModified):
+            stored_at = await touch_conditional(
+                redis, key, STATIC_DATA_POLICY.hard_seconds
+            )
+            await touch(redis, STATIC_TREE_CACHE, key, stored_at)
+            return result
+        pages, validators = result
+        await write_tree_cache(key, pages, STATIC_DATA_POLICY, redis, validators)
+        await invalidate(redis, STATIC_TREE_CACHE, key)
+        return pages
+
+    return await serve_cached(
+        redis,
+        ("wynncraft", "tree_structure", class_type),
+        STATIC_DATA_POLICY,
+        lambda: read_static_tree_cache(key, redis),
+        fetch,
+    )
 
-    pages = await fetch_tree_abilities(class_type, http_client)
 
-    await redis.set(
-        key,
-        json.dumps([page.model_dump() for page in pages]),
-        ex=STATIC_DATA_TTL_SECONDS,
+async def get_tree_abilities(
+    class_type: str, http_client: UpstreamClients, redis: Redis
+) -> list[AbilityTreePage]:
+    key = WYNNCRAFT_TREE_ABILITIES.key(class_type)
+
+    async def fetch() -> list[AbilityTreePage] | NotModified:
+        validators = await read_validators(redis, key)
+        result = await fetch_tree_abilities(class_type, http_client, validators)
+        if isinstance(result, NotModified):
+            stored_at = await touch_conditional(
+                redis, key, STATIC_DATA_POLICY.hard_seconds
+            )
+            await touch(redis, STATIC_TREE_CACHE, key, stored_at)
+            return result
+        pages, validators = result
+        await write_tree_cache(key, pages, STATIC_DATA_POLICY, redis, validators)
+        await invalidate(redis, STATIC_TREE_CACHE, key)
+        return pages
+
+    return await serve_cached(
+        redis,
+        ("wynncraft", "tree_abilities", class_type),
+        STATIC_DATA_POLICY,
+        lambda: read_static_tree_cache(key, redis),
+        fetch,
     )
 
-    return pages
-
 
 async def get_player_structure(
-    uuid: str, character_uuid: str, http_client: httpx.AsyncClient, redis: Redis
+    uuid: str, character_uuid: str, http_client: UpstreamClients, redis: Redis
 ) -> list[AbilityTreePage]:
-    key = f"{PLAYER_STRUCTURE_KEY}{uuid}:{character_uuid}"
-    cached = await redis.get(key)
-
-    if cached is not None:
-        raw_pages = json.loads(cached)
-        return [AbilityTreePage.model_validate(page) for page in raw_pages]
-
-    pages = await fetch_player_structure(uuid, character_uuid, http_client)
-
-    await redis.set(
-        key,
-        json.dumps([page.model_dump() for page in pages]),
-        ex=DYNAMIC_DATA_TTL_SECONDS,
+    key = WYNNCRAFT_PLAYER_STRUCTURE.key(f"{uuid}:{character_uuid}")
+
+    async def fetch() -> list[AbilityTreePage]:
+        pages = await fetch_player_structure(uuid, character_uuid, http_client)
+        await write_tree_cache(key, pages, DYNAMIC_DATA_POLICY, redis)
+        return pages
+
+    return await serve_cached(
+        redis,
+        ("wynncraft", "player_abilities", f"{uuid}:{character_uuid}"),
+        DYNAMIC_DATA_POLICY,
+        lambda: read_tree_cache(key, redis),
+        fetch,
     )
 
-    return pages
-
 
 if __name__ == "__main__":
 
@@ -516,7 +672,7 @@ if __name__ == "__main__":
             "3ff2e63ad63045e0b96f57cd0eae708d",
             "b44f68d8-e73a-437b-acda-ee938282932f",
             "warrior",
-            httpx.AsyncClient(),
+            UpstreamClients(),
             redis,
         )
         print(data)
@@ -6,9 +6,10 @@ from metrics_manager import add_value
 from db import engine
 from dotenv import load_dotenv
 import os
-from exceptions import NotFound
+from exceptions import NotFound, UpstreamError, UpstreamTimeoutError
 import httpx
 import asyncio
+from upstream_clients import UpstreamClients
 
 # * The wynncraft api requires dashed uuids so when calling something by UUID dashed_uuid should be used
 
@@ -553,22 +554,57 @@ def process_characters(
     return pydantic_characters
 
 
+async def fetch_wynncraft_player(
+    uuid: str, http_client: UpstreamClients, full_result: bool = True
+) -> dict:
+    """
+    The raw /v3/player response. Without full_result it leaves out the
+    characters and stats, which is all the online status needs.
+    """
+    dashed_uuid = dashify_uuid(uuid)
+    url = f"https://api.wynncraft.com/v3/player/{dashed_uuid}"
+    if full_result:
+        url += "?fullResult"
+
+    try:
+        response = await http_client.provider("wynncraft").get(
+            url,
+            headers={"Authorization": f"Bearer {wynn_token}"},
+        )
+        if response.status_code == 404:
+            raise NotFound()
+        response.raise_for_status()
+    except httpx.HTTPStatusError:
+        raise UpstreamError()
+    except httpx.TimeoutException as e:
+        print(f"Wynncraft player request timed out: {e}")
+        raise UpstreamTimeoutError()
+    except httpx.RequestError as e:
+        print(f"Wynncraft player request failed: {e}")
+        raise UpstreamError()
+    return response.json()
+
+
+def extract_status(wynn_response: dict) -> dict:
+    """The fields of a /v3/player response that online status lookups read"""
+    return {
+        "online": wynn_response.get("online", False),
+        "server": wynn_response.get("server"),
+        "activeCharacter": wynn_response.get("activeCharacter"),
+        "restrictions": wynn_response.get("restrictions") or {},
+    }
+
+
 async def get_wynncraft_player_data(
-    uuid: str, http_client: httpx.AsyncClient
+    uuid: str, http_client: UpstreamClients
 ) -> WynncraftPlayerSummary:
     """Gets basic data about the player"""
-    dashed_uuid = dashify_uuid(uuid)
+    return process_wynncraft_player(await fetch_wynncraft_player(uuid, http_client))
 
-    raw_wynn_response = await http_client.get(
-        f"https://api.wynncraft.com/v3/player/{dashed_uuid}?fullResult",
-        headers={"Authorization": f"Bearer {wynn_token}"},
-    )
-    if raw_wynn_response.status_code == 404:
-        raise NotFound()
-    try:
-        raw_wynn_response.raise_for_status()
-        wynn_response: dict = raw_wynn_response.json()
 
+def process_wynncraft_player(wynn_response: dict) -> WynncraftPlayerSummary:
+    dashed_uuid = wynn_response.get("uuid")
+    try:
         restrictions_response: dict = wynn_response.get("restrictions", {})
         restrictions = PlayerRestrictions(
             main_access=restrictions_response.get("mainAccess", True),
@@ -667,10 +703,10 @@ async def get_wynncraft_player_data(
 
 
 async def get_wynncraft_guild_data(
-    guild_prefix: str, http_client: httpx.AsyncClient
+    guild_prefix: str, http_client: UpstreamClients
 ) -> WynncraftGuildInfo:
     """Gets the guild response, player_guild is req"""
-    raw_guild_response = await http_client.get(
+    raw_guild_response = await http_client.provider("wynncraft").get(
         f"https://api.wynncraft.com/v3/guild/prefix/{guild_prefix}?identifier=username",
         headers={"Authorization": f"Bearer {wynn_token}"},
     )
@@ -760,6 +796,6 @@ if __name__ == "__main__":
     uuid = "3ff2e63ad63045e0b96f57cd0eae708d"
     # uuid = "f3659880e6444485a6515d6f66e9360e"
     # wynn_instance.get_guild_list()
-    data = asyncio.run(get_wynncraft_player_data(uuid, httpx.AsyncClient()))
+    data = asyncio.run(get_wynncraft_player_data(uuid, UpstreamClients()))
     print(data)
     # wynn_instance.get_guild_data('Pirates of the Black Scourge')
@@ -6,7 +6,18 @@ import exceptions
 from wynncraft_api import get_dungeon_unique_completions
 from dotenv import load_dotenv
 from pydantic import BaseModel
-import json
+from upstream_clients import UpstreamClients
+from cache_envelope import (
+    NOT_MODIFIED,
+    NotModified,
+    Validators,
+    read_conditional,
+    read_validators,
+    touch_conditional,
+    write_conditional,
+)
+from cache_namespaces import WYNNCRAFT_MAX_CONTENT
+from local_cache import invalidate, local_cache
 
 load_dotenv()
 
@@ -21,9 +32,13 @@ CONTENT_LEADERBOARD_URL = (
 
 BASE_PLAYER_CHARACTER_URL = "https://api.wynncraft.com/v3/player/"
 
-MAX_CONTENT_KEY = "aspexis:wynncraft:max_stats"
+MAX_CONTENT_KEY = WYNNCRAFT_MAX_CONTENT.key()
 MAX_CONTENT_TTL_SECONDS = 60 * 60 * 24
 
+MAX_CONTENT_LOCAL_CACHE = local_cache(
+    "wynncraft_max_content", ttl_seconds=60 * 5, max_entries=1
+)
+
 
 class MaxContent(BaseModel):
     level: int
@@ -84,12 +99,18 @@ def _parse_character_stats(character_data: dict) -> MaxContent | None:
     )
 
 
-async def _fetch_content_max(http_client: httpx.AsyncClient) -> MaxContent:
+async def _fetch_content_max(
+    http_client: UpstreamClients, validators: Validators = Validators()
+) -> tuple[MaxContent, Validators] | NotModified:
     print("Updating Wynncraft content max")
-    leaderboard_response = await http_client.get(
+    leaderboard_response = await http_client.provider("wynncraft").get(
         CONTENT_LEADERBOARD_URL,
-        headers={"Authorization": f"Bearer {wynn_token}"},
+        headers={"Authorization": f"Bearer {wynn_token}", **validators.headers()},
     )
+    if leaderboard_response.status_code == 304:
+        # same leaderboard, so the same characters hold the max
+        return NOT_MODIFIED
+
     try:
         leaderboard_response.raise_for_status()
     except httpx.TimeoutException:
@@ -103,7 +124,7 @@ async def _fetch_content_max(http_client: httpx.AsyncClient) -> MaxContent:
 
     for character in characters:
         # we loop through the characters until we find one that isn't restricted
-        character_response = await http_client.get(
+        character_response = await http_client.provider("wynncraft").get(
             f"{BASE_PLAYER_CHARACTER_URL}{character['uuid']}/characters/{character['characterUuid']}",
             headers={"Authorization": f"Bearer {wynn_token}"},
         )
@@ -121,33 +142,52 @@ async def _fetch_content_max(http_client: httpx.AsyncClient) -> MaxContent:
             )
             continue
 
-        return result
+        return result, Validators.from_response(leaderboard_response)
     raise exceptions.ServiceError()
 
 
-async def update_content_max(http_client: httpx.AsyncClient, redis: Redis) -> None:
+async def update_content_max(http_client: UpstreamClients, redis: Redis) -> None:
     """Updates Wynncraft Max content in Redis, should only be called by a scheduler"""
-    data = await _fetch_content_max(http_client)
-    json_data = data.model_dump_json()
-    await redis.set(MAX_CONTENT_KEY, json_data, ex=MAX_CONTENT_TTL_SECONDS)
+    validators = await read_validators(redis, MAX_CONTENT_KEY)
+    result = await _fetch_content_max(http_client, validators)
+    if isinstance(result, NotModified):
+        await touch_conditional(redis, MAX_CONTENT_KEY, MAX_CONTENT_TTL_SECONDS)
+        print("wynncraft content leaderboard unchanged, kept max content")
+        return
+
+    data, validators = result
+    await write_conditional(
+        redis, MAX_CONTENT_KEY, data.model_dump(), MAX_CONTENT_TTL_SECONDS, validators
+    )
+    await invalidate(redis, MAX_CONTENT_LOCAL_CACHE, MAX_CONTENT_KEY)
     print("successfully updated wynncraft max content")
 
 
 async def get_wynncraft_content_max(
-    http_client: httpx.AsyncClient, redis: Redis
+    http_client: UpstreamClients, redis: Redis
 ) -> MaxContent:
     """Gets Wynncraft Max content, getting from Redis if available"""
-    data = await redis.get(MAX_CONTENT_KEY)
-    if data is None:
-        data = await _fetch_content_max(http_client)
-        json_data = data.model_dump_json()
-        await redis.set(MAX_CONTENT_KEY, json_data, ex=MAX_CONTENT_TTL_SECONDS)
-    else:
-        data = json.loads(data)
-        data = MaxContent(**data)
 
+    async def read_cache() -> MaxContent | None:
+        cached = await read_conditional(redis, MAX_CONTENT_KEY)
+        if cached is not None:
+            payload, _ = cached
+            return MaxContent(**payload)
+        return None
+
+    cached = await MAX_CONTENT_LOCAL_CACHE.get_or_load(MAX_CONTENT_KEY, read_cache)
+    if cached is not None:
+        return cached
+
+    result = await _fetch_content_max(http_client)
+    assert not isinstance(result, NotModified)  # sent without validators
+    data, validators = result
+    await write_conditional(
+        redis, MAX_CONTENT_KEY, data.model_dump(), MAX_CONTENT_TTL_SECONDS, validators
+    )
+    await invalidate(redis, MAX_CONTENT_LOCAL_CACHE, MAX_CONTENT_KEY)
     return data
 
 
 if __name__ == "__main__":
-    print(asyncio.run(_fetch_content_max(httpx.AsyncClient())))
+    print(asyncio.run(_fetch_content_max(UpstreamClients())))
@@ -0,0 +1,109 @@
+from redis.asyncio import Redis
+
+from cache_envelope import (
+    CachePolicy,
+    Cached,
+    is_known_missing,
+    read_entry,
+    remember_missing,
+    serve_cached,
+    wrap,
+)
+from cache_namespaces import WYNNCRAFT_PLAYER, WYNNCRAFT_STATUS
+from exceptions import NotFound
+from upstream_clients import UpstreamClients
+from wynncraft_api import (
+    WynncraftPlayerSummary,
+    extract_status,
+    fetch_wynncraft_player,
+    process_wynncraft_player,
+)
+
+WYNNCRAFT_POLICY = CachePolicy(
+    fresh_seconds=60 * 3,
+    revalidate_seconds=60 * 10,
+    hard_seconds=60 * 60,
+)
+# online status older than a minute is no use. The tracker polls every minute
+# too, so its own entry has always expired by its next poll: the cache is for
+# the status endpoint and for other workers' lookups between polls, a longer
+# TTL would only make the tracker report every other minute
+WYNNCRAFT_STATUS_TTL = 60
+
+
+async def get_wynncraft_player_cache(
+    uuid: str, redis: Redis
+) -> Cached[WynncraftPlayerSummary] | None:
+    cached = await read_entry(redis, WYNNCRAFT_PLAYER, uuid)
+    if cached is not None:
+        payload, stored_at = cached
+        try:
+            return Cached(WynncraftPlayerSummary(**payload), stored_at)
+        except Exception as e:
+            print(f"Couldn't validate WynncraftPlayerSummary from cache: {e}")
+            return None
+    return None
+
+
+async def fetch_wynncraft_player_data(
+    uuid: str, http_client: UpstreamClients, redis: Redis
+) -> WynncraftPlayerSummary:
+    wynn_response = await fetch_wynncraft_player(uuid, http_client)
+    data = process_wynncraft_player(wynn_response)
+
+    pipe = redis.pipeline()
+    pipe.set(
+        WYNNCRAFT_PLAYER.key(uuid),
+        wrap(data.model_dump()),
+        ex=WYNNCRAFT_POLICY.hard_seconds,
+    )
+    # written by both full and status-only fetches so the status route and
+    # the tracker can skip the upstream call after a player page
+    pipe.set(
+        WYNNCRAFT_STATUS.key(uuid),
+        wrap(extract_status(wynn_response)),
+        ex=WYNNCRAFT_STATUS_TTL,
+    )
+    await pipe.execute()
+    return data
+
+
+async def get_wynncraft_data(
+    uuid: str, http_client: UpstreamClients, redis: Redis
+) -> WynncraftPlayerSummary:
+    return await serve_cached(
+        redis,
+        ("wynncraft", "player", uuid),
+        WYNNCRAFT_POLICY,
+        lambda: get_wynncraft_player_cache(uuid, redis),
+        lambda: fetch_wynncraft_player_data(uuid, http_client, redis),
+    )
+
+
+async def get_wynncraft_status(
+    uuid: str, http_client: UpstreamClients, redis: Redis
+) -> dict:
+    """
+    online, server, activeCharacter and restrictions of a player, from the
+    last minute's full or status fetch if there was one
+    """
+    cached = await read_entry(redis, WYNNCRAFT_STATUS, uuid)
+    if cached is not None:
+        entry = Cached(*cached)
+        if entry.age < WYNNCRAFT_STATUS_TTL:
+            return entry.value
+
+    # shared with the player lookup, the same players never joined
+    missing_key = ("wynncraft", "player", uuid)
+    if await is_known_missing(redis, missing_key):
+        raise NotFound()
+    try:
+        wynn_response = await fetch_wynncraft_player(
+            uuid, http_client, full_result=False
+        )
+    except NotFound:
+        await remember_missing(redis, missing_key)
+        raise
+    status = extract_status(wynn_response)
+    await redis.set(WYNNCRAFT_STATUS.key(uuid), wrap(status), ex=WYNNCRAFT_STATUS_TTL)
+    return status